@@ -0,0 +1,132 @@
+import argparse
+import os
+import socket
+import traceback
+
+from multiprocessing.connection import Client
+
+import numpy as np
+
+from cpu_backend import WorkerPool
+from dataset_io import load_dataset
+
+####
+# Node of a multi-node run, one per host
+# The node connects to the coordinator of multi_node.py, is given a range
+# of rows of the dataset, keeps it in the shared memory of its own pool of
+# CPU workers and answers the same commands as a worker. The replies of
+# its workers are reduced on the node, so only K x M statistics go over
+# the network on each iteration
+####
+
+# How the replies of the workers of a node are combined into one reply
+def sum_replies(replies):
+    return sum(replies)
+
+def sum_statistics(replies):
+    # The timeline events of the workers, the last values, are concatenated
+    return tuple(sum(values[1:], values[0]) for values in zip(*replies))
+
+def concatenate_replies(replies):
+    return np.concatenate(replies)
+
+# The labels are only gathered when they were asked for, otherwise the
+# coordinator asks for the label_statistics, K counts and inertias
+REDUCTIONS = {  'statistics'       : sum_statistics      ,
+                'potential'        : sum_replies         ,
+                'counts'           : sum_replies         ,
+                'sample'           : concatenate_replies ,
+                'labels'           : concatenate_replies ,
+                'label_statistics' : sum_statistics       }
+
+def parse_address(address):
+    (host, port) = address.rsplit(':', 1)
+    return (host, int(port))
+
+def node_loop(connection, n_workers):
+    pool = None
+    pool_method = None
+    worker_offset = 0
+
+    while True:
+        (command, args) = connection.recv()
+        if command == 'close':
+            break
+
+        try:
+            if command == 'load':
+                (data_file, start, stop, method_name, dtype, worker_offset) = args
+                if pool_method != method_name:
+                    if pool is not None:
+                        pool.close()
+                    pool = WorkerPool(n_workers, method_name)
+                    pool_method = method_name
+
+                # Only the rows of this node are read from the dataset
+                pool.scatter(load_dataset(data_file)[start:stop], dtype)
+                reply = None
+
+            elif command == 'sample':
+                # The random streams are numbered over the workers of all nodes
+                (factor, seed_value, stream) = args
+                reply = concatenate_replies(pool.broadcast('sample', factor, seed_value, stream + worker_offset))
+
+            elif command == 'mini_batch':
+                # So are the streams of the mini-batches
+                (centroids, K, fraction, seed_value, stream, timed) = args
+                reply = sum_statistics(pool.broadcast('mini_batch', centroids, K, fraction, seed_value,
+                                                      stream + worker_offset, timed))
+
+            else:
+                reply = REDUCTIONS[command](pool.broadcast(command, *args))
+
+            connection.send(('ok', reply))
+        except Exception as e:
+            traceback.print_exc()
+            connection.send(('error', e))
+
+    if pool is not None:
+        pool.close()
+    connection.close()
+
+def run_node(address, authkey, n_workers):
+    connection = Client(parse_address(address), authkey = authkey)
+    connection.send((socket.gethostname(), n_workers))
+    node_loop(connection, n_workers)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Node of a Multi-Node Distribuited Clustering.')
+
+    parser.add_argument("--address"                                           ,
+                        dest     = "address"                                  ,
+                        required = True                                       ,
+                        metavar  = "host:port"                                ,
+                        help     = "Address of the multi_node.py coordinator !!!" )
+
+    parser.add_argument("--n_workers"                                         ,
+                        dest     = "n_workers"                                ,
+                        required = False                                      ,
+                        default  = os.cpu_count()                             ,
+                        metavar  = "int"                                      ,
+                        type     = int                                        ,
+                        help     = "Number of CPU worker processes, all the " +
+                        "cores by default !!!" )
+
+    parser.add_argument("--authkey"                                           ,
+                        dest     = "authkey"                                  ,
+                        required = False                                      ,
+                        default  = os.environ.get('MULTI_NODE_AUTHKEY')       ,
+                        metavar  = "str"                                      ,
+                        help     = "Shared secret of the coordinator, or the " +
+                        "MULTI_NODE_AUTHKEY environment variable !!!" )
+
+    args = parser.parse_args()
+
+    if args.authkey is None:
+        parser.error("An --authkey or MULTI_NODE_AUTHKEY is Required")
+    if args.n_workers <= 0:
+        parser.error("Number of Workers Given is Non Positive")
+
+    run_node(address   = args.address                 ,
+             authkey   = args.authkey.encode('utf-8') ,
+             n_workers = args.n_workers               )
@@ -0,0 +1,74 @@
+import json
+import os
+
+import numpy as np
+
+####
+# Fitted clustering saved to disk, so that new data can update it instead
+# of reclustering everything seen so far
+# The model keeps the sufficient statistics of all the data it was fitted
+# on : the per cluster sums (K x M) and counts (K), which are membership
+# sums for fuzzy C-means. A refit on new data adds the statistics of the
+# new data to them, so the stored counts weight the old data and the cost
+# only depends on the size of the new data
+####
+MODEL_EXTENSION = '.npz'
+
+class ClusteringModel(object):
+    def __init__(self, method_name, centers, sums, counts, method_params = None, n_seen = 0):
+        self.method_name = method_name
+        self.centers = np.asarray(centers)
+        self.sums = np.asarray(sums, dtype = np.float64)
+        self.counts = np.asarray(counts, dtype = np.float64)
+        self.method_params = dict(method_params or {})
+        self.n_seen = int(n_seen)
+
+    @property
+    def K(self):
+        return self.centers.shape[0]
+
+    @property
+    def n_dim(self):
+        return self.centers.shape[1]
+
+    def prior(self):
+        # Statistics the next refit starts from
+        return (self.sums, self.counts)
+
+    def updated(self, run_result, n_new):
+        ####
+        # Model after a fit on n_new rows, run_result must hold the sums and
+        # counts of the last iteration, which already include this model's
+        ####
+        return ClusteringModel(method_name   = self.method_name       ,
+                               centers       = run_result['end_center'],
+                               sums          = run_result['sums']      ,
+                               counts        = run_result['counts']    ,
+                               method_params = self.method_params      ,
+                               n_seen        = self.n_seen + n_new     )
+
+    def save(self, model_file):
+        if os.path.splitext(model_file)[1] != MODEL_EXTENSION:
+            raise ValueError("Models are saved as " + MODEL_EXTENSION + " files")
+
+        np.savez(model_file,
+                 method_name   = np.array(self.method_name)              ,
+                 centers       = self.centers                            ,
+                 sums          = self.sums                               ,
+                 counts        = self.counts                             ,
+                 method_params = np.array(json.dumps(self.method_params)),
+                 n_seen        = np.array(self.n_seen)                   )
+        return model_file
+
+def empty_model(method_name, K, n_dim, method_params = None):
+    # Model of nothing, a fit from it is a fit from scratch
+    return ClusteringModel(method_name, np.zeros((K, n_dim)), np.zeros((K, n_dim)), np.zeros(K), method_params)
+
+def load_model(model_file):
+    with np.load(model_file) as model:
+        return ClusteringModel(method_name   = str(model['method_name'])                ,
+                               centers       = model['centers']                         ,
+                               sums          = model['sums']                            ,
+                               counts        = model['counts']                          ,
+                               method_params = json.loads(str(model['method_params']))  ,
+                               n_seen        = int(model['n_seen'])                     )
@@ -1,9 +1,43 @@
 import os
 import argparse
+import hashlib
+import json
 import time
 import re
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
+
+####
+# Compiles the nvprof logs of a sweep into one table, with one row per
+# profiled call, keyed by the method, GPUs, n_obs, n_dims and K of the
+# log file name (method-GPUs2-n_obs1000-n_dims5-K3.log)
+# The logs are parsed in a process pool. A manifest next to the table keeps
+# the mtime, size and hash of every log compiled, so only new or changed
+# logs are parsed again and the rows of the others are kept from the table
+####
+OUTPUT_NAME = 'profiling_results'
+MANIFEST_NAME = 'profiling_manifest.json'
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+KEY_COLUMNS = ['LogFile', 'Method', 'n_GPUs', 'n_obs', 'n_dims', 'K']
+
+CALL_COLUMNS = ['Section', 'TimePerc', 'Time', 'NumCalls', 'AvgCallTime', 'MinCallTime',
+                'MaxCallTime', 'CallName']
+
+SECTIONS = {'profiling_result' : re.compile(r'==\d+== Profiling result:'),
+            'API_calls'        : re.compile(r'==\d+== API calls:')       }
+
+# Newer nvprof list the API calls in the profiling result, after this label
+API_CALLS_LABEL = re.compile(r'^(?=\s*API calls:)', re.MULTILINE)
+
+# Time(%) Time Calls Avg Min Max Name, newer nvprof prefix the first line of
+# each type of call with 'GPU activities:' or 'API calls:'
+CALL_LINE = re.compile(r'^\s*(?:[A-Za-z ]+:)?\s*([\d.]+%)\s+(\S+)\s+(\d+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(.+?)\s*$',
+                       re.MULTILINE)
+
+TIME_UNITS = {'ns' : 1e-9, 'us' : 1e-6, 'ms' : 1e-3, 's' : 1.0, 'm' : 60.0, 'h' : 3600.0}
+
 def is_valid_file(parser, arg):
   if not os.path.exists(arg):
     parser.error("The directory %s does not exist!" % arg)
@@ -13,163 +47,184 @@ def is_valid_file(parser, arg):
 def create_dir_if_not_exist(parser, arg):
   if not os.path.exists(arg):
     os.makedirs(arg)
-  else:
-    return arg
+  return arg
 
 def any_time_to_seconds(time_str):
   unit = str( re.sub("[^A-Za-z]", "", time_str) )
   unit = str( re.sub("e", "", unit ) )
   time_val = float( re.sub(unit, "", time_str) )
-
-  if unit == 'ns':
-    time_val /= (10.0 ** 9)
-  elif unit == 'us':
-    time_val /= (10.0 ** 6)
-  elif unit == 'ms':
-    time_val /= (10.0 ** 3)
-  elif unit == 'm':
-    time_val *= (60.0)
-  elif unit == 'h':
-    time_val *= (3600.0)
-
-  return float(time_val)
-
-def digits_items_in_list(List):
-  filtered_list = []
-  for element in List:
-    if len(re.findall('\d+', element)) :
-      filtered_list.append(element)
-  return filtered_list
-
-def read_and_process_file(input_file_name, input_dir, output_dir):
+  return float(time_val * TIME_UNITS.get(unit, 1.0))
+
+def parse_file_name(input_file_name):
+  (method, n_GPUs, n_obs, n_dim, K) = os.path.splitext(input_file_name)[0].split('-')
+  return {'LogFile' : input_file_name                     ,
+          'Method'  : method                              ,
+          'n_GPUs'  : int( n_GPUs.split('GPUs')[1] )      ,
+          'n_obs'   : int( n_obs.split('n_obs')[1] )      ,
+          'n_dims'  : int( n_dim.split('n_dims')[1] )     ,
+          'K'       : int( K.split('K')[1] )              }
+
+def parse_calls(section_name, text):
+  rows = []
+  for (time_perc, total_time, n_calls, avg_time, min_time, max_time, name) in CALL_LINE.findall(text):
+    rows.append( (section_name, time_perc, any_time_to_seconds(total_time), int(n_calls),
+                  any_time_to_seconds(avg_time), any_time_to_seconds(min_time),
+                  any_time_to_seconds(max_time), name.replace(' ', '')) )
+  return rows
+
+def read_and_process_file(input_file_name, input_dir):
+  ####
+  # Rows of one log, the profiling result and the API calls sections, or
+  # None when the file is not a complete nvprof log of a run
+  ####
   if os.path.splitext(input_file_name)[1] != '.log':
-    return -1
+    return None
 
-  (method, n_GPUs, n_obs, n_dim, K) = input_file_name.split('.')[0].split('-')
-  n_obs = int ( n_obs.split('n_obs')[1] )
-  n_dim = int ( n_dim.split('n_dims')[1] )
-  n_GPUs = int ( n_GPUs.split('GPUs')[1] )
-  K = int ( K.split('K')[1] )
+  try:
+    key = parse_file_name(input_file_name)
+  except (ValueError, IndexError):
+    return None
 
-  file_connection = open(input_dir + input_file_name, 'r')
-  file_text = file_connection.read()
-  file_connection.close()
+  with open(os.path.join(input_dir, input_file_name), 'r') as file_connection:
+    file_text = file_connection.read()
 
-  profling_calls_flag = '==\d+== Profiling result:'
-  API_calls_flag = '==\d+== API calls:'
-  
   try:
-    after_profling_text = re.split(profling_calls_flag, file_text)[1]
-    until_API_calls_text = re.split(API_calls_flag, after_profling_text)
+    after_profling_text = SECTIONS['profiling_result'].split(file_text)[1]
   except IndexError:
-    return -2
-
-  profling_text = until_API_calls_text[0]
-  API_calls_text = until_API_calls_text[1]
-
-  profling_text_list = re.split('\n', profling_text)
-  API_calls_text_list = re.split('\n', API_calls_text)
-
-  ### Character Count
-  profling_items_list = digits_items_in_list(profling_text_list)
-  API_calls_items_list = digits_items_in_list(API_calls_text_list)
-
-  line_split = []
-  time_perc = []
-  total_time = []
-  n_calls = []
-  avg_call_time = []
-  min_call_time = []
-  max_call_time = []
-  call_name = []
-
-  for item in profling_items_list:
-    line_split = item.split()
-    time_perc.append( line_split[0] )
-    total_time.append( any_time_to_seconds(line_split[1]) )
-    n_calls.append( line_split[2] )
-    avg_call_time.append( any_time_to_seconds(line_split[3]) )
-    min_call_time.append( any_time_to_seconds(line_split[4]) )
-    max_call_time.append( any_time_to_seconds(line_split[5]) )
-    call_name.append( ''.join(line_split[6:]) )
-  aux_dict = {'TimePerc'    : time_perc    ,
-              'Time'        : total_time   ,
-              'NumCalls'    : n_calls      ,
-              'AvgCallTime' : avg_call_time,
-              'MinCallTime' : min_call_time,
-              'MaxCallTime' : max_call_time,
-              'CallName'    : call_name     }
-
-  profling_result_data_frame = pd.DataFrame(aux_dict)
-  save_file_name = os.path.join(output_dir, 'profling_result_' + os.path.splitext(input_file_name)[0] + '.csv')
-  profling_result_data_frame.to_csv(save_file_name)
-
-  line_split = []
-  time_perc = []
-  total_time = []
-  n_calls = []
-  avg_call_time = []
-  min_call_time = []
-  max_call_time = []
-  call_name = []
-
-  for item in API_calls_items_list:
-    line_split = item.split()
-    time_perc.append( line_split[0] )
-    total_time.append( any_time_to_seconds(line_split[1]) )
-    n_calls.append( line_split[2] )
-    avg_call_time.append( any_time_to_seconds(line_split[3]) )
-    min_call_time.append( any_time_to_seconds(line_split[4]) )
-    max_call_time.append( any_time_to_seconds(line_split[5]) )
-    call_name.append( ''.join(line_split[6:]) )
-  aux_dict = {'TimePerc'    : time_perc    ,
-              'Time'        : total_time   ,
-              'NumCalls'    : n_calls      ,
-              'AvgCallTime' : avg_call_time,
-              'MinCallTime' : min_call_time,
-              'MaxCallTime' : max_call_time,
-              'CallName'    : call_name     }
-
-  API_calls_data_frame = pd.DataFrame(aux_dict)
-  save_file_name = os.path.join(output_dir, 
-                  'API_calls_' + os.path.splitext(input_file_name)[0] + '.csv')
-  API_calls_data_frame.to_csv(save_file_name)
-  return 1
-
+    return None
+
+  until_API_calls_text = SECTIONS['API_calls'].split(after_profling_text)
+  if len(until_API_calls_text) < 2:
+    until_API_calls_text = API_CALLS_LABEL.split(after_profling_text, maxsplit = 1)
+  if len(until_API_calls_text) < 2:
+    return None
+  (profling_text, API_calls_text) = until_API_calls_text[0:2]
+
+  rows = parse_calls('profiling_result', profling_text) + parse_calls('API_calls', API_calls_text)
+
+  data_frame = pd.DataFrame(rows, columns = CALL_COLUMNS)
+  for (column, value) in reversed(list(key.items())):
+    data_frame.insert(0, column, value)
+  return data_frame
+
+def file_hash(file_path):
+  digest = hashlib.sha1()
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def file_state(file_path, old_state = None):
+  ####
+  # mtime, size and hash of a log, the hash is only computed again when
+  # the mtime or size changed, a log touched but not modified keeps its rows
+  ####
+  stat = os.stat(file_path)
+  state = {'mtime' : stat.st_mtime, 'size' : stat.st_size}
+  if old_state is not None and old_state['mtime'] == state['mtime'] and old_state['size'] == state['size']:
+    state['sha1'] = old_state['sha1']
+  else:
+    state['sha1'] = file_hash(file_path)
+  return state
+
+def read_table(output_file):
+  if not os.path.exists(output_file):
+    return None
+  if output_file.endswith('.parquet'):
+    return pd.read_parquet(output_file)
+  return pd.read_csv(output_file)
+
+def write_table(data_frame, output_file):
+  # Written under another name first, an interrupted run keeps the old table
+  partial_file = output_file + '.partial'
+  if output_file.endswith('.parquet'):
+    data_frame.to_parquet(partial_file, index = False)
+  else:
+    data_frame.to_csv(partial_file, index = False)
+  os.replace(partial_file, output_file)
+
+def main(input_dir, output_dir, output_format = 'csv', n_processes = None):
+  start_time = time.time()
+
+  output_file = os.path.join(output_dir, OUTPUT_NAME + '.' + output_format)
+  manifest_file = os.path.join(output_dir, MANIFEST_NAME)
+
+  old_manifest = {}
+  table = read_table(output_file)
+  if table is not None and os.path.exists(manifest_file):
+    with open(manifest_file, 'r') as f:
+      old_manifest = json.load(f)
+
+  input_files = sorted(name for name in os.listdir(input_dir) if os.path.splitext(name)[1] == '.log')
+  manifest = dict( (name, file_state(os.path.join(input_dir, name), old_manifest.get(name)))
+                   for name in input_files )
+
+  # Logs whose hash changed, and logs removed, lose their rows
+  up_to_date = [name for name in input_files
+                if name in old_manifest and old_manifest[name]['sha1'] == manifest[name]['sha1']]
+  to_parse = [name for name in input_files if name not in up_to_date]
+  print(len(up_to_date), 'logs up to date,', len(to_parse), 'to compile')
+
+  frames = []
+  if table is not None:
+    frames.append( table[table['LogFile'].isin(up_to_date)] )
+
+  with ProcessPoolExecutor(n_processes) as executor:
+    for (input_file_name, data_frame) in zip(to_parse, executor.map(read_and_process_file, to_parse,
+                                                                    [input_dir] * len(to_parse))):
+      if data_frame is None:
+        print('skipped', input_file_name, '- not a complete nvprof log of a run')
+      else:
+        frames.append(data_frame)
+
+  if len(frames) > 0:
+    consolidated = pd.concat(frames, ignore_index = True)
+  else:
+    consolidated = pd.DataFrame(columns = KEY_COLUMNS + CALL_COLUMNS)
+  write_table(consolidated, output_file)
 
-def main(input_dir, output_dir):
-  all_input_files_input_dir = os.listdir(input_dir)
-  
-  I = 0
-  for input_file_name in all_input_files_input_dir:
-    I += 1
-    print(I, '- input_file_name = ', input_file_name)
-    read_and_process_file(input_file_name = input_file_name, 
-                          input_dir = input_dir,
-                          output_dir = output_dir)
+  with open(manifest_file, 'w') as f:
+    json.dump(manifest, f, indent = 1)
 
+  print(len(consolidated), 'calls of', consolidated['LogFile'].nunique(), 'logs written to', output_file,
+        'in', '%.1f' % (time.time() - start_time), 's')
   return 1
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description = 'Compile Distribuited K Means Results.')
-  
+
   parser.add_argument("--input_dir"                                      ,
-            dest = "input_dir"                                 ,
-            required = True                                    ,
-                        metavar = "FILE"                                   ,
-                        type = lambda x: is_valid_file(parser, x)          ,
-                        help = "The directory where log files are located!" )
+                      dest = "input_dir"                                 ,
+                      required = True                                    ,
+                      metavar = "FILE"                                   ,
+                      type = lambda x: is_valid_file(parser, x)          ,
+                      help = "The directory where log files are located!" )
 
   parser.add_argument('--output_dir'                                            ,
-            dest = 'output_dir'                                       ,
-            required = True                                           ,
-                        metavar = "FILE"                                          ,
-            type = lambda x: is_valid_file(create_dir_if_not_exist, x),
-            help = 'The directory where log files will be saved!'      )
+                      dest = 'output_dir'                                       ,
+                      required = True                                           ,
+                      metavar = "FILE"                                          ,
+                      type = lambda x: create_dir_if_not_exist(parser, x)       ,
+                      help = 'The directory where the compiled table will be saved!' )
+
+  parser.add_argument('--output_format'                                         ,
+                      dest = 'output_format'                                    ,
+                      required = False                                          ,
+                      default = 'csv'                                           ,
+                      choices = OUTPUT_FORMATS                                  ,
+                      help = 'csv, or parquet if pyarrow or fastparquet is installed!' )
+
+  parser.add_argument('--n_processes'                                           ,
+                      dest = 'n_processes'                                      ,
+                      required = False                                          ,
+                      default = None                                            ,
+                      metavar = "int"                                           ,
+                      type = int                                                ,
+                      help = 'Number of parsing processes, all the cores by default!' )
 
   args = parser.parse_args()
-  input_dir = args.input_dir
-  output_dir = args.output_dir
 
-  main(input_dir = input_dir  ,
-     output_dir = output_dir )
\ No newline at end of file
+  main(input_dir     = args.input_dir     ,
+       output_dir    = args.output_dir    ,
+       output_format = args.output_format ,
+       n_processes   = args.n_processes   )
@@ -0,0 +1,83 @@
+import numpy as np
+
+####
+# Weighted coresets of the datasets, small weighted sets of points whose
+# weighted cost for any set of centers is close to the cost of the whole
+# dataset, so the methods can be fitted on them instead of the dataset
+# The coresets are lightweight coresets (Bachem, Lucic and Krause, 2018) :
+# m points drawn with replacement with probability
+#     q(x) = 1 / (2 n) + d^2(x, mean) / (2 sum d^2(x', mean))
+# and weighted 1 / (m q(x)). With m = O((M K log K + log 1/delta) / eps^2)
+# the cost of any K centers is estimated within eps times the cost of the
+# centers plus eps times the cost of the mean, with probability 1 - delta
+# The dataset is read once : every block of CORESET_BLOCK_ROWS rows gets a
+# coreset of its own, with its own mean and a share of the m points in
+# proportion to its rows, and the union of the coresets of the blocks is a
+# coreset of the dataset. The shards are the blocks of the np.array_split of
+# the dataset, one per CPU worker
+####
+CORESET_BLOCK_ROWS = 1 << 20
+
+def split_samples(n_samples, bounds):
+    # Share of n_samples of each part bounds[i]:bounds[i + 1], rounded so
+    # that they add up to n_samples
+    cumulative = np.round( (np.asarray(bounds) - bounds[0]) * (n_samples / float(bounds[-1] - bounds[0])) )
+    return np.diff(cumulative).astype(np.int64)
+
+def lightweight_coreset(X, n_samples, rng):
+    # n_samples weighted rows of X, see above
+    sqr_dist = np.sum(np.square(X - X.mean(axis = 0, dtype = np.float64)), axis = 1)
+    total = sqr_dist.sum()
+
+    probabilities = 0.5 / len(X) + (0.5 * sqr_dist / total if total > 0 else 0.5 / len(X))
+    probabilities /= probabilities.sum()
+
+    rows = np.sort(rng.choice(len(X), size = n_samples, p = probabilities))
+    return (X[rows], 1.0 / (n_samples * probabilities[rows]))
+
+def shard_coreset(X, start, stop, n_samples, seed_value):
+    ####
+    # Coreset of rows start:stop of X, a memmap read block by block. The
+    # block starting at row b draws its points from the stream (seed, b)
+    ####
+    bounds = list(range(start, stop, CORESET_BLOCK_ROWS)) + [stop]
+
+    points = []
+    weights = []
+    for (block_start, block_stop, block_samples) in zip(bounds[:-1], bounds[1:], split_samples(n_samples, bounds)):
+        if block_samples == 0:
+            continue
+        rng = np.random.default_rng([seed_value, block_start])
+        (block_points, block_weights) = lightweight_coreset(np.asarray(X[block_start:block_stop]), block_samples, rng)
+        points.append( block_points )
+        weights.append( block_weights )
+
+    if len(points) == 0:
+        return (np.empty((0, X.shape[1]), dtype = X.dtype), np.empty(0))
+    return (np.concatenate(points), np.concatenate(weights))
+
+def shard_bounds(n_rows, n_shards):
+    # Rows of the np.array_split of n_rows rows in n_shards, the first r
+    # shards have one row more
+    (q, r) = divmod(n_rows, n_shards)
+    return np.cumsum([0] + [q + 1] * r + [q] * (n_shards - r))
+
+def build_coreset(pool, data_file, n_rows, coreset_size, seed):
+    ####
+    # Coreset of coreset_size points of the first n_rows rows of data_file,
+    # each worker of pool (see cpu_backend.py) builds the one of its shard
+    # Returns the points and their weights, which add up to about n_rows
+    ####
+    bounds = shard_bounds(n_rows, len(pool.connections))
+    samples = split_samples(coreset_size, bounds)
+
+    replies = pool.run('coreset', [ (data_file, bounds[i], bounds[i + 1], samples[i], seed)
+                                    for i in range(len(samples)) ])
+    return (np.concatenate([points for (points, _) in replies]),
+            np.concatenate([weights for (_, weights) in replies]))
+
+def full_inertia(pool, data_file, n_rows, centers, method_params):
+    # Objective of the method of pool for centers on the first n_rows rows of data_file
+    bounds = shard_bounds(n_rows, len(pool.connections))
+    return float( sum(pool.run('inertia', [ (data_file, bounds[i], bounds[i + 1], centers, method_params)
+                                            for i in range(len(bounds) - 1) ])) )
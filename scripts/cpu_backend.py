@@ -0,0 +1,504 @@
+import argparse
+import atexit
+import os
+import subprocess
+import sys
+import traceback
+
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from coreset import shard_coreset
+from dataset_io import load_dataset
+from memory_planner import fuzzy_block_rows
+from timeline import Timeline, NULL_TIMELINE
+
+####
+# Data parallel backend for hosts without GPUs
+# N local worker processes play the role of the GPUs : the batch is copied
+# once into shared memory and worker i works on the rows of shard i, like
+# the 'scope_i' of the tensorflow graph. Every iteration the parent sends
+# the centers, each worker returns the per cluster statistics of its shard
+# and the parent reduces them and updates the centers
+# The statistics are always returned in ACCUMULATOR_DTYPE, whatever the 
+# precision the shards are stored and the distances computed in
+# In the coments we denote :
+# => N = Number of Observations of a shard
+# => M = Number of Dimensions
+# => K = Number of Centers
+####
+CPU_WORKER_PREFIX = '/cpu_worker:'
+
+ACCUMULATOR_DTYPE = np.float64
+
+# Every worker is one process, the BLAS of each one must use a single thread
+# or the workers compete for the cores and the scaling is lost
+THREAD_ENV_VARS = [ 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS' ]
+
+def cpu_worker_names(n_workers):
+    return [CPU_WORKER_PREFIX + str(i) for i in range(n_workers)]
+
+def uses_cpu_workers(device_names):
+    return len(device_names) > 0 and all(name.startswith(CPU_WORKER_PREFIX) for name in device_names)
+
+def squared_norms(X):
+    return np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+
+def squared_distances(X, X_sqr_norm, centroids):
+    # Same ||x||^2 - 2 x.c + ||c||^2 form as the tensorflow graph
+    sqr_distances = X_sqr_norm - 2 * np.dot(X, centroids.T) + np.einsum('ij,ij->i', centroids, centroids)
+    return np.maximum(sqr_distances, 0, out = sqr_distances)
+
+def cluster_statistics(X, labels, K, weights = None):
+    # One bincount per dimension, linear in N x M like the segment sums
+    sums = np.empty((K, X.shape[1]), dtype = ACCUMULATOR_DTYPE)
+    for j in range(X.shape[1]):
+        sums[:, j] = np.bincount(labels, weights = X[:, j] if weights is None else X[:, j] * weights, minlength = K)
+    counts = np.bincount(labels, weights = weights, minlength = K).astype(ACCUMULATOR_DTYPE)
+    return (sums, counts)
+
+def k_means_statistics(X, X_sqr_norm, centroids, K, timeline = NULL_TIMELINE, weights = None):
+    with timeline.span('distance'):
+        sum_squares = squared_distances(X, X_sqr_norm, centroids)
+    with timeline.span('assignment'):
+        best_centroids = np.argmin(sum_squares, axis = 1)
+        min_sum_squares = sum_squares[np.arange(len(X)), best_centroids]
+        if weights is None:
+            inertia = min_sum_squares.sum(dtype = ACCUMULATOR_DTYPE)
+        else:
+            inertia = np.dot(min_sum_squares.astype(ACCUMULATOR_DTYPE), weights)
+
+    with timeline.span('local_reduction'):
+        (sums, counts) = cluster_statistics(X, best_centroids, K, weights)
+
+    return (sums, counts, inertia, best_centroids)
+
+def fuzzy_memberships(sqr_distances, fuzzifier):
+    # Same stable ratios as the tensorflow graph, all in (0, 1]
+    tiny = np.finfo(sqr_distances.dtype).tiny
+    min_sqr_distances = sqr_distances.min(axis = 1, keepdims = True)
+
+    weights = np.power((min_sqr_distances + tiny) / (sqr_distances + tiny), 1.0 / (fuzzifier - 1.0))
+    return weights / weights.sum(axis = 1, keepdims = True)
+
+def fuzzy_C_means_statistics(X, X_sqr_norm, centroids, K, fuzzifier, timeline = NULL_TIMELINE, weights = None):
+    # Reduced block by block, only block x K memberships are alive
+    Mu_X_sum = np.zeros((K, X.shape[1]), dtype = ACCUMULATOR_DTYPE)
+    Mu_sum = np.zeros(K, dtype = ACCUMULATOR_DTYPE)
+    inertia = 0.0
+
+    block_rows = fuzzy_block_rows(K)
+    for start in range(0, len(X), block_rows):
+        X_block = X[start:start + block_rows]
+        with timeline.span('distance'):
+            sum_squares = squared_distances(X_block, X_sqr_norm[start:start + block_rows], centroids)
+        with timeline.span('assignment'):
+            MU = np.power(fuzzy_memberships(sum_squares, fuzzifier), fuzzifier)
+            if weights is not None:
+                MU *= weights[start:start + block_rows, np.newaxis]
+
+        with timeline.span('local_reduction'):
+            Mu_X_sum += np.dot(MU.T, X_block)
+            Mu_sum += MU.sum(axis = 0, dtype = ACCUMULATOR_DTYPE)
+            inertia += np.sum(MU * sum_squares, dtype = ACCUMULATOR_DTYPE)
+
+    return (Mu_X_sum, Mu_sum, inertia, None)
+
+def stacked_statistics(X, X_sqr_norm, centroids, Ks, fuzzifier = None, timeline = NULL_TIMELINE):
+    ####
+    # Statistics of the models of several K on the shard, the centers of 
+    # all the models stacked in centroids, same blocks as the tensorflow 
+    # graph : one distance matmul and one sums matmul per block for all the
+    # models. The assignments are kept as sum(Ks) x block, so the rows of
+    # each model are contiguous, and the inertia is per center
+    ####
+    K = sum(Ks)
+    offsets = np.cumsum([0] + list(Ks))
+    sums = np.zeros((K, X.shape[1]), dtype = ACCUMULATOR_DTYPE)
+    counts = np.zeros(K, dtype = ACCUMULATOR_DTYPE)
+    inertia = np.zeros(K, dtype = ACCUMULATOR_DTYPE)
+
+    # Hard assignments are summed in ACCUMULATOR_DTYPE, as by cluster_statistics
+    sums_dtype = ACCUMULATOR_DTYPE if fuzzifier is None else X.dtype
+
+    block_rows = fuzzy_block_rows(K)
+    for start in range(0, len(X), block_rows):
+        X_block = X[start:start + block_rows]
+        with timeline.span('distance'):
+            sum_squares = squared_distances(X_block, X_sqr_norm[start:start + block_rows], centroids)
+        with timeline.span('assignment'):
+            if fuzzifier is None:
+                # A point is assigned to the centers at its minimum distance,
+                # the rare ties go to the first one, as with argmin
+                sum_squares = np.ascontiguousarray(sum_squares.T)
+                A = np.empty(sum_squares.shape, dtype = sums_dtype)
+                for j in range(len(Ks)):
+                    model_squares = sum_squares[offsets[j]:offsets[j + 1]]
+                    np.equal(model_squares, model_squares.min(axis = 0), out = A[offsets[j]:offsets[j + 1]])
+                for row in np.flatnonzero(A.sum(axis = 0) != len(Ks)):
+                    for j in range(len(Ks)):
+                        A[offsets[j]:offsets[j + 1], row] = 0
+                        A[offsets[j] + np.argmin(sum_squares[offsets[j]:offsets[j + 1], row]), row] = 1
+            else:
+                A = np.empty(sum_squares.shape, dtype = sums_dtype)
+                for j in range(len(Ks)):
+                    model_squares = sum_squares[:, offsets[j]:offsets[j + 1]]
+                    A[:, offsets[j]:offsets[j + 1]] = np.power(fuzzy_memberships(model_squares, fuzzifier), fuzzifier)
+                (A, sum_squares) = (A.T, sum_squares.T)
+
+        with timeline.span('local_reduction'):
+            sums += np.dot(A, X_block.astype(sums_dtype, copy = False))
+            counts += A.sum(axis = 1, dtype = ACCUMULATOR_DTYPE)
+            inertia += np.einsum('ij,ij->i', A, sum_squares, dtype = ACCUMULATOR_DTYPE)
+
+    return (sums, counts, inertia, None)
+
+def stacked_labels(X, X_sqr_norm, centroids, Ks):
+    # Closest center of each of the models of several K, N x number of models
+    offsets = np.cumsum([0] + list(Ks))
+    labels = np.empty((len(X), len(Ks)), dtype = np.int64)
+    block_rows = fuzzy_block_rows(len(centroids))
+    for start in range(0, len(X), block_rows):
+        stop = start + block_rows
+        sum_squares = squared_distances(X[start:stop], X_sqr_norm[start:stop], centroids)
+        for j in range(len(Ks)):
+            labels[start:stop, j] = np.argmin(sum_squares[:, offsets[j]:offsets[j + 1]], axis = 1)
+    return labels
+
+def nearest_centers(X, X_sqr_norm, centroids):
+    # Hard labels of every method, the closest center, computed in blocks
+    labels = np.empty(len(X), dtype = np.int64)
+    block_rows = fuzzy_block_rows(len(centroids))
+    for start in range(0, len(X), block_rows):
+        stop = start + block_rows
+        labels[start:stop] = np.argmin(squared_distances(X[start:stop], X_sqr_norm[start:stop], centroids), axis = 1)
+    return labels
+
+def label_statistics(X, X_sqr_norm, centroids, weights = None):
+    ####
+    # Points and inertia of each cluster of the hard labels, so that they
+    # can be reduced instead of gathering the label of every point
+    ####
+    K = len(centroids)
+    counts = np.zeros(K, dtype = ACCUMULATOR_DTYPE)
+    inertia = np.zeros(K, dtype = ACCUMULATOR_DTYPE)
+    block_rows = fuzzy_block_rows(K)
+    for start in range(0, len(X), block_rows):
+        stop = start + block_rows
+        sqr_dist = squared_distances(X[start:stop], X_sqr_norm[start:stop], centroids)
+        labels = np.argmin(sqr_dist, axis = 1)
+        min_sqr_dist = np.maximum(sqr_dist[np.arange(len(labels)), labels], 0)
+
+        block_weights = None if weights is None else weights[start:stop]
+        if block_weights is not None:
+            min_sqr_dist = min_sqr_dist * block_weights
+        counts += np.bincount(labels, weights = block_weights, minlength = K)
+        inertia += np.bincount(labels, weights = min_sqr_dist, minlength = K)
+    return (counts, inertia)
+
+# The Hamerly bounds are an engine of the tensorflow graph, on the CPU
+# workers the method runs plain k-means iterations. The full passes of
+# mini-batch k-means are k-means passes, its steps the 'mini_batch' command
+STATISTICS_FUNCS = {    'distributedKMeans'          : k_means_statistics       ,
+                        'distributedFuzzyCMeans'     : fuzzy_C_means_statistics ,
+                        'distributedHamerlyKMeans'   : k_means_statistics       ,
+                        'distributedMiniBatchKMeans' : k_means_statistics        }
+
+def centers_from_statistics(sums, counts, old_centers):
+    # Clusters with no points keep their previous center
+    new_centers = old_centers.copy()
+    non_empty = counts > 0
+    new_centers[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+    return new_centers
+
+class Shard(object):
+    ####
+    # Rows of the shared batch owned by one worker, with their ||x||^2,
+    # the k-means|| distances to the closest candidate and the weights of
+    # the rows, None unless a weighted batch (a coreset) is clustered
+    ####
+    def __init__(self):
+        self.memory = None
+        self.X = None
+        self.weights = None
+
+    def attach(self, memory_name, shape, dtype, start, stop):
+        if self.memory is None or self.memory.name != memory_name:
+            self.detach()
+            self.memory = shared_memory.SharedMemory(name = memory_name)
+            # The block belongs to the parent, it must not be unlinked when 
+            # this worker exits
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+
+        batch = np.ndarray(shape, dtype = dtype, buffer = self.memory.buf)
+        self.X = batch[start:stop]
+        self.X_sqr_norm = squared_norms(self.X)
+        self.min_sqr_dist = np.full(len(self.X), np.inf, dtype = self.X.dtype)
+        self.weights = None
+
+    def weighted(self, values):
+        return values if self.weights is None else values * self.weights
+
+    def detach(self):
+        self.X = None
+        if self.memory is not None:
+            self.memory.close()
+            self.memory = None
+
+def worker_loop(worker_num, method_name, connection):
+    statistics_func = STATISTICS_FUNCS[method_name]
+    shard = Shard()
+
+    while True:
+        (command, args) = connection.recv()
+        if command == 'close':
+            shard.detach()
+            connection.close()
+            return
+
+        try:
+            if command == 'attach':
+                shard.attach(*args)
+                reply = None
+
+            elif command == 'weights':
+                # Weights of the rows of the shard, until the next attach
+                (weights, ) = args
+                shard.weights = np.asarray(weights, dtype = ACCUMULATOR_DTYPE)
+                reply = None
+
+            elif command == 'statistics':
+                # Timed workers send the spans of their phases with the statistics
+                (centroids, K, method_params, timed) = args
+                timeline = Timeline() if timed else NULL_TIMELINE
+                (sums, counts, inertia, _) = statistics_func(shard.X, shard.X_sqr_norm, centroids, K, 
+                                                             timeline = timeline, weights = shard.weights,
+                                                             **method_params)
+                reply = (sums, counts, inertia, list(timeline.events))
+
+            elif command == 'stacked_statistics':
+                # Statistics of the models of several K, see stacked_statistics
+                (centroids, Ks, method_params, timed) = args
+                timeline = Timeline() if timed else NULL_TIMELINE
+                (sums, counts, inertia, _) = stacked_statistics(shard.X, shard.X_sqr_norm, centroids, Ks,
+                                                                timeline = timeline, **method_params)
+                reply = (sums, counts, inertia, list(timeline.events))
+
+            elif command == 'stacked_labels':
+                (centroids, Ks) = args
+                reply = stacked_labels(shard.X, shard.X_sqr_norm, centroids, Ks)
+
+            elif command == 'mini_batch':
+                # k-means statistics of fraction of the rows of the shard, drawn
+                # with replacement from a stream per (seed, step, worker)
+                (centroids, K, fraction, seed_value, stream, timed) = args
+                timeline = Timeline() if timed else NULL_TIMELINE
+                rng = np.random.default_rng([seed_value, stream + worker_num])
+                rows = rng.integers(len(shard.X), size = max(1, int(round(fraction * len(shard.X)))))
+                (sums, counts, inertia, _) = k_means_statistics(shard.X[rows], shard.X_sqr_norm[rows], centroids, K,
+                                                                timeline = timeline)
+                reply = (sums, counts, inertia, list(timeline.events))
+
+            elif command == 'labels':
+                (centroids, ) = args
+                reply = nearest_centers(shard.X, shard.X_sqr_norm, centroids)
+
+            elif command == 'label_statistics':
+                (centroids, ) = args
+                reply = label_statistics(shard.X, shard.X_sqr_norm, centroids, shard.weights)
+
+            elif command == 'potential':
+                (candidates, reset) = args
+                if reset:
+                    shard.min_sqr_dist.fill(np.inf)
+                candidates_sqr_dist = squared_distances(shard.X, shard.X_sqr_norm, candidates)
+                np.minimum(shard.min_sqr_dist, candidates_sqr_dist.min(axis = 1), out = shard.min_sqr_dist)
+                reply = shard.weighted(shard.min_sqr_dist).sum(dtype = ACCUMULATOR_DTYPE)
+
+            elif command == 'sample':
+                # Stateless stream per (seed, round, worker), as in the graph
+                (factor, seed_value, stream) = args
+                rng = np.random.default_rng([seed_value, stream + worker_num])
+                keep = rng.uniform(size = len(shard.X)) < factor * shard.weighted(shard.min_sqr_dist)
+                reply = np.array(shard.X[keep])
+
+            elif command == 'predict':
+                # Labels rows start:stop of the dataset straight into the
+                # output file, the parent never touches the data
+                (data_file, start, stop, centroids, output_file, block_rows) = args
+                X = load_dataset(data_file)
+                labels = np.load(output_file, mmap_mode = 'r+')
+                centroids_sqr_norm = np.einsum('ij,ij->i', centroids, centroids)
+
+                for block_start in range(start, stop, block_rows):
+                    block_stop = min(block_start + block_rows, stop)
+                    X_block = np.asarray(X[block_start:block_stop], dtype = centroids.dtype)
+
+                    # ||x||^2 does not change the argmin, only x.c and ||c||^2 are needed
+                    cross_term = np.dot(X_block, centroids.T)
+                    labels[block_start:block_stop] = np.argmin(centroids_sqr_norm - 2 * cross_term, axis = 1)
+
+                labels.flush()
+                del labels
+                reply = stop - start
+
+            elif command == 'coreset':
+                # Weighted coreset of rows start:stop of the dataset, read from
+                # the file block by block like 'predict', see coreset.py
+                (data_file, start, stop, n_samples, seed_value) = args
+                reply = shard_coreset(load_dataset(data_file), start, stop, n_samples, seed_value)
+
+            elif command == 'inertia':
+                # Objective of the method on rows start:stop of the dataset
+                (data_file, start, stop, centroids, method_params) = args
+                X = load_dataset(data_file)
+                block_rows = fuzzy_block_rows(len(centroids))
+
+                reply = 0.0
+                for block_start in range(start, stop, block_rows):
+                    X_block = np.asarray(X[block_start:min(block_start + block_rows, stop)], dtype = centroids.dtype)
+                    reply += statistics_func(X_block, squared_norms(X_block), centroids, len(centroids),
+                                             **method_params)[2]
+
+            elif command == 'counts':
+                (candidates, ) = args
+                candidates_sqr_dist = squared_distances(shard.X, shard.X_sqr_norm, candidates)
+                reply = np.bincount(np.argmin(candidates_sqr_dist, axis = 1), weights = shard.weights,
+                                    minlength = len(candidates))
+
+            else:
+                raise ValueError("Unknown worker command " + command)
+
+            connection.send(('ok', reply))
+        except Exception as e:
+            traceback.print_exc()
+            connection.send(('error', e))
+
+class WorkerPool(object):
+    ####
+    # Worker processes and the shared memory holding the current batch
+    # Workers are plain python processes running this file, started with
+    # single threaded BLAS so that N workers use N cores, and connected back
+    # through a local socket. They keep running between fits, like the 
+    # tensorflow sessions
+    ####
+    def __init__(self, n_workers, method_name):
+        authkey = os.urandom(16)
+        listener = Listener(authkey = authkey)
+
+        env = dict(os.environ)
+        env.update(dict((var, '1') for var in THREAD_ENV_VARS))
+        env['CPU_WORKER_AUTHKEY'] = authkey.hex()
+
+        self.processes = []
+        for worker_num in range(n_workers):
+            command = [ sys.executable, os.path.abspath(__file__),
+                        '--worker_num', str(worker_num),
+                        '--method_name', method_name,
+                        '--address', listener.address ]
+            self.processes.append( subprocess.Popen(command, env = env) )
+
+        # Workers connect in any order, each one first sends its number
+        self.connections = [None] * n_workers
+        for _ in range(n_workers):
+            connection = listener.accept()
+            self.connections[connection.recv()] = connection
+        listener.close()
+
+        self.memory = None
+        self.closed = False
+        atexit.register(self.close)
+
+    def run(self, command, per_worker_args):
+        # Sends one command to every worker and waits for all the replies
+        for (connection, args) in zip(self.connections, per_worker_args):
+            connection.send((command, args))
+
+        replies = [connection.recv() for connection in self.connections]
+        for (status, reply) in replies:
+            if status == 'error':
+                raise reply
+        return [reply for (_, reply) in replies]
+
+    def broadcast(self, command, *args):
+        return self.run(command, [args] * len(self.connections))
+
+    def scatter(self, batch, dtype = None):
+        ####
+        # Copies the batch to shared memory and gives each worker its shard
+        # The batch is converted to dtype during the copy, and the block is
+        # only reallocated when a bigger batch comes in
+        ####
+        dtype = np.dtype(batch.dtype if dtype is None else dtype)
+        nbytes = max(int(np.prod(batch.shape)) * dtype.itemsize, 1)
+
+        old_memory = None
+        if self.memory is None or self.memory.size < nbytes:
+            old_memory = self.memory
+            self.memory = shared_memory.SharedMemory(create = True, size = nbytes)
+
+        np.ndarray(batch.shape, dtype = dtype, buffer = self.memory.buf)[:] = batch
+
+        bounds = np.cumsum([0] + [len(shard) for shard in np.array_split(batch, len(self.connections))])
+        self.run('attach', [ (self.memory.name, batch.shape, dtype.str, bounds[i], bounds[i + 1])
+                             for i in range(len(self.connections)) ])
+
+        # Workers moved to the new block, the old one can be freed
+        if old_memory is not None:
+            old_memory.close()
+            old_memory.unlink()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        for (connection, process) in zip(self.connections, self.processes):
+            try:
+                connection.send(('close', None))
+            except (IOError, OSError):
+                pass
+            try:
+                process.wait(timeout = 5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            connection.close()
+
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'CPU Worker of the Distribuited Clustering.')
+
+    parser.add_argument("--worker_num"                            ,
+                        dest     = "worker_num"                   ,
+                        required = True                           ,
+                        metavar  = "int"                          ,
+                        type     = int                            ,
+                        help     = "Number of the Shard !!!"       )
+
+    parser.add_argument("--method_name"                           ,
+                        dest     = "method_name"                  ,
+                        required = True                           ,
+                        metavar  = "str"                          ,
+                        help     = "Clustering Method !!!"         )
+
+    parser.add_argument("--address"                               ,
+                        dest     = "address"                      ,
+                        required = True                           ,
+                        metavar  = "str"                          ,
+                        help     = "Address of the Parent !!!"     )
+
+    args = parser.parse_args()
+
+    connection = Client(args.address, authkey = bytes.fromhex(os.environ['CPU_WORKER_AUTHKEY']))
+    connection.send(args.worker_num)
+
+    worker_loop(worker_num  = args.worker_num ,
+                method_name = args.method_name,
+                connection  = connection      )
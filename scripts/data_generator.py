@@ -0,0 +1,252 @@
+import argparse
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from dataset_io import create_dataset, open_dataset, load_dataset
+
+####
+# Synthetic datasets made chunk by chunk, in parallel and straight to disk
+# Chunk i holds rows [i * GENERATOR_CHUNK_ROWS, (i + 1) * GENERATOR_CHUNK_ROWS)
+# and is drawn from its own random stream, spawned from the seed with the
+# key (i, ), so any chunk can be made by any process in any order and a
+# dataset is the prefix of every bigger dataset with the same parameters
+# The parameters shared by all chunks (the centers of the clusters) are
+# drawn from the seed itself
+# Kinds of data :
+# => blobs          : isotropic gaussian clusters, like make_blobs
+# => classification : gaussian clusters with a random covariance centered
+#                     on vertices of an hypercube, like make_classification
+#                     with one cluster per class
+# Each process only holds the chunk it is making, the memory needed does
+# not depend on the number of rows
+####
+GENERATOR_CHUNK_ROWS = 1 << 20
+
+KINDS = ['blobs', 'classification']
+
+# make_blobs center_box and make_classification class_sep
+BLOBS_CENTER_BOX = 10.0
+CLASS_SEP = 1.0
+
+def make_centers(kind, n_dim, n_centers, seed):
+    ####
+    # Centers of the clusters, and for classification the matrix mixing the
+    # dimensions of each cluster
+    ####
+    rng = np.random.default_rng(np.random.SeedSequence(seed))
+
+    if kind == 'blobs':
+        centers = rng.uniform(-BLOBS_CENTER_BOX, BLOBS_CENTER_BOX, size = (n_centers, n_dim))
+        return (centers, None)
+
+    if 2 ** min(n_dim, 62) < n_centers:
+        raise ValueError("An hypercube of " + str(n_dim) + " dimensions has less than " +
+                         str(n_centers) + " vertices")
+
+    # Distinct vertices of the hypercube
+    vertices = np.unique(rng.choice([-1.0, 1.0], size = (n_centers, n_dim)), axis = 0)
+    while len(vertices) < n_centers:
+        new_vertices = rng.choice([-1.0, 1.0], size = (n_centers - len(vertices), n_dim))
+        vertices = np.unique(np.concatenate([vertices, new_vertices]), axis = 0)
+
+    centers = CLASS_SEP * rng.permutation(vertices)
+    mixing = rng.uniform(-1.0, 1.0, size = (n_centers, n_dim, n_dim))
+    return (centers, mixing)
+
+def make_chunk(kind, centers, mixing, seed, chunk_index, n_rows):
+    # The first n_rows of chunk chunk_index, the chunk is always drawn whole
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key = (chunk_index, )))
+    (n_centers, n_dim) = centers.shape
+
+    labels = rng.integers(n_centers, size = GENERATOR_CHUNK_ROWS)
+    X = rng.standard_normal(size = (GENERATOR_CHUNK_ROWS, n_dim))
+
+    if kind == 'classification':
+        for k in range(n_centers):
+            members = labels == k
+            X[members] = np.dot(X[members], mixing[k])
+    X += centers[labels]
+
+    return (X[0:n_rows], labels[0:n_rows])
+
+def write_chunk(data_file, labels_file, kind, centers, mixing, seed, chunk_index):
+    X = open_dataset(data_file)
+    labels = np.load(labels_file, mmap_mode = 'r+')
+
+    start = chunk_index * GENERATOR_CHUNK_ROWS
+    stop = min(start + GENERATOR_CHUNK_ROWS, len(X))
+    (X[start:stop], labels[start:stop]) = make_chunk(kind, centers, mixing, seed, chunk_index, stop - start)
+
+    X.flush()
+    labels.flush()
+    return stop - start
+
+def labels_file_of(data_file):
+    return os.path.splitext(data_file)[0] + '-Y.npy'
+
+def generate_dataset(data_file, kind, n_obs, n_dim, n_centers, seed, dtype = 'float64',
+                     n_processes = None, prefix_file = None):
+    ####
+    # Writes n_obs rows to data_file, a .npy or .bin file, and their labels
+    # to the -Y.npy file next to it. The whole chunks of prefix_file, a
+    # smaller dataset with the same parameters, are copied instead of made
+    ####
+    if kind not in KINDS:
+        raise ValueError("Kind Must Be One of " + ', '.join(KINDS))
+
+    labels_file = labels_file_of(data_file)
+    (centers, mixing) = make_centers(kind, n_dim, n_centers, seed)
+
+    X = create_dataset(data_file, (n_obs, n_dim), dtype)
+    labels = np.lib.format.open_memmap(labels_file, mode = 'w+', dtype = np.min_scalar_type(n_centers - 1),
+                                       shape = (n_obs, ))
+
+    first_chunk = 0
+    if prefix_file is not None:
+        prefix_X = load_dataset(prefix_file)
+        prefix_labels = np.load(labels_file_of(prefix_file), mmap_mode = 'r')
+        first_chunk = min(len(prefix_X), n_obs) // GENERATOR_CHUNK_ROWS
+
+        for start in range(0, first_chunk * GENERATOR_CHUNK_ROWS, GENERATOR_CHUNK_ROWS):
+            X[start:start + GENERATOR_CHUNK_ROWS] = prefix_X[start:start + GENERATOR_CHUNK_ROWS]
+            labels[start:start + GENERATOR_CHUNK_ROWS] = prefix_labels[start:start + GENERATOR_CHUNK_ROWS]
+
+    # The headers must be on disk before the processes open the files
+    X.flush()
+    labels.flush()
+    del X, labels
+
+    n_chunks = -(-n_obs // GENERATOR_CHUNK_ROWS)
+    chunks = range(first_chunk, n_chunks)
+
+    # Spawned processes only import this module, not the caller's modules
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(n_processes or os.cpu_count(), mp_context = context) as executor:
+        futures = [ executor.submit(write_chunk, data_file, labels_file, kind, centers, mixing, seed, chunk_index)
+                    for chunk_index in chunks ]
+        for future in futures:
+            future.result()
+
+    return (data_file, labels_file)
+
+def cached_dataset(cache_dir, kind, n_obs, n_dim, n_centers, seed, dtype = 'float64', n_processes = None):
+    ####
+    # Dataset of at least n_obs rows with the given parameters, made once
+    # and kept in cache_dir. A cached dataset with fewer rows is extended,
+    # so a dataset is stored once whatever the number of rows asked, load
+    # the first n_obs rows with dataset_io.load_dataset(data_file, n_obs)
+    ####
+    key = '-'.join([ kind, 'd' + str(n_dim), 'c' + str(n_centers), 's' + str(seed),
+                     np.dtype(dtype).name, 'r' + str(GENERATOR_CHUNK_ROWS) ])
+    data_file = os.path.join(cache_dir, key + '.npy')
+
+    cached_rows = 0
+    if os.path.exists(data_file) and os.path.exists(labels_file_of(data_file)):
+        cached_rows = len(load_dataset(data_file))
+    if cached_rows >= n_obs:
+        return (data_file, labels_file_of(data_file))
+
+    os.makedirs(cache_dir, exist_ok = True)
+
+    # Made under another name, an interrupted run does not leave a partial dataset
+    partial_file = os.path.join(cache_dir, key + '-partial.npy')
+    start_time = time.time()
+    generate_dataset(data_file   = partial_file                            ,
+                     kind        = kind                                    ,
+                     n_obs       = n_obs                                   ,
+                     n_dim       = n_dim                                   ,
+                     n_centers   = n_centers                               ,
+                     seed        = seed                                    ,
+                     dtype       = dtype                                   ,
+                     n_processes = n_processes                             ,
+                     prefix_file = data_file if cached_rows > 0 else None  )
+
+    os.replace(labels_file_of(partial_file), labels_file_of(data_file))
+    os.replace(partial_file, data_file)
+    print('made', n_obs, 'rows of', data_file, 'in', '%.1f' % (time.time() - start_time), 's')
+
+    return (data_file, labels_file_of(data_file))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Makes a Synthetic Dataset Chunk by Chunk.')
+
+    parser.add_argument("--cache_dir"                                                 ,
+                        dest     = "cache_dir"                                        ,
+                        required = True                                               ,
+                        metavar  = "DIR"                                              ,
+                        help     = "Directory of the cached datasets !!!" )
+
+    parser.add_argument("--kind"                                                      ,
+                        dest     = "kind"                                             ,
+                        required = False                                              ,
+                        default  = 'classification'                                   ,
+                        metavar  = "str"                                              ,
+                        choices  = KINDS                                              ,
+                        help     = "blobs or classification !!!" )
+
+    parser.add_argument("--n_obs"                                                     ,
+                        dest     = "n_obs"                                            ,
+                        required = True                                               ,
+                        metavar  = "int"                                              ,
+                        type     = int                                                ,
+                        help     = "Number of Observations !!!" )
+
+    parser.add_argument("--n_dim"                                                     ,
+                        dest     = "n_dim"                                            ,
+                        required = True                                               ,
+                        metavar  = "int"                                              ,
+                        type     = int                                                ,
+                        help     = "Number of Dimensions !!!" )
+
+    parser.add_argument("--n_centers"                                                 ,
+                        dest     = "n_centers"                                        ,
+                        required = True                                               ,
+                        metavar  = "int"                                              ,
+                        type     = int                                                ,
+                        help     = "Number of clusters, or classes !!!" )
+
+    parser.add_argument("--seed"                                                      ,
+                        dest     = "seed"                                             ,
+                        required = True                                               ,
+                        metavar  = "int"                                              ,
+                        type     = int                                                ,
+                        help     = "Seed Value !!!" )
+
+    parser.add_argument("--dtype"                                                     ,
+                        dest     = "dtype"                                            ,
+                        required = False                                              ,
+                        default  = 'float64'                                          ,
+                        metavar  = "str"                                              ,
+                        choices  = ['float32', 'float64']                             ,
+                        help     = "Precision of the data !!!" )
+
+    parser.add_argument("--n_processes"                                               ,
+                        dest     = "n_processes"                                      ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "int"                                              ,
+                        type     = int                                                ,
+                        help     = "Number of processes, all the cores by default !!!" )
+
+    args = parser.parse_args()
+
+    if min(args.n_obs, args.n_dim, args.n_centers) <= 0:
+        parser.error("Number of Observations, Dimensions and Centers Must Be Positive")
+    if args.n_processes is not None and args.n_processes <= 0:
+        parser.error("Number of Processes Given is Non Positive")
+
+    (data_file, labels_file) = cached_dataset(cache_dir   = args.cache_dir   ,
+                                              kind        = args.kind        ,
+                                              n_obs       = args.n_obs       ,
+                                              n_dim       = args.n_dim       ,
+                                              n_centers   = args.n_centers   ,
+                                              seed        = args.seed        ,
+                                              dtype       = args.dtype       ,
+                                              n_processes = args.n_processes )
+    print('data_file =', data_file)
+    print('labels_file =', labels_file)
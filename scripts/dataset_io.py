@@ -0,0 +1,174 @@
+import argparse
+import os
+import zipfile
+
+import numpy as np
+
+####
+# Storage formats accepted for --data_file :
+# => .npy : uncompressed numpy array, memory-mapped with np.load
+# => .bin : raw row-major binary preceded by a small header (RAW_HEADER_SIZE
+#           bytes) holding a magic string, the dtype and the shape
+# => .npz : legacy format, it can not be memory-mapped so X is loaded whole
+# Memory-mapped datasets are only read from disk when a batch or shard
+# is actually used, so the host memory needed scales with the batch size
+# CPU workers reading their own rows are given the path of worker_dataset,
+# a .npz is converted once for all of them instead of loaded by each one
+####
+RAW_MAGIC = b'TFDCRAW1'
+RAW_HEADER_SIZE = 64
+RAW_DTYPE_SIZE = 16
+
+CONVERSION_CHUNK_ROWS = 1 << 20
+
+def write_raw_header(f, shape, dtype):
+    dtype_str = np.dtype(dtype).str.encode('ascii').ljust(RAW_DTYPE_SIZE, b'\0')
+    header = RAW_MAGIC + dtype_str + np.array(shape, dtype = '<u8').tobytes()
+    f.write(header.ljust(RAW_HEADER_SIZE, b'\0'))
+
+def read_raw_header(f):
+    header = f.read(RAW_HEADER_SIZE)
+    if len(header) != RAW_HEADER_SIZE or header[0:len(RAW_MAGIC)] != RAW_MAGIC:
+        raise ValueError("Not a raw dataset file")
+
+    dtype_start = len(RAW_MAGIC)
+    shape_start = dtype_start + RAW_DTYPE_SIZE
+
+    dtype = np.dtype(header[dtype_start:shape_start].rstrip(b'\0').decode('ascii'))
+    shape = tuple(int(x) for x in np.frombuffer(header[shape_start:shape_start + 16], dtype = '<u8'))
+    return (shape, dtype)
+
+def load_dataset(data_file, n_obs = None):
+    extension = os.path.splitext(data_file)[1]
+
+    if extension == '.npy':
+        X = np.load(data_file, mmap_mode = 'r')
+
+    elif extension == '.bin':
+        with open(data_file, 'rb') as f:
+            (shape, dtype) = read_raw_header(f)
+        X = np.memmap(data_file, dtype = dtype, mode = 'r', offset = RAW_HEADER_SIZE, shape = shape)
+
+    elif extension == '.npz':
+        print('Warning: ' + data_file + ' is a .npz file and will be loaded whole in memory,',
+              'convert it with dataset_io.py to memory-map it')
+        with np.load(data_file) as data:
+            X = data['X']
+
+    else:
+        raise ValueError("Unknown dataset format " + extension)
+
+    if X.ndim != 2:
+        raise ValueError("Dataset must be a 2 dimensional matrix")
+
+    # Smaller datasets can be prefixes of bigger ones
+    if n_obs is not None:
+        X = X[0:n_obs]
+
+    return X
+
+def create_dataset(data_file, shape, dtype):
+    ####
+    # Creates a writable memory-mapped dataset of the given shape, so that
+    # it can be filled chunk by chunk without ever being whole in memory
+    ####
+    extension = os.path.splitext(data_file)[1]
+
+    if extension == '.npy':
+        return np.lib.format.open_memmap(data_file, mode = 'w+', dtype = dtype, shape = tuple(shape))
+
+    if extension == '.bin':
+        with open(data_file, 'wb') as f:
+            write_raw_header(f, shape, dtype)
+            f.truncate(RAW_HEADER_SIZE + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        return np.memmap(data_file, dtype = dtype, mode = 'r+', offset = RAW_HEADER_SIZE, shape = tuple(shape))
+
+    raise ValueError("Memory-mapped datasets must be .npy or .bin files")
+
+def open_dataset(data_file):
+    # Writable memory map of an existing .npy or .bin dataset
+    extension = os.path.splitext(data_file)[1]
+
+    if extension == '.npy':
+        return np.load(data_file, mmap_mode = 'r+')
+
+    if extension == '.bin':
+        with open(data_file, 'rb') as f:
+            (shape, dtype) = read_raw_header(f)
+        return np.memmap(data_file, dtype = dtype, mode = 'r+', offset = RAW_HEADER_SIZE, shape = shape)
+
+    raise ValueError("Memory-mapped datasets must be .npy or .bin files")
+
+def save_dataset(data_file, X):
+    out = create_dataset(data_file, X.shape, X.dtype)
+    for start in range(0, len(X), CONVERSION_CHUNK_ROWS):
+        out[start:start + CONVERSION_CHUNK_ROWS] = X[start:start + CONVERSION_CHUNK_ROWS]
+    out.flush()
+    del out
+
+def convert_npz(npz_file, data_file, key = 'X'):
+    ####
+    # Streams the array `key` of a .npz file into a memory-mappable file
+    # The zip member is read in chunks, the array is never whole in memory
+    ####
+    with zipfile.ZipFile(npz_file) as archive:
+        with archive.open(key + '.npy') as member:
+            version = np.lib.format.read_magic(member)
+            if version == (1, 0):
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_1_0(member)
+            else:
+                (shape, fortran_order, dtype) = np.lib.format.read_array_header_2_0(member)
+
+            if fortran_order:
+                raise ValueError("Fortran ordered arrays can not be streamed")
+
+            out = create_dataset(data_file, shape, dtype)
+            row_size = int(np.prod(shape[1:])) * dtype.itemsize
+
+            for start in range(0, shape[0], CONVERSION_CHUNK_ROWS):
+                stop = min(start + CONVERSION_CHUNK_ROWS, shape[0])
+                chunk = member.read((stop - start) * row_size)
+                out[start:stop] = np.frombuffer(chunk, dtype = dtype).reshape((stop - start,) + tuple(shape[1:]))
+
+            out.flush()
+            del out
+
+    return data_file
+
+def worker_dataset(data_file):
+    ####
+    # Path of data_file for the CPU workers that each memory-map their own
+    # rows. A .npz is converted to data_file.npy, next to it, and the
+    # conversion is reused as long as it is newer than the .npz
+    ####
+    if os.path.splitext(data_file)[1] != '.npz':
+        return data_file
+
+    npy_file = data_file + '.npy'
+    if not os.path.exists(npy_file) or os.path.getmtime(npy_file) < os.path.getmtime(data_file):
+        print('Converting', data_file, 'to', npy_file, 'for the workers to memory-map it')
+        # Written under another name first, an interrupted conversion is not reused
+        partial_file = data_file + '.partial.npy'
+        convert_npz(data_file, partial_file)
+        os.replace(partial_file, npy_file)
+    return npy_file
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Convert a .npz Dataset to a Memory-Mappable File.')
+
+    parser.add_argument("--npz_file"                                      ,
+                        dest     = "npz_file"                             ,
+                        required = True                                   ,
+                        metavar  = "FILE"                                 ,
+                        help     = "The .npz file with the X matrix !!!"   )
+
+    parser.add_argument("--data_file"                                                 ,
+                        dest     = "data_file"                                        ,
+                        required = True                                               ,
+                        metavar  = "FILE"                                             ,
+                        help     = "Output file, .npy or .bin (raw with header) !!!"   )
+
+    args = parser.parse_args()
+
+    convert_npz(npz_file  = args.npz_file ,
+                data_file = args.data_file)
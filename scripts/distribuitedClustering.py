@@ -1,5 +1,7 @@
 import argparse
 import os
+import queue
+import threading
 import time
 import traceback
 import sys
@@ -9,12 +11,58 @@ import numpy as np
 import tensorflow as tf
 from tensorflow.python.client import device_lib
 
-from sklearn.datasets import make_classification
+from dataset_io import load_dataset, worker_dataset
+from memory_planner import available_host_memory, plan_batches, format_plan, fuzzy_block_rows, PREFETCH_DEPTH
+from initializers import INIT_METHODS, initialize_centers, initialize_multi_K
+from clustering_model import load_model, empty_model, MODEL_EXTENSION
+from timeline import Timeline, NULL_TIMELINE, active_timeline, recording
+from ledger import Ledger, is_ledger
+from coreset import build_coreset, full_inertia
+import cpu_backend
+
+LOG_COLUMNS = [ 'method_name', 'seed', 'num_GPUs', 'K', 'n_obs', 'n_dim', 'setup_time', 
+                'initialization_time', 'computation_time', 'n_iter', 'num_batches', 
+                'batch_size', 'shard_size', 'estimated_peak_MB', 'init', 'init_time',
+                'skipped_fraction', 'backend', 'dtype', 'fuzzifier', 'mini_batch_size',
+                'full_pass_every', 'data_passes', 'coreset_size', 'coreset_time', 'full_inertia',
+                'coreset_error', 'shared_K', 'host_to_device_bytes', 'n_max_iters', 'tol', 'inertia_tol' ]
+
+# Precisions the shards and the distances can be computed in, the per 
+# cluster statistics are always accumulated in ACCUMULATOR_DTYPE
+DTYPES = ['float32', 'float64']
+ACCUMULATOR_DTYPE = tf.float64
+
+# Fuzzifier m of fuzzy C-means
+DEFAULT_FUZZIFIER = 2.0
+
+# Rows of each step of mini-batch k-means, over all the devices, and steps
+# between two full passes over the data
+DEFAULT_MINI_BATCH_SIZE = 1 << 14
+DEFAULT_FULL_PASS_EVERY = 100
+
+# Relative change of the exact inertia between two full passes below which
+# mini-batch k-means stops when no inertia_tol is given
+DEFAULT_MINI_BATCH_INERTIA_TOL = 1e-3
+
+# Plans tried before giving up when the estimate turns out to be too low
+MAX_PLAN_ATTEMPTS = 3
 
 def get_available_gpus():
     local_device_protos = device_lib.list_local_devices()
     return [x.name for x in local_device_protos if x.device_type == 'GPU']
 
+def get_device_budget(GPU_names):
+    ####
+    # Memory available to each device : the smallest memory_limit of the 
+    # GPUs used, or an equal share of the host memory when running on CPUs
+    ####
+    local_device_protos = device_lib.list_local_devices()
+    limits = [x.memory_limit for x in local_device_protos 
+              if x.device_type == 'GPU' and x.name in GPU_names]
+    if len(limits) == len(GPU_names):
+        return min(limits)
+    return available_host_memory() // len(GPU_names)
+
 def check_file_exists(parser, arg):
     try:
         data_file = str(arg)
@@ -28,13 +76,39 @@ def check_file_exists(parser, arg):
     return -2
 
 def is_valid_file(parser, arg):
-    if not os.path.exists(arg):
+    # Ledgers create their own tables, see ledger.py
+    if not os.path.exists(arg) and not is_ledger(arg):
         with open(arg, 'w') as f:
-            f.write(','.join(['method_name', 'seed', 'num_GPUs', 'K', 'n_obs',
-                        'n_dim', 'setup_time', 'initialization_time', 
-                        'computation_time', 'n_iter']) + '\n')
+            f.write(','.join(LOG_COLUMNS) + '\n')
     return str(arg)
 
+# Runs of sweep_runner.py on disjoint devices log from several threads
+_log_lock = threading.Lock()
+
+def append_to_log(log_file, data_to_append):
+    ####
+    # Logs created before some of the LOG_COLUMNS existed get their header 
+    # upgraded, the old rows are kept with the new columns left empty
+    ####
+    with _log_lock:
+        with open(log_file, 'r') as f:
+            lines = f.read().splitlines()
+        header = lines[0].split(',')
+
+        if header != LOG_COLUMNS:
+            if header != LOG_COLUMNS[0:len(header)]:
+                raise ValueError("Unknown columns in log file " + log_file)
+            padding = ',' * (len(LOG_COLUMNS) - len(header))
+            with open(log_file, 'w') as f:
+                f.write(','.join(LOG_COLUMNS) + '\n')
+                for line in lines[1:]:
+                    f.write(line + padding + '\n')
+
+        str_to_write = ','.join([ str( data_to_append[column] ) for column in LOG_COLUMNS ])
+
+        with open(log_file, 'a') as f:
+            f.write(str_to_write + '\n')
+
 def make_valid_int(parser, arg):
     try:
         ret = int(arg)
@@ -43,18 +117,80 @@ def make_valid_int(parser, arg):
         return -1    
     return ret
 
+def make_valid_float(parser, arg):
+    try:
+        ret = float(arg)
+    except ValueError:
+        parser.error("Invalid Float")
+        return -1    
+    if ret < 0:
+        parser.error("Tolerance Given is Negative")
+        return -2
+    return ret
+
 def make_valid_method(parser, arg):
     try:
         method_name = str(arg)
     except ValueError:
         parser.error("Invalid String")
         return -1 
-    if method_name in ['distributedKMeans', 'distributedFuzzyCMeans']:
+    if method_name in METHOD_NAMES:
         return method_name
     else :
         parser.error("Invalid Method Name")
     return -2
 
+def make_valid_fuzzifier(parser, arg):
+    try:
+        ret = float(arg)
+    except ValueError:
+        parser.error("Invalid Float")
+        return -1
+    if ret <= 1:
+        parser.error("Fuzzifier Must Be Greater Than 1")
+        return -2
+    return ret
+
+def make_valid_positive_int(parser, arg):
+    ret = make_valid_int(parser, arg)
+    if ret <= 0:
+        parser.error("Integer Given is Non Positive")
+        return -2
+    return ret
+
+def make_valid_K(parser, arg):
+    # One K, or several separated by commas to fit their models together
+    values = [make_valid_positive_int(parser, value) for value in str(arg).split(',')]
+    if len(values) == 1:
+        return values[0]
+    if len(set(values)) != len(values):
+        parser.error("Repeated K Values")
+        return -1
+    return values
+
+def make_valid_dtype(parser, arg):
+    dtype = str(arg)
+    if dtype in DTYPES:
+        return dtype
+    parser.error("Dtype Must Be One of " + ', '.join(DTYPES))
+    return -1
+
+def make_valid_init(parser, arg):
+    # One of INIT_METHODS or the file with the user supplied centers
+    init = str(arg)
+    if init in INIT_METHODS or os.path.exists(init):
+        return init
+    parser.error("Init Must Be One of " + ', '.join(INIT_METHODS) + " or an Existing File")
+    return -1
+
+def make_valid_model_file(parser, arg):
+    # Checked before the fit, a model saved to another file would fail after it
+    model_file = str(arg)
+    if os.path.splitext(model_file)[1] == MODEL_EXTENSION:
+        return model_file
+    parser.error("Models Are Saved as " + MODEL_EXTENSION + " Files")
+    return -1
+
 def parse_valid_gpus_names(parser, arg):
     num_GPUs = make_valid_int(parser = parser,
                               arg    = arg    )
@@ -63,346 +199,1874 @@ def parse_valid_gpus_names(parser, arg):
     if num_GPUs > available_num_GPUs:
         parser.error("Number of GPUs Given is More Then Available")
         return -1
-    if num_GPUs <= 0:
-        parser.error("Number of GPUs Given is Non Positive")
+    if num_GPUs < 0:
+        parser.error("Number of GPUs Given is Negative")
         return -2
     gpus_to_use = np.random.choice(gpu_names, size = num_GPUs, replace = False)
     return gpus_to_use
 
-def distribuited_fuzzy_C_means(data_batch, K, GPU_names, n_max_iters):
-    setup_ts = time.time()
-    number_of_gpus = len(GPU_names)
-    
-    sizes = [len(arg) for arg in np.array_split( data_batch, len(GPU_names))]
-    result_matrix = [[] for _ in GPU_names]
-    
-    partial_Mu_sum_list = []
-    partial_Mu_X_sum_list = []
-    
-    initial_centers = k_means_._init_centroids(data_batch, K, init='k-means++')
-    
-    tf.reset_default_graph()
-    with tf.name_scope('global'):
-        with tf.device('/cpu:0'):
-            all_data = tf.placeholder(data_batch.dtype, shape=(data_batch.shape), name='all_data')
-            
-            parts = tf.split(all_data, sizes, 0)
-
-            global_centroids = tf.Variable(initial_centers)
-            
-    for GPU_num in range(number_of_gpus):
-        GPU_name = GPU_names[GPU_num]
-        
-        (X_mat) = parts[GPU_num]
-        (N, M) = X_mat.get_shape().as_list()
-  
-        with tf.name_scope('scope_' + str(GPU_num)):
-            with tf.device(GPU_name) :
-                ####
-                # In the coments we denote :
-                # => N = Number of Observations
-                # => M = Number of Dimensions
-                # => K = Number of Centers
-                ####
-                # Data for GPU GPU_num to Clusterize
-                X = tf.Variable(X_mat)
-
-                # Reshapes rep_centroids and  rep_points to format N x K x M so that 
-                # the 2 matrixes have the same size
-                rep_centroids = tf.reshape(tf.tile(global_centroids, [N, 1]), [N, K, M])
-                rep_points = tf.reshape(tf.tile(X, [1, K]), [N, K, M])
-
-                # Calculates sum_squares, a matrix of size N x K
-                # This matrix is just(X-Y)^2
-                dist_to_centers = tf.sqrt( tf.reduce_sum(tf.square(tf.subtract( rep_points, rep_centroids) ), 
-                                                         reduction_indices = 2) )
-                
-                # Calculates cluster_membership, a matrix of size N x K
-                tmp = tf.pow(dist_to_centers, -2 / (M - 1))
-                cluster_membership_with_nan = tf.div( tf.transpose(tmp), tf.reduce_sum(tmp, 1))
-                
-                # Error treatment for when there are zeros in count_means_aux
-                cluster_membership = tf.where(
-                    tf.is_nan(cluster_membership_with_nan), tf.zeros_like(cluster_membership_with_nan), cluster_membership_with_nan);
-                result_matrix[GPU_num] = cluster_membership
-                
-                MU = tf.pow(cluster_membership, M)
-                
-                # Calculates auxiliar matrixes 
-                # Mu_X_sum of size 
-                Mu_X_sum = tf.matmul(MU, X)
-                Mu_sum = tf.reduce_sum(MU, 1)
-                
-                partial_Mu_sum_list.append( Mu_sum )
-                partial_Mu_X_sum_list.append( Mu_X_sum )
-                
-    with tf.name_scope('global') :
-        with tf.device('/cpu:0') :
-            result_matrix = tf.argmax(tf.transpose(tf.concat(result_matrix, 1)), axis = 1)
-            
-            global_Mu_sum = tf.add_n( partial_Mu_sum_list )
-            global_Mu_X_sum = tf.transpose(  tf.add_n(partial_Mu_X_sum_list) )
-            
-            new_centers = tf.transpose( tf.div(global_Mu_X_sum, global_Mu_sum) )
-            
-            update_centroid = tf.group( global_centroids.assign(new_centers) )
-        
-    setup_time = float( time.time() - setup_ts )
-    initialization_ts = time.time()
-    
+def squared_norms(X):
+    ####
+    # ||x||^2 of every row of X, a matrix of size N x 1
+    # For device resident shards it is kept in a Variable so that it is
+    # computed once, when the shard is initialized, and reused by 
+    # squared_distances on every iteration
+    ####
+    return tf.reduce_sum(tf.square(X), axis = 1, keepdims = True)
+
+def squared_distances(X, X_sqr_norm, centroids):
+    ####
+    # Calculates the N x K matrix of squared distances between the rows of 
+    # X (N x M) and the centroids (K x M) as ||x||^2 - 2 x.c + ||c||^2
+    # Only N x K values are ever stored, the N x K x M tensor of 
+    # differences is never built
+    ####
+    with tf.name_scope('distance'):
+        centroids_sqr_norm = tf.reduce_sum(tf.square(centroids), axis = 1)
+        cross_term = tf.matmul(X, centroids, transpose_b = True)
+
+        sqr_distances = X_sqr_norm - 2 * cross_term + centroids_sqr_norm
+
+        # Rounding errors can make distances of coincident points slightly negative
+        return tf.maximum(sqr_distances, 0)
+
+def cluster_statistics(X, labels, K, weights = None):
+    ####
+    # Sufficient statistics of the shard X for the k-means update :
+    # => sums   : K x M matrix with the sum of the points of each cluster
+    # => counts : K vector with the number of points of each cluster
+    # Both come from one segment sum, so the graph does not grow with K
+    # They are summed in ACCUMULATOR_DTYPE whatever the precision of X
+    # With weights the points count weights times, see coreset.py
+    ####
+    with tf.name_scope('local_reduction'):
+        labels = tf.to_int32(labels)
+        X = tf.cast(X, ACCUMULATOR_DTYPE)
+        if weights is None:
+            weights = tf.ones_like(X[:, 0])
+        else:
+            weights = tf.cast(weights, ACCUMULATOR_DTYPE)
+            X = X * tf.expand_dims(weights, 1)
+        sums = tf.unsorted_segment_sum(X, labels, K)
+        counts = tf.unsorted_segment_sum(weights, labels, K)
+        return (sums, counts)
+
+def centers_from_statistics(sums, counts, old_centers):
+    ####
+    # New centers are sums / counts, clusters that ended up with no points 
+    # keep their previous center instead of becoming NaN
+    # The division is done in the precision of the statistics and the 
+    # centers are returned in the precision of old_centers
+    ####
+    # counts are fuzzy membership sums for fuzzy C-means, they can be below 1
+    safe_counts = tf.where(counts > 0, counts, tf.ones_like(counts))
+    new_centers = tf.div(sums, tf.expand_dims(safe_counts, 1))
+    new_centers = tf.where(counts > 0, new_centers, tf.cast(old_centers, sums.dtype))
+    return tf.cast(new_centers, old_centers.dtype)
+
+def centers_shift(new_centers, old_centers):
+    # Total squared distance moved by the centers in one update
+    shift = tf.subtract(tf.cast(new_centers, ACCUMULATOR_DTYPE), tf.cast(old_centers, ACCUMULATOR_DTYPE))
+    return tf.reduce_sum(tf.square(shift))
+
+def has_converged(inertia_history, shift_history, tol, inertia_tol):
+    ####
+    # Stops when the centers moved less than tol, or when the relative 
+    # change of the inertia between two iterations is below inertia_tol
+    ####
+    if shift_history[-1] <= tol:
+        return True
+
+    if inertia_tol > 0 and len(inertia_history) > 1:
+        previous_inertia = inertia_history[-2]
+        return abs(previous_inertia - inertia_history[-1]) <= inertia_tol * abs(previous_inertia)
+
+    return False
+
+def k_means_statistics(X, X_sqr_norm, centroids, K, weights = None):
+    ####
+    # In the coments we denote :
+    # => N = Number of Observations
+    # => M = Number of Dimensions
+    # => K = Number of Centers
+    ####
+
+    # Calculates sum_squares, a matrix of size N x K
+    # This matrix is not sqrt((X-Y)^2), it is just(X-Y)^2
+    # Since we need just the argmin(sqrt((X-Y)^2)) wich is equal to 
+    # argmin((X-Y)^2), it would be a waste of computation
+    sum_squares = squared_distances(X, X_sqr_norm, centroids)
+
+    with tf.name_scope('assignment'):
+        # Use argmin to select the lowest-distance point
+        # This gets a matrix of size N x 1
+        best_centroids = tf.argmin(sum_squares, axis = 1)
+
+        # Inertia of the shard, the sum of the squared distances of each
+        # point to its closest center
+        min_sum_squares = tf.cast(tf.reduce_min(sum_squares, axis = 1), ACCUMULATOR_DTYPE)
+        if weights is not None:
+            min_sum_squares = min_sum_squares * tf.cast(weights, ACCUMULATOR_DTYPE)
+        inertia = tf.reduce_sum(min_sum_squares)
+
+    # Per cluster sums (K x M) and counts (K) of the shard,
+    # obtained in a single pass over X
+    (sums, counts) = cluster_statistics(X, best_centroids, K, weights)
+
+    return (sums, counts, inertia, best_centroids)
+
+def fuzzy_memberships(sqr_distances, fuzzifier):
+    ####
+    # Memberships u_ik = 1 / sum_j (d_ik^2 / d_ij^2)^(1/(m-1)) of a block
+    # Computed from the ratios (min_j d_ij^2 + tiny) / (d_ik^2 + tiny), which
+    # are all in (0, 1] and equal to 1 for the closest center, so the sum is
+    # at least 1 and a point lying on a center gets membership 1, no NaN
+    ####
+    with tf.name_scope('assignment'):
+        tiny = tf.constant(np.finfo(sqr_distances.dtype.as_numpy_dtype).tiny, dtype = sqr_distances.dtype)
+        min_sqr_distances = tf.reduce_min(sqr_distances, axis = 1, keepdims = True)
+
+        weights = tf.pow((min_sqr_distances + tiny) / (sqr_distances + tiny), 1.0 / (fuzzifier - 1.0))
+        return weights / tf.reduce_sum(weights, axis = 1, keepdims = True)
+
+def blocked_rows_loop(X, block_rows, body, initial_values):
+    ####
+    # Runs body(X_start, X_stop, *values) on consecutive blocks of block_rows
+    # rows of X, one block at a time, so only block_rows x K intermediates
+    # are alive whatever the number of rows of the shard
+    ####
+    N = tf.shape(X)[0]
+    n_blocks = (N + block_rows - 1) // block_rows
+
+    def loop_body(i, *values):
+        start = i * block_rows
+        return [i + 1] + list(body(start, tf.minimum(start + block_rows, N), *values))
+
+    results = tf.while_loop(lambda i, *values: i < n_blocks, loop_body, [tf.constant(0)] + initial_values,
+                            parallel_iterations = 1)
+    return results[1:]
+
+def fuzzy_C_means_statistics(X, X_sqr_norm, centroids, K, fuzzifier = DEFAULT_FUZZIFIER, weights = None):
+    ####
+    # In the coments we denote :
+    # => N = Number of Observations
+    # => M = Number of Dimensions
+    # => K = Number of Centers
+    # => m = Fuzzifier, m > 1, memberships are raised to the power m
+    # The shard is reduced block by block straight to Mu_X_sum (K x M) and
+    # Mu_sum (K), the N x K memberships are never built
+    ####
+    M = X.get_shape().as_list()[1]
+    block_rows = fuzzy_block_rows(K)
+
+    def block_statistics(start, stop, Mu_X_sum, Mu_sum, inertia):
+        X_block = X[start:stop]
+        sum_squares = squared_distances(X_block, X_sqr_norm[start:stop], centroids)
+
+        # Memberships of the block raised to the fuzzifier, block x K, a
+        # weighted point counts weights times
+        MU = tf.pow(fuzzy_memberships(sum_squares, fuzzifier), fuzzifier)
+        if weights is not None:
+            MU = MU * tf.expand_dims(weights[start:stop], 1)
+
+        with tf.name_scope('local_reduction'):
+            Mu_X_sum += tf.cast(tf.matmul(MU, X_block, transpose_a = True), ACCUMULATOR_DTYPE)
+            Mu_sum += tf.reduce_sum(tf.cast(MU, ACCUMULATOR_DTYPE), 0)
+
+            # Objective of the block, the membership weighted squared distances
+            inertia += tf.reduce_sum(tf.cast(tf.multiply(MU, sum_squares), ACCUMULATOR_DTYPE))
+
+        return (Mu_X_sum, Mu_sum, inertia)
+
+    (Mu_X_sum, Mu_sum, inertia) = blocked_rows_loop(X, block_rows, block_statistics, 
+                                                    [ tf.zeros([K, M], dtype = ACCUMULATOR_DTYPE),
+                                                      tf.zeros([K], dtype = ACCUMULATOR_DTYPE),
+                                                      tf.zeros([], dtype = ACCUMULATOR_DTYPE) ])
+
+    # Hard labels, the cluster with the highest membership which is the 
+    # closest one. They are only computed when they are fetched, at the end
+    def block_labels(start, stop, labels):
+        sum_squares = squared_distances(X[start:stop], X_sqr_norm[start:stop], centroids)
+        return (labels.write(labels.size(), tf.argmin(sum_squares, axis = 1)), )
+
+    (labels, ) = blocked_rows_loop(X, block_rows, block_labels, 
+                                   [ tf.TensorArray(tf.int64, size = 0, dynamic_size = True, 
+                                                    infer_shape = False) ])
+
+    return (Mu_X_sum, Mu_sum, inertia, labels.concat())
+
+def stacked_statistics(X, X_sqr_norm, centroids, Ks, fuzzifier = None):
+    ####
+    # Statistics of several models of one method on the same shard, the
+    # centers of the model j are the Ks[j] rows of centroids following the
+    # ones of the models before it. Each block of rows gets its distances to
+    # the centers of all the models from one matmul, then every model 
+    # reduces its slice of them : k-means with the segment sums of 
+    # k_means_statistics, fuzzy C-means with the memberships of all the
+    # models in one block x sum(Ks) matrix, summed with one more matmul
+    # The inertia is returned per center, the one of a model is the sum of
+    # its slice, and the labels are N x number of models
+    ####
+    M = X.get_shape().as_list()[1]
+    K = sum(Ks)
+    offsets = np.cumsum([0] + list(Ks))
+    block_rows = fuzzy_block_rows(K)
+
+    def block_statistics(start, stop, sums, counts, inertia):
+        X_block = X[start:stop]
+        sum_squares = squared_distances(X_block, X_sqr_norm[start:stop], centroids)
+
+        if fuzzifier is None:
+            block_sums = []
+            block_counts = []
+            block_inertia = []
+            for j in range(len(Ks)):
+                model_squares = sum_squares[:, offsets[j]:offsets[j + 1]]
+                with tf.name_scope('assignment'):
+                    best_centroids = tf.argmin(model_squares, axis = 1)
+                    min_sum_squares = tf.cast(tf.reduce_min(model_squares, axis = 1), ACCUMULATOR_DTYPE)
+
+                (model_sums, model_counts) = cluster_statistics(X_block, best_centroids, Ks[j])
+                block_sums.append( model_sums )
+                block_counts.append( model_counts )
+                block_inertia.append( tf.unsorted_segment_sum(min_sum_squares, tf.to_int32(best_centroids), Ks[j]) )
+
+            return (sums + tf.concat(block_sums, 0), counts + tf.concat(block_counts, 0), 
+                    inertia + tf.concat(block_inertia, 0))
+
+        # Memberships raised to the fuzzifier of all the models, block x sum(Ks)
+        MU = tf.concat([ tf.pow(fuzzy_memberships(sum_squares[:, offsets[j]:offsets[j + 1]], fuzzifier), fuzzifier)
+                         for j in range(len(Ks)) ], 1)
+
+        with tf.name_scope('local_reduction'):
+            sums += tf.cast(tf.matmul(MU, X_block, transpose_a = True), ACCUMULATOR_DTYPE)
+            counts += tf.reduce_sum(tf.cast(MU, ACCUMULATOR_DTYPE), 0)
+            inertia += tf.reduce_sum(tf.cast(tf.multiply(MU, sum_squares), ACCUMULATOR_DTYPE), 0)
+
+        return (sums, counts, inertia)
+
+    (sums, counts, inertia) = blocked_rows_loop(X, block_rows, block_statistics, 
+                                                [ tf.zeros([K, M], dtype = ACCUMULATOR_DTYPE),
+                                                  tf.zeros([K], dtype = ACCUMULATOR_DTYPE),
+                                                  tf.zeros([K], dtype = ACCUMULATOR_DTYPE) ])
+
+    # Closest center of each model, only computed when they are fetched
+    def block_labels(start, stop, labels):
+        sum_squares = squared_distances(X[start:stop], X_sqr_norm[start:stop], centroids)
+        block = tf.stack([ tf.argmin(sum_squares[:, offsets[j]:offsets[j + 1]], axis = 1) 
+                           for j in range(len(Ks)) ], axis = 1)
+        return (labels.write(labels.size(), block), )
+
+    (labels, ) = blocked_rows_loop(X, block_rows, block_labels, 
+                                   [ tf.TensorArray(tf.int64, size = 0, dynamic_size = True, 
+                                                    infer_shape = False) ])
+
+    return (sums, counts, inertia, labels.concat())
+
+def session_config():
     config = tf.ConfigProto( allow_soft_placement = True )
     config.gpu_options.allow_growth = True
     config.gpu_options.allocator_type = 'BFC'
-
-    with tf.Session( config = config ) as sess:
-        initialization_ts = time.time()
-        sess.run(tf.global_variables_initializer(), feed_dict={all_data: data_batch})
-        initialization_time = float( time.time() - initialization_ts ) 
-    
-        computation_time = 0.0
-        for i in range(n_max_iters):
-            aux_ts = time.time()
-            [result, _] = sess.run([global_centroids, update_centroid])
-            computation_time += float(time.time() - aux_ts)
-            
-            cluster_idx = sess.run(result_matrix, feed_dict={all_data: data_batch})
-    
-    end_resut = {   'end_center'          : result             ,
-                    'cluster_idx'         : cluster_idx        ,
-                    'init_center'         : initial_centers    ,
-                    'setup_time'          : setup_time         ,
-                    'initialization_time' : initialization_time,
-                    'computation_time'    : computation_time   ,
-                    'n_iter'              : i+1
-                }
-    return end_resut
-
-def distribuited_k_means(data_batch, K, GPU_names, n_max_iters):
-    setup_ts = time.time()
-    number_of_gpus = len(GPU_names)
-
-    sizes = [len(arg) for arg in np.array_split( data_batch, len(GPU_names))]
-    result_matrix = [[] for _ in GPU_names]
-    
-    partial_directions = []
-    partial_values = []
-    partial_results = []
-    
-    initial_centers = k_means_._init_centroids(data_batch, K, init='k-means++')
-    
-    tf.reset_default_graph()
-    with tf.name_scope('global'):
-        with tf.device('/cpu:0'):
-            all_data = tf.placeholder(data_batch.dtype, shape=(data_batch.shape), name='all_data')
-            parts = tf.split(all_data, sizes, 0)
-
-            global_centroids = tf.Variable(initial_centers)
-            
-    for GPU_num in range(len(GPU_names)):
-        GPU_name = GPU_names[GPU_num]
-            
-        (X_mat) = parts[GPU_num]
-        (N, M) = X_mat.get_shape().as_list()
-        
-        with tf.name_scope('scope_' + str(GPU_num)):
-            with tf.device(GPU_name) :
-                ####
-                # In the coments we denote :
-                # => N = Number of Observations
-                # => M = Number of Dimensions
-                # => K = Number of Centers
-                ####
-
-                # Data for GPU GPU_num to Clusterize
-                X = tf.Variable(X_mat)
-
-                # Reshapes rep_centroids and rep_points to format N x K x M so that 
-                # the 2 matrixes have the same size
-                rep_centroids = tf.reshape(tf.tile(global_centroids, [N, 1]), [N, K, M])
-                rep_points = tf.reshape(tf.tile(X, [1, K]), [N, K, M])
-
-                # Calculates sum_squares, a matrix of size N x K
-                # This matrix is not sqrt((X-Y)^2), it is just(X-Y)^2
-                # Since we need just the argmin(sqrt((X-Y)^2)) wich is equal to 
-                # argmin((X-Y)^2), it would be a waste of computation
-                subtraction = tf.subtract(rep_points, rep_centroids)
-                square = tf.square(subtraction)
-                sum_squares = tf.reduce_sum(square, axis = 2)
-
-                # Use argmin to select the lowest-distance point
-                # This gets a matrix of size N x 1
-                best_centroids = tf.argmin(sum_squares, axis = 1)
-                result_matrix[GPU_num] = sum_squares
-                
-                means = []
-                for c in range(K):
-                    aux_points = tf.gather(X, tf.reshape(tf.where(tf.equal(best_centroids, c)), [1,-1]))
-                    means.append(tf.reduce_mean(aux_points, axis=[1]))
-
-                new_centroids = tf.concat(means, 0)
-                    
+    return config
+
+# The Hamerly engine reaches the same statistics as k-means, and falls back 
+# to it for streamed batches, where its per point bounds can not be kept
+# The full passes of mini-batch k-means are k-means passes
+STATISTICS_FUNCS = {    'distributedKMeans'          : k_means_statistics       ,
+                        'distributedFuzzyCMeans'     : fuzzy_C_means_statistics ,
+                        'distributedHamerlyKMeans'   : k_means_statistics       ,
+                        'distributedMiniBatchKMeans' : k_means_statistics        }
+
+METHOD_NAMES = list(STATISTICS_FUNCS.keys())
+
+def clustering_params(method_name, fuzzifier = DEFAULT_FUZZIFIER, mini_batch_size = DEFAULT_MINI_BATCH_SIZE,
+                      full_pass_every = DEFAULT_FULL_PASS_EVERY):
+    ####
+    # Keyword arguments of the statistics of each method, the mini-batch
+    # ones are taken by the mini-batch engines, see MiniBatchClusterer
+    ####
+    if method_name == 'distributedFuzzyCMeans':
+        return {'fuzzifier': float(fuzzifier)}
+    if method_name == 'distributedMiniBatchKMeans':
+        return {'mini_batch_size': int(mini_batch_size), 'full_pass_every': int(full_pass_every)}
+    return {}
+
+def shard_batch_rows(mini_batch_size, shard_size, n_rows):
+    # Rows a shard of shard_size of the n_rows draws on each mini-batch step
+    return max(1, int(round(mini_batch_size * shard_size / float(n_rows))))
+
+def sample_rows(batches, n_rows, seed_value, step):
+    ####
+    # n_rows rows drawn uniformly, with replacement, from all the batches,
+    # for the steps of the streaming mini-batch engines. The rows are read
+    # in order, so a memory-mapped dataset is read forward
+    ####
+    offsets = np.cumsum([0] + [len(batch) for batch in batches])
+    rows = np.sort(np.random.default_rng([seed_value, step]).integers(offsets[-1], size = n_rows))
+    batch_of_rows = np.searchsorted(offsets, rows, side = 'right') - 1
+    return np.concatenate([ batches[batch_num][rows[batch_of_rows == batch_num] - offsets[batch_num]]
+                            for batch_num in range(len(batches)) ])
+
+def prefetched(batches, prepare, depth = PREFETCH_DEPTH):
+    ####
+    # prepare(batch) of the batches, in order, computed by a background
+    # thread up to depth batches ahead of the one the caller is working on
+    # So reading the next batch of a memory-mapped dataset and converting
+    # it to the precision of the clusterer overlap the computation of the
+    # current one, the session runs and the workers release the GIL
+    # The exceptions of prepare are raised in the caller
+    ####
+    if len(batches) == 1:
+        yield prepare(batches[0])
+        return
+
+    staged = queue.Queue()
+    slots = threading.Semaphore(1 + depth)
+    stop = threading.Event()
+    timeline = active_timeline()
+
+    def stage():
+        with recording(timeline):
+            try:
+                for batch in batches:
+                    slots.acquire()
+                    if stop.is_set():
+                        return
+                    staged.put( (True, prepare(batch)) )
+            except Exception as e:
+                staged.put( (False, e) )
+
+    stager = threading.Thread(target = stage, daemon = True)
+    stager.start()
+    try:
+        for _ in range(len(batches)):
+            (ok, value) = staged.get()
+            if not ok:
+                raise value
+            yield value
+            # The caller is done with the batch, its slot goes to the next one
+            del value
+            slots.release()
+    finally:
+        # When the caller stopped early the stager is unblocked and stops
+        stop.set()
+        slots.release()
+        stager.join()
+
+class DistributedClusterer(object):
+    ####
+    # Clustering graph and session built once for a given method, shard 
+    # sizes, number of dimensions, K, dtype and set of devices
+    # Every fit only feeds new data and initial centers into the Variables 
+    # of the existing graph, so repeated batches, seeds and calls skip the
+    # setup entirely. Clusterers are shared through get_clusterer
+    #
+    # With shard_sizes = None the graph is built for streaming : the shards 
+    # are placeholders fed with every batch on every pass, and the per cluster
+    # statistics are accumulated on the CPU until the end of the pass
+    # method_params are the keyword arguments of the method statistics, 
+    # see clustering_params
+    # Weighted clusterers keep a weight per point next to the shards, each
+    # point counts weight times in the statistics and in k-means||, see
+    # coreset.py. Their shards are always resident
+    ####
+    def __init__(self, method_name, shard_sizes, n_dim, K, dtype, GPU_names, method_params = None, 
+                 weighted = False):
+        setup_ts = time.time()
+
+        self.method_name = method_name
+        self.method_params = dict(method_params or {})
+        self.shard_sizes = shard_sizes
+        self.n_dim = n_dim
+        self.K = K
+        self.dtype = np.dtype(dtype)
+        self.GPU_names = list(GPU_names)
+        self.streaming = shard_sizes is None
+        self.weighted = weighted
+        self.statistics_func = STATISTICS_FUNCS[method_name]
+
+        if self.weighted and self.streaming:
+            raise ValueError("Weighted clusterers must keep their shards on the devices")
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._build_graph()
+            init_op = tf.global_variables_initializer()
+        self.graph.finalize()
+
+        self.session = tf.Session( graph = self.graph, config = session_config() )
+        self.session.run(init_op)
+
+        # Bytes sent from the host to the devices, reported per iteration
+        self.transfer_bytes = 0
+
+        # Reported by the first fit only, later fits reuse the graph
+        self._setup_time = float( time.time() - setup_ts )
+
+    def _build_graph(self):
+        (K, M) = (self.K, self.n_dim)
+
+        partial_sums = []
+        partial_counts = []
+        partial_inertia = []
+        partial_labels = []
+
+        partial_potential = []
+        partial_samples = []
+        partial_candidates_counts = []
+        self.reset_min_sqr_dist = []
+
+        self.shards = []
+        self.load_data = []
+
+        # Weights of the points of each shard, None when unweighted
+        self.shard_weights = []
+        self.weight_inputs = []
+
+        # Engine specific ops, run at the start of each fit and on each iteration
+        self.reset_state = []
+        self.iteration_fetches = {}
+
+        with tf.name_scope('global'):
             with tf.device('/cpu:0'):
-                y_count = tf.cast(
-                    tf.bincount(tf.to_int32(best_centroids), maxlength = K, minlength = K), dtype = tf.float64)
-                
-                partial_mu =  tf.multiply( tf.transpose(new_centroids), y_count )
-
-                partial_directions.append( y_count )
-                partial_values.append( partial_mu )
-                
-    with tf.name_scope('global') :
-        with tf.device('/cpu:0') :
-            result_matrix = tf.argmin(tf.concat(result_matrix, 0), axis = 1)
-            
-            sum_direction = tf.add_n( partial_directions )
-            sum_mu = tf.add_n( partial_values )
-
-            rep_sum_direction = tf.reshape(tf.tile(sum_direction, [M]), [M, K])
-            new_centers = tf.transpose( tf.div(sum_mu, rep_sum_direction) )
-
-            update_centroid = tf.group( global_centroids.assign(new_centers) )
-        
-    setup_time = float( time.time() - setup_ts )
-
-    config = tf.ConfigProto( allow_soft_placement = True )
-    config.gpu_options.allow_growth = True
-    config.gpu_options.allocator_type = 'BFC'
+                self.centers_input = tf.placeholder(self.dtype, shape = (K, M), name = 'centers_input')
+                self.global_centroids = tf.Variable(tf.zeros([K, M], dtype = self.dtype), trainable = False)
+                self.load_centers = self.global_centroids.assign(self.centers_input)
+
+                # Statistics of the data a warm started model was fitted on,
+                # added to the ones of the data of each iteration
+                self.prior_sums_input = tf.placeholder(ACCUMULATOR_DTYPE, shape = (K, M), name = 'prior_sums')
+                self.prior_counts_input = tf.placeholder(ACCUMULATOR_DTYPE, shape = (K, ), name = 'prior_counts')
+                self.prior_sums = tf.Variable(tf.zeros([K, M], dtype = ACCUMULATOR_DTYPE), trainable = False)
+                self.prior_counts = tf.Variable(tf.zeros([K], dtype = ACCUMULATOR_DTYPE), trainable = False)
+                self.load_prior = tf.group( self.prior_sums.assign(self.prior_sums_input),
+                                            self.prior_counts.assign(self.prior_counts_input) )
+
+                self._build_global_state()
+
+        with tf.name_scope('init'):
+            with tf.device('/cpu:0'):
+                # Inputs of the k-means|| passes, see initializers.py
+                self.candidates = tf.placeholder(self.dtype, shape = (None, M), name = 'candidates')
+                self.sampling_factor = tf.placeholder(self.dtype, shape = (), name = 'sampling_factor')
+                self.sampling_seed = tf.placeholder(tf.int64, shape = (2,), name = 'sampling_seed')
+
+        for GPU_num in range(len(self.GPU_names)):
+            GPU_name = self.GPU_names[GPU_num]
+
+            with tf.name_scope('scope_' + str(GPU_num)):
+                with tf.device(GPU_name) :
+                    if self.streaming:
+                        # Part of the current batch for GPU GPU_num, fed on every pass
+                        N = None
+                        X = tf.placeholder(self.dtype, shape = (None, M), name = 'shard')
+                        X_sqr_norm = squared_norms(X)
+                        self.shards.append( X )
+                    else:
+                        # Data for GPU GPU_num to Clusterize, loaded once per fit
+                        N = self.shard_sizes[GPU_num]
+                        X_mat = tf.placeholder(self.dtype, shape = (N, M), name = 'shard')
+                        X = tf.Variable(tf.zeros([N, M], dtype = self.dtype), trainable = False)
+                        X_sqr_norm = tf.Variable(tf.zeros([N, 1], dtype = self.dtype), trainable = False)
+
+                        self.shards.append( X_mat )
+                        self.load_data.append( tf.group( X.assign(X_mat), 
+                                                         X_sqr_norm.assign(squared_norms(X_mat)) ) )
+
+                    if self.weighted:
+                        W_vec = tf.placeholder(self.dtype, shape = (N, ), name = 'weights')
+                        W = tf.Variable(tf.zeros([N], dtype = self.dtype), trainable = False)
+                        self.weight_inputs.append( W_vec )
+                        self.load_data.append( W.assign(W_vec) )
+                        self.shard_weights.append( W )
+                    else:
+                        W = None
+                        self.shard_weights.append( W )
+
+                    (sums, counts, inertia, labels) = self._shard_statistics(GPU_num, X, X_sqr_norm, N)
+
+                    partial_sums.append( sums )
+                    partial_counts.append( counts )
+                    partial_inertia.append( inertia )
+                    partial_labels.append( labels )
+
+                    with tf.name_scope('init'):
+                        candidates_sqr_dist = squared_distances(X, X_sqr_norm, self.candidates)
+
+                        if self.streaming:
+                            # Distances to all the candidates are computed on each pass
+                            min_sqr_dist = tf.reduce_min(candidates_sqr_dist, axis = 1)
+                            partial_potential.append( tf.reduce_sum(tf.cast(min_sqr_dist, ACCUMULATOR_DTYPE)) )
+                        else:
+                            # Resident shards keep the distance to the closest candidate,
+                            # so each round only compares them to the new candidates
+                            min_sqr_dist = tf.Variable(tf.zeros([N], dtype = self.dtype), trainable = False)
+                            self.reset_min_sqr_dist.append( 
+                                min_sqr_dist.assign(tf.fill([N], tf.constant(np.inf, dtype = self.dtype))) )
+
+                            updated_min_sqr_dist = min_sqr_dist.assign( 
+                                tf.minimum(min_sqr_dist, tf.reduce_min(candidates_sqr_dist, axis = 1)) )
+                            if W is not None:
+                                updated_min_sqr_dist = updated_min_sqr_dist * W
+                                min_sqr_dist = min_sqr_dist * W
+                            partial_potential.append( tf.reduce_sum(tf.cast(updated_min_sqr_dist, ACCUMULATOR_DTYPE)) )
+
+                        # Each point is a new candidate with probability factor * w d^2(x, C)
+                        uniform = tf.random.stateless_uniform( [tf.shape(X)[0]], 
+                                                               seed = self.sampling_seed + [0, GPU_num],
+                                                               dtype = self.dtype )
+                        partial_samples.append( tf.boolean_mask(X, uniform < self.sampling_factor * min_sqr_dist) )
+
+                        # Number (total weight) of points closest to each candidate
+                        (_, candidates_counts) = cluster_statistics(X, tf.argmin(candidates_sqr_dist, axis = 1), 
+                                                                    tf.shape(self.candidates)[0], W)
+                        partial_candidates_counts.append( candidates_counts )
+
+        with tf.name_scope('init'):
+            with tf.device('/cpu:0'):
+                self.potential = tf.add_n( partial_potential )
+                self.samples = tf.concat( partial_samples, 0 )
+                self.candidates_counts = tf.add_n( partial_candidates_counts )
+
+        with tf.name_scope('global') :
+            with tf.device('/cpu:0') :
+                self.labels = tf.concat(partial_labels, 0)
+
+                global_sums = tf.add_n( partial_sums )
+                global_counts = tf.add_n( partial_counts )
+                global_inertia = tf.add_n( partial_inertia )
+
+                if self.streaming:
+                    # Statistics accumulated along one pass over the batches
+                    sums_accumulator = tf.Variable(tf.zeros([K, M], dtype = ACCUMULATOR_DTYPE), trainable = False)
+                    counts_accumulator = tf.Variable(tf.zeros([K], dtype = ACCUMULATOR_DTYPE), trainable = False)
+                    inertia_accumulator = tf.Variable(tf.zeros([], dtype = ACCUMULATOR_DTYPE), trainable = False)
+
+                    self.accumulate = tf.group( sums_accumulator.assign_add( global_sums ),
+                                                counts_accumulator.assign_add( global_counts ),
+                                                inertia_accumulator.assign_add( global_inertia ) )
+
+                    self.reset_accumulators = tf.group( sums_accumulator.assign( tf.zeros_like(sums_accumulator) ),
+                                                        counts_accumulator.assign( tf.zeros_like(counts_accumulator) ),
+                                                        inertia_accumulator.assign( tf.zeros_like(inertia_accumulator) ) )
+
+                    (global_sums, global_counts, global_inertia) = (sums_accumulator, counts_accumulator, inertia_accumulator)
+
+                self.inertia = global_inertia
+
+                # Statistics the new centers come from, kept by the models
+                self.statistics = (global_sums + self.prior_sums, global_counts + self.prior_counts)
+
+                new_centers = centers_from_statistics(self.statistics[0], self.statistics[1], self.global_centroids)
+                self.center_shift = centers_shift(new_centers, self.global_centroids)
+
+                with tf.control_dependencies([self.inertia, self.center_shift] + self._build_before_update()):
+                    self.update_centroid = tf.group( self.global_centroids.assign(new_centers) )
+
+    def _build_global_state(self):
+        # Extra Variables shared by all the shards, built before them
+        pass
+
+    def _shard_statistics(self, GPU_num, X, X_sqr_norm, N):
+        # Per cluster sums, counts, inertia and labels of one shard
+        return self.statistics_func(X, X_sqr_norm, self.global_centroids, self.K, 
+                                    weights = self.shard_weights[GPU_num], **self.method_params)
+
+    def _build_before_update(self):
+        # Ops that must run before the centers are overwritten
+        return []
+
+    @property
+    def timeline(self):
+        # Timeline of the thread running the fit, see timeline.py
+        return active_timeline()
+
+    def _run(self, fetches, feed_dict = None):
+        # Session run, traced op by op when the timeline records
+        if feed_dict is not None:
+            self.transfer_bytes += sum(np.asarray(value).nbytes for value in feed_dict.values())
+
+        timeline = self.timeline
+        if not timeline.enabled:
+            return self.session.run(fetches, feed_dict = feed_dict)
+
+        run_metadata = tf.RunMetadata()
+        results = self.session.run(fetches, feed_dict = feed_dict, 
+                                   options = tf.RunOptions(trace_level = tf.RunOptions.FULL_TRACE),
+                                   run_metadata = run_metadata)
+        timeline.add_step_stats(run_metadata.step_stats)
+        return results
+
+    def load(self, data_batch, weights = None):
+        # Copies the batch, and the weights of its points, to the Variables of the devices, once per fit
+        feed_dict = self._batch_feed(data_batch)
+        if self.weighted:
+            feed_dict.update(zip(self.weight_inputs, np.array_split(np.asarray(weights, dtype = self.dtype), 
+                                                                    len(self.GPU_names))))
+        self._run(self.load_data, feed_dict = feed_dict)
+
+    def _batch_feed(self, batch):
+        ####
+        # Shards are converted to the precision of the clusterer on the host
+        # They are always copied, so the rows of a memory-mapped batch are
+        # read here, by the prefetching thread of the streaming clusterers
+        ####
+        with self.timeline.span('host_transfer', name = 'batch_feed'):
+            shards = np.array_split(batch, len(self.GPU_names))
+            return dict(zip(self.shards, [np.array(shard, dtype = self.dtype) for shard in shards]))
+
+    def _batch_feeds(self, batches):
+        # Feeds of the batches, each one staged while the previous one is computed
+        return prefetched(batches, self._batch_feed)
+
+    def _count_centers_transfer(self):
+        # Every pass over the shards copies the centers to each device
+        self.transfer_bytes += self.K * self.n_dim * self.dtype.itemsize * len(self.GPU_names)
+
+    def candidates_potential(self, candidates, n_new, data, reset = False):
+        ####
+        # Sum over all points of the squared distance to the closest candidate
+        # Resident clusterers only compare the points to the n_new last ones
+        ####
+        if not self.streaming:
+            if reset:
+                self.session.run(self.reset_min_sqr_dist)
+            return float( self.session.run(self.potential, feed_dict = {self.candidates: candidates[-n_new:]}) )
+
+        potential = 0.0
+        for feed_dict in self._batch_feeds(data):
+            feed_dict[self.candidates] = candidates
+            potential += float( self.session.run(self.potential, feed_dict = feed_dict) )
+        return potential
+
+    def sample_candidates(self, candidates, factor, seed, data):
+        # Points kept with probability factor * d^2(x, C), seeded by the pair seed
+        (seed_value, seed_round) = seed
+
+        if not self.streaming:
+            feed_dict = {   self.sampling_factor : factor,
+                            self.sampling_seed   : [seed_value, seed_round * len(self.GPU_names)] }
+            return self.session.run(self.samples, feed_dict = feed_dict)
+
+        samples = []
+        for (batch_num, feed_dict) in enumerate(self._batch_feeds(data)):
+            feed_dict[self.candidates] = candidates
+            feed_dict[self.sampling_factor] = factor
+            feed_dict[self.sampling_seed] = [seed_value, (seed_round * len(data) + batch_num) * len(self.GPU_names)]
+            samples.append( self.session.run(self.samples, feed_dict = feed_dict) )
+        return np.concatenate(samples)
+
+    def candidates_weights(self, candidates, data):
+        # Number of points closest to each candidate
+        feed_dicts = [{}] if not self.streaming else self._batch_feeds(data)
+
+        weights = np.zeros(len(candidates))
+        for feed_dict in feed_dicts:
+            feed_dict[self.candidates] = candidates
+            weights += self.session.run(self.candidates_counts, feed_dict = feed_dict)
+        return weights
+
+    def _accumulate(self, batches):
+        # Streaming clusterers sum the statistics of all the batches of a pass
+        if self.streaming:
+            self.session.run(self.reset_accumulators)
+            for feed_dict in self._batch_feeds(batches):
+                self._count_centers_transfer()
+                self._run(self.accumulate, feed_dict = feed_dict)
+        else:
+            self._count_centers_transfer()
+
+    def _iterate(self, batches):
+        self._accumulate(batches)
+        [_, inertia, shift, extras, statistics] = self._run([self.update_centroid, self.inertia, 
+                                                             self.center_shift, self.iteration_fetches,
+                                                             self.statistics])
+        return (inertia, shift, extras, statistics)
+
+    def _converged(self, inertia_history, shift_history, tol, inertia_tol):
+        return has_converged(inertia_history, shift_history, tol, inertia_tol)
+
+    def fit(self, data, initial_centers, n_max_iters, tol = 0.0, inertia_tol = 0.0, prior = None, seed = None,
+            labels = True):
+        ####
+        # data is a single batch for resident clusterers and a list of 
+        # batches for streaming ones. Resident clusterers can be given 
+        # data = None to reuse the batch loaded by the previous fit
+        # prior are the (sums, counts) of the data a model was fitted on,
+        # they weight the previous data in every update of the centers
+        # seed seeds the random parts of the iterations, the mini-batches
+        # labels = False leaves out the labels of the points, cluster_idx
+        ####
+        setup_time = self._setup_time
+        self._setup_time = 0.0
+        self.seed = 0 if seed is None else seed
 
-    with tf.Session( config = config ) as sess:
         initialization_ts = time.time()
-        sess.run(tf.global_variables_initializer(), feed_dict={all_data: data_batch})
+        if not self.streaming and data is not None:
+            self.load(data)
+        if prior is None:
+            prior = (np.zeros((self.K, self.n_dim)), np.zeros(self.K))
+        self._start(initial_centers, prior)
         initialization_time = float( time.time() - initialization_ts ) 
-    
+
         computation_time = 0.0
+        inertia_history = []
+        shift_history = []
+        extras_history = dict((name + '_history', []) for name in self.iteration_fetches)
+        timeline = self.timeline
+        self.n_max_iters = n_max_iters
         for i in range(n_max_iters):
+            timeline.iteration = i
             aux_ts = time.time()
-            [result, centroids, _] = sess.run([global_centroids, best_centroids, update_centroid])
+            self.transfer_bytes = 0
+            with timeline.span('iteration'):
+                (inertia, shift, extras, statistics) = self._iterate(data)
             computation_time += float(time.time() - aux_ts)
-            
-            cluster_idx = sess.run(result_matrix, feed_dict={all_data: data_batch})
-
-    end_resut = {   'end_center'          : result             ,
-                    'cluster_idx'         : cluster_idx        ,
-                    'centroids'           : centroids          ,
-                    'init_center'         : initial_centers    ,
-                    'setup_time'          : setup_time         ,
-                    'initialization_time' : initialization_time,
-                    'computation_time'    : computation_time   ,
-                    'n_iter'              : i+1
-                }
+            extras = dict(extras, host_to_device_bytes = self.transfer_bytes)
+
+            inertia_history.append( float(inertia) )
+            shift_history.append( float(shift) )
+            for name in extras:
+                extras_history.setdefault(name + '_history', []).append( float(extras[name]) )
+
+            if self._converged(inertia_history, shift_history, tol, inertia_tol):
+                break
+        timeline.iteration = None
+
+        end_resut = {   'end_center'          : self._centers()    ,
+                        'init_center'         : initial_centers    ,
+                        'setup_time'          : setup_time         ,
+                        'initialization_time' : initialization_time,
+                        'computation_time'    : computation_time   ,
+                        'inertia_history'     : inertia_history    ,
+                        'shift_history'       : shift_history      ,
+                        'sums'                : statistics[0]      ,
+                        'counts'              : statistics[1]      ,
+                        'n_iter'              : i+1
+                    }
+        end_resut.update(extras_history)
+
+        # Labels are only computed once, for the final centers
+        if labels and not self.streaming:
+            end_resut['cluster_idx'] = self._labels()
+
+        return end_resut
+
+    def _start(self, initial_centers, prior):
+        self.session.run(self.load_centers, feed_dict = {self.centers_input: initial_centers})
+        self.session.run(self.load_prior, feed_dict = { self.prior_sums_input   : prior[0],
+                                                        self.prior_counts_input : prior[1] })
+        self.session.run(self.reset_state)
+
+    def _centers(self):
+        return self.session.run(self.global_centroids)
+
+    def _labels(self):
+        return self.session.run(self.labels)
+
+    def close(self):
+        self.session.close()
+
+class CPUClusterer(DistributedClusterer):
+    ####
+    # Same clusterer running on the worker processes of cpu_backend instead 
+    # of a tensorflow graph, the worker i holds shard i in shared memory and
+    # the parent reduces the per cluster statistics of all the workers
+    # Only the fit loop is shared with DistributedClusterer
+    # Any pool answering the worker commands can be given, multi_node.py 
+    # gives one whose workers are the nodes of a multi-node run
+    ####
+    def __init__(self, method_name, shard_sizes, n_dim, K, dtype, GPU_names, method_params = None, pool = None,
+                 weighted = False):
+        setup_ts = time.time()
+
+        self.method_name = method_name
+        self.method_params = dict(method_params or {})
+        self.shard_sizes = shard_sizes
+        self.n_dim = n_dim
+        self.K = K
+        self.dtype = np.dtype(dtype)
+        self.GPU_names = list(GPU_names)
+        self.streaming = shard_sizes is None
+        self.weighted = weighted
+        self.iteration_fetches = {}
+
+        if self.weighted and self.streaming:
+            raise ValueError("Weighted clusterers must keep their shards on the workers")
+
+        # A pool given is shared with other clusterers and closed by its owner
+        self.owns_pool = pool is None
+        if pool is None:
+            pool = cpu_backend.WorkerPool(len(self.GPU_names), method_name)
+        self.pool = pool
+        self.centers = np.zeros((K, n_dim), dtype = self.dtype)
+        self.transfer_bytes = 0
+
+        self._setup_time = float( time.time() - setup_ts )
+
+    def load(self, data_batch, weights = None):
+        # Converted to the precision of the clusterer while copied to the workers
+        with self.timeline.span('host_transfer', name = 'scatter'):
+            self.transfer_bytes += len(data_batch) * self.n_dim * self.dtype.itemsize
+            self.pool.scatter(data_batch, self.dtype)
+            if self.weighted:
+                self.pool.run('weights', [(shard_weights, ) for shard_weights in 
+                                          np.array_split(weights, len(self.GPU_names))])
+
+    def candidates_potential(self, candidates, n_new, data, reset = False):
+        if not self.streaming:
+            return float( sum(self.pool.broadcast('potential', candidates[-n_new:], reset)) )
+
+        potential = 0.0
+        for batch in self._staged_batches(data):
+            self.load(batch)
+            potential += float( sum(self.pool.broadcast('potential', candidates, True)) )
+        return potential
+
+    def sample_candidates(self, candidates, factor, seed, data):
+        (seed_value, seed_round) = seed
+        n_workers = len(self.GPU_names)
+
+        if not self.streaming:
+            return np.concatenate(self.pool.broadcast('sample', factor, seed_value, seed_round * n_workers))
+
+        samples = []
+        for (batch_num, batch) in enumerate(self._staged_batches(data)):
+            self.load(batch)
+            self.pool.broadcast('potential', candidates, True)
+            samples.extend( self.pool.broadcast('sample', factor, seed_value, 
+                                                (seed_round * len(data) + batch_num) * n_workers) )
+        return np.concatenate(samples)
+
+    def candidates_weights(self, candidates, data):
+        batches = [None] if not self.streaming else self._staged_batches(data)
+
+        weights = np.zeros(len(candidates))
+        for batch in batches:
+            if batch is not None:
+                self.load(batch)
+            weights += sum(self.pool.broadcast('counts', candidates))
+        return weights
+
+    def _reduce(self, replies):
+        # Sums, counts and inertia of all the workers, with their timeline events
+        timeline = self.timeline
+        with timeline.span('global_reduction'):
+            for (worker_num, (_, _, _, events)) in enumerate(replies):
+                # The replies of a multi-node pool are the ones of its nodes
+                device = self.GPU_names[worker_num] if len(replies) == len(self.GPU_names) else 'node_' + str(worker_num)
+                timeline.add_worker_events(events, device, worker_num)
+            return tuple( sum(reply[i] for reply in replies) for i in range(3) )
+
+    def _staged_batches(self, batches):
+        ####
+        # Batches read and converted to the precision of the clusterer by
+        # a background thread while the workers compute the previous one,
+        # only the copy to the shared memory is left to load
+        ####
+        return prefetched(batches, lambda batch: np.array(batch, dtype = self.dtype))
+
+    def _statistics(self, batches):
+        # Statistics of a full pass over the data, added to the prior ones
+        batches = [None] if not self.streaming else self._staged_batches(batches)
+
+        sums = self.prior_sums.copy()
+        counts = self.prior_counts.copy()
+        inertia = 0.0
+        for batch in batches:
+            if batch is not None:
+                self.load(batch)
+            self._count_centers_transfer()
+            replies = self.pool.broadcast('statistics', self.centers, self.K, self.method_params, 
+                                          self.timeline.enabled)
+            (batch_sums, batch_counts, batch_inertia) = self._reduce(replies)
+            sums += batch_sums
+            counts += batch_counts
+            inertia += batch_inertia
+        return (sums, counts, inertia)
+
+    def _iterate(self, batches):
+        (sums, counts, inertia) = self._statistics(batches)
+
+        with self.timeline.span('global_reduction', name = 'update_centers'):
+            new_centers = cpu_backend.centers_from_statistics(sums, counts, self.centers).astype(self.dtype)
+            shift = np.sum(np.square(new_centers.astype(cpu_backend.ACCUMULATOR_DTYPE) - self.centers))
+        self.centers = new_centers
+        return (inertia, shift, {}, (sums, counts))
+
+    def _start(self, initial_centers, prior):
+        self.centers = np.array(initial_centers, dtype = self.dtype)
+        (self.prior_sums, self.prior_counts) = (np.array(prior[0], dtype = cpu_backend.ACCUMULATOR_DTYPE), 
+                                                np.array(prior[1], dtype = cpu_backend.ACCUMULATOR_DTYPE))
+
+    def _centers(self):
+        return self.centers.copy()
+
+    def _labels(self):
+        return np.concatenate(self.pool.broadcast('labels', self.centers))
+
+    def label_statistics(self):
+        # Points and inertia of each cluster of the final centers, reduced on the workers
+        replies = self.pool.broadcast('label_statistics', self.centers)
+        return tuple( sum(reply[i] for reply in replies) for i in range(2) )
+
+    def close(self):
+        if self.owns_pool:
+            self.pool.close()
+
+class HamerlyClusterer(DistributedClusterer):
+    ####
+    # k-means engine accelerated with the triangle inequality (Hamerly, 2010)
+    # Each point keeps its cluster a, an upper bound u on the distance to 
+    # its center and a lower bound l on the distance to any other center
+    # After the centers move by p, u grows by p[a] and l shrinks by max(p)
+    # A point can only change cluster if u > max(s[a], l), where s[j] is
+    # half the distance from center j to the closest other center, so only
+    # those points get their distance to c[a] recomputed, and only the ones
+    # still above the bound get all their K distances recomputed
+    # The bounds live next to the resident shards, the sums and counts are
+    # the same as the ones of distributedKMeans
+    ####
+    def _build_global_state(self):
+        K = self.K
+        inf = tf.constant(np.inf, dtype = self.dtype)
+
+        # Centers of the previous iteration, to know how much they moved
+        previous_centroids = tf.Variable(tf.zeros([K, self.n_dim], dtype = self.dtype), trainable = False)
+        self.previous_centroids = previous_centroids
+        self.reset_state.append( previous_centroids.assign(self.global_centroids) )
+
+        self.centers_movement = tf.sqrt( tf.reduce_sum(tf.square(self.global_centroids - previous_centroids), axis = 1) )
+        self.max_centers_movement = tf.reduce_max(self.centers_movement)
+
+        # Half the distance of each center to the closest other center
+        centers_sqr_dist = squared_distances(self.global_centroids, squared_norms(self.global_centroids), 
+                                             self.global_centroids)
+        centers_sqr_dist = centers_sqr_dist + tf.diag(tf.fill([K], inf))
+        self.half_separation = 0.5 * tf.sqrt(tf.reduce_min(centers_sqr_dist, axis = 1))
+
+        self.bounds_updates = []
+        self.partial_checked = []
+        self.partial_recomputed = []
+
+    def _shard_statistics(self, GPU_num, X, X_sqr_norm, N):
+        K = self.K
+        inf = tf.constant(np.inf, dtype = self.dtype)
+
+        with tf.name_scope('bounds'):
+            assignment = tf.Variable(tf.zeros([N], dtype = tf.int64), trainable = False)
+            upper = tf.Variable(tf.zeros([N], dtype = self.dtype), trainable = False)
+            lower = tf.Variable(tf.zeros([N], dtype = self.dtype), trainable = False)
+
+            # Every point starts in cluster 0 with no information on its distances
+            self.reset_state.append( tf.group( assignment.assign(tf.zeros([N], dtype = tf.int64)),
+                                               upper.assign(tf.fill([N], inf)),
+                                               lower.assign(tf.zeros([N], dtype = self.dtype)) ) )
+
+            # Bounds after the last move of the centers
+            upper_bound = upper + tf.gather(self.centers_movement, assignment)
+            lower_bound = lower - self.max_centers_movement
+            bound = tf.maximum(tf.gather(self.half_separation, assignment), lower_bound)
+
+            # Points that may have changed cluster get their upper bound tightened
+            check = tf.reshape(tf.where(upper_bound > bound), [-1])
+            check_X = tf.gather(X, check)
+            check_centers = tf.gather(self.global_centroids, tf.gather(assignment, check))
+            check_sqr_dist = ( tf.gather(X_sqr_norm[:, 0], check) 
+                               - 2 * tf.reduce_sum(tf.multiply(check_X, check_centers), axis = 1)
+                               + tf.reduce_sum(tf.square(check_centers), axis = 1) )
+            tight_upper = tf.sqrt(tf.maximum(check_sqr_dist, 0))
+
+            # Points still above the bound get all their K distances computed
+            still = tf.reshape(tf.where(tight_upper > tf.gather(bound, check)), [-1])
+            recompute = tf.gather(check, still)
+            recompute_sqr_dist = squared_distances(tf.gather(check_X, still), tf.gather(X_sqr_norm, recompute), 
+                                                   self.global_centroids)
+
+            (neg_closest, closest) = tf.nn.top_k(-recompute_sqr_dist, k = min(2, K))
+            new_upper = tf.sqrt(tf.maximum(-neg_closest[:, 0], 0))
+            if K > 1:
+                new_lower = tf.sqrt(tf.maximum(-neg_closest[:, 1], 0))
+            else:
+                new_lower = tf.fill(tf.shape(new_upper), inf)
+
+            with tf.control_dependencies([upper.assign(upper_bound)]):
+                tightened_upper = tf.scatter_update(upper, check, tight_upper)
+            with tf.control_dependencies([tightened_upper]):
+                new_upper = tf.scatter_update(upper, recompute, new_upper)
+            with tf.control_dependencies([lower.assign(lower_bound)]):
+                new_lower = tf.scatter_update(lower, recompute, new_lower)
+            labels = tf.scatter_update(assignment, recompute, tf.to_int64(closest[:, 0]))
+
+            self.bounds_updates.extend([new_upper, new_lower, labels])
+
+            # One distance per checked point to tighten its upper bound, K per
+            # recomputed point
+            self.partial_checked.append( tf.size(check) )
+            self.partial_recomputed.append( tf.size(recompute) )
+
+        (sums, counts) = cluster_statistics(X, labels, K)
+
+        # The bounds are not exact distances, the inertia is obtained from the
+        # statistics as sum ||x||^2 - 2 sum_k c_k . S_k + sum_k n_k ||c_k||^2
+        centroids = tf.cast(self.global_centroids, ACCUMULATOR_DTYPE)
+        inertia = ( tf.reduce_sum(tf.cast(X_sqr_norm, ACCUMULATOR_DTYPE)) 
+                    - 2 * tf.reduce_sum(tf.multiply(centroids, sums)) 
+                    + tf.reduce_sum(counts * tf.reduce_sum(tf.square(centroids), axis = 1)) )
+
+        return (sums, counts, tf.maximum(inertia, 0), labels)
+
+    def _build_before_update(self):
+        # Fraction of the N x K point to center distances the bounds allowed
+        # to skip, and fraction of the points whose upper bound was tightened
+        N = float(sum(self.shard_sizes))
+        recomputed = tf.cast(tf.add_n(self.partial_recomputed), self.dtype)
+        checked = tf.cast(tf.add_n(self.partial_checked), self.dtype)
+        self.iteration_fetches['skipped_fraction'] = 1 - recomputed / N
+        self.iteration_fetches['checked_fraction'] = checked / N
+
+        with tf.control_dependencies(self.bounds_updates):
+            return [ self.previous_centroids.assign(self.global_centroids) ]
+
+def mini_batch_start(clusterer, initial_centers):
+    clusterer.step = 0
+    clusterer.pass_statistics = None
+    clusterer.pass_centers = np.array(initial_centers, dtype = np.float64)
+    clusterer.pass_inertia = []
+    clusterer.pass_shift = np.inf
+    clusterer.full_pass_done = False
+
+def mini_batch_iterate(clusterer, batches):
+    ####
+    # One iteration of the mini-batch engines is one mini-batch step, its
+    # inertia the one of the mini-batch scaled to all the rows. Every
+    # full_pass_every iterations, and on the last one, the data is read once
+    # for the exact inertia of the new centers and the statistics kept by
+    # the models, the convergence is only tested then, see mini_batch_converged
+    # The iteration reports the rows its step and its pass read as rows_touched
+    ####
+    old_centers = clusterer._centers().astype(np.float64)
+    if clusterer.streaming:
+        n_rows = sum(len(batch) for batch in batches)
+    else:
+        n_rows = sum(clusterer.shard_sizes)
+
+    (rows_touched, batch_inertia) = clusterer.mini_batch_step(batches)
+    clusterer.step += 1
+    inertia = batch_inertia * n_rows / float(max(rows_touched, 1))
+
+    centers = clusterer._centers().astype(np.float64)
+    shift = np.sum(np.square(centers - old_centers))
+
+    clusterer.full_pass_done = (clusterer.step % clusterer.full_pass_every == 0 or 
+                                clusterer.step == clusterer.n_max_iters)
+    if clusterer.full_pass_done:
+        (inertia, clusterer.pass_statistics) = clusterer.full_pass(batches)
+        rows_touched += n_rows
+
+        clusterer.pass_inertia.append( float(inertia) )
+        clusterer.pass_shift = np.sum(np.square(centers - clusterer.pass_centers))
+        clusterer.pass_centers = centers
+
+    extras = {'rows_touched': rows_touched, 'full_pass': float(clusterer.full_pass_done)}
+    return (inertia, shift, extras, clusterer.pass_statistics)
+
+def mini_batch_converged(clusterer, tol, inertia_tol):
+    ####
+    # Tested on the full passes only : on the move of the centers since the
+    # previous pass and the relative change of its exact inertia, which
+    # stops at DEFAULT_MINI_BATCH_INERTIA_TOL when no inertia_tol is given
+    ####
+    if not clusterer.full_pass_done:
+        return False
+    inertia_tol = inertia_tol if inertia_tol > 0 else DEFAULT_MINI_BATCH_INERTIA_TOL
+    return has_converged(clusterer.pass_inertia, [clusterer.pass_shift], tol, inertia_tol)
+
+class MiniBatchClusterer(DistributedClusterer):
+    ####
+    # Mini-batch k-means (Sculley, 2010)
+    # On each step every shard draws its share of mini_batch_size rows, with
+    # a stateless random stream per (seed, step, shard), and the per cluster
+    # sums S and counts n of all the draws move each center towards their
+    # mean with its own learning rate n / (v + n), where v is the number of
+    # points the center was moved towards so far :
+    #     c <- (v c + S) / (v + n)    and    v <- v + n
+    # which is Sculley's per point update applied to the whole mini-batch
+    # Streaming clusterers draw the mini-batch from all the batches on the
+    # host and feed only those rows. Every full_pass_every steps the data is
+    # read once for the exact inertia, see mini_batch_iterate
+    # A warm started fit starts from the counts of the model, its centers
+    # then move as slowly as the data they already stand for
+    ####
+    def __init__(self, method_name, shard_sizes, n_dim, K, dtype, GPU_names, method_params = None):
+        method_params = dict(method_params or {})
+        self.mini_batch_size = method_params.pop('mini_batch_size')
+        self.full_pass_every = method_params.pop('full_pass_every')
+        DistributedClusterer.__init__(self, method_name, shard_sizes, n_dim, K, dtype, GPU_names, method_params)
+
+    def _build_global_state(self):
+        # Streams above 2^32 are the steps, the ones below the k-means|| rounds
+        self.step_seed = tf.placeholder(tf.int64, shape = (2,), name = 'step_seed')
+
+        self.center_counts = tf.Variable(tf.zeros([self.K], dtype = ACCUMULATOR_DTYPE), trainable = False)
+        self.reset_state.append( self.center_counts.assign(self.prior_counts) )
+
+        self.partial_batch_statistics = []
+
+    def _shard_statistics(self, GPU_num, X, X_sqr_norm, N):
+        (sums, counts, inertia, labels) = k_means_statistics(X, X_sqr_norm, self.global_centroids, self.K)
+
+        if self.streaming:
+            # The shards fed by a step are the mini-batch itself
+            self.partial_batch_statistics.append( (sums, counts, inertia) )
+        else:
+            with tf.name_scope('mini_batch'):
+                n_rows = shard_batch_rows(self.mini_batch_size, N, sum(self.shard_sizes))
+                rows = tf.random.stateless_uniform( [n_rows], seed = self.step_seed + [0, GPU_num],
+                                                    minval = 0, maxval = N, dtype = tf.int64 )
+                (batch_sums, batch_counts, batch_inertia, _) = k_means_statistics(tf.gather(X, rows), 
+                                                                                  tf.gather(X_sqr_norm, rows),
+                                                                                  self.global_centroids, self.K)
+                self.partial_batch_statistics.append( (batch_sums, batch_counts, batch_inertia) )
+
+        return (sums, counts, inertia, labels)
+
+    def _build_graph(self):
+        DistributedClusterer._build_graph(self)
+
+        with tf.name_scope('global'):
+            with tf.device('/cpu:0'):
+                (partial_sums, partial_counts, partial_inertia) = zip(*self.partial_batch_statistics)
+                batch_sums = tf.add_n( list(partial_sums) )
+                batch_counts = tf.add_n( list(partial_counts) )
+                self.batch_rows = tf.reduce_sum(batch_counts)
+                self.batch_inertia = tf.add_n( list(partial_inertia) )
+
+                centers = tf.cast(self.global_centroids, ACCUMULATOR_DTYPE)
+                center_counts = self.center_counts + batch_counts
+                new_centers = centers_from_statistics(batch_sums + tf.expand_dims(self.center_counts, 1) * centers,
+                                                      center_counts, self.global_centroids)
+
+                # Both Variables are only written once the new values are computed
+                with tf.control_dependencies([new_centers, center_counts]):
+                    self.step_update = tf.group( self.global_centroids.assign(new_centers),
+                                                 self.center_counts.assign(center_counts) )
+
+    def mini_batch_step(self, batches):
+        # Updates the centers with one mini-batch, returns its number of rows and its inertia
+        feed_dict = {}
+        if self.streaming:
+            feed_dict = self._batch_feed(sample_rows(batches, self.mini_batch_size, self.seed, self.step))
+        feed_dict[self.step_seed] = [self.seed, (1 << 32) + self.step * len(self.GPU_names)]
+
+        self._count_centers_transfer()
+        (_, batch_rows, batch_inertia) = self._run([self.step_update, self.batch_rows, self.batch_inertia], 
+                                                   feed_dict = feed_dict)
+        return (int(batch_rows), float(batch_inertia))
+
+    def full_pass(self, batches):
+        # Inertia and statistics of all the data, the centers do not move
+        self._accumulate(batches)
+        return tuple(self._run([self.inertia, self.statistics]))
+
+    def _iterate(self, batches):
+        return mini_batch_iterate(self, batches)
+
+    def _converged(self, inertia_history, shift_history, tol, inertia_tol):
+        return mini_batch_converged(self, tol, inertia_tol)
+
+    def _start(self, initial_centers, prior):
+        DistributedClusterer._start(self, initial_centers, prior)
+        mini_batch_start(self, initial_centers)
+
+class CPUMiniBatchClusterer(CPUClusterer):
+    ####
+    # Mini-batch k-means on the CPU workers, see MiniBatchClusterer
+    # Each worker draws its rows from its shard, the parent sums the
+    # statistics of the draws and updates the centers
+    ####
+    def __init__(self, method_name, shard_sizes, n_dim, K, dtype, GPU_names, method_params = None, pool = None):
+        method_params = dict(method_params or {})
+        self.mini_batch_size = method_params.pop('mini_batch_size')
+        self.full_pass_every = method_params.pop('full_pass_every')
+        CPUClusterer.__init__(self, method_name, shard_sizes, n_dim, K, dtype, GPU_names, method_params, pool)
+
+    def mini_batch_step(self, batches):
+        timeline = self.timeline
+        self._count_centers_transfer()
+        if self.streaming:
+            self.load(sample_rows(batches, self.mini_batch_size, self.seed, self.step))
+            replies = self.pool.broadcast('statistics', self.centers, self.K, self.method_params, timeline.enabled)
+        else:
+            fraction = self.mini_batch_size / float(sum(self.shard_sizes))
+            replies = self.pool.broadcast('mini_batch', self.centers, self.K, fraction, self.seed,
+                                          (1 << 32) + self.step * len(self.GPU_names), timeline.enabled)
+        (batch_sums, batch_counts, batch_inertia) = self._reduce(replies)
+
+        with timeline.span('global_reduction', name = 'update_centers'):
+            center_counts = self.center_counts + batch_counts
+            weighted_sums = batch_sums + self.center_counts[:, np.newaxis] * self.centers
+            self.centers = cpu_backend.centers_from_statistics(weighted_sums, center_counts, 
+                                                               self.centers).astype(self.dtype)
+            self.center_counts = center_counts
+        return (int(np.sum(batch_counts)), float(batch_inertia))
+
+    def full_pass(self, batches):
+        (sums, counts, inertia) = self._statistics(batches)
+        return (inertia, (sums, counts))
+
+    def _iterate(self, batches):
+        return mini_batch_iterate(self, batches)
+
+    def _converged(self, inertia_history, shift_history, tol, inertia_tol):
+        return mini_batch_converged(self, tol, inertia_tol)
+
+    def _start(self, initial_centers, prior):
+        CPUClusterer._start(self, initial_centers, prior)
+        self.center_counts = self.prior_counts.copy()
+        mini_batch_start(self, initial_centers)
+
+def multi_K_fit(clusterer, initial_centers, n_max_iters, tol = 0.0, inertia_tol = 0.0):
+    ####
+    # Iterations of the models of a multi-K clusterer, on the batch it has
+    # loaded, from the initial centers of each model. Every model follows
+    # has_converged on its own inertia and shift histories, a converged one
+    # has its centers frozen while the others go on, so each model ends as
+    # its own fit would. Returns the result of each model, as the ones of
+    # DistributedClusterer.fit, with the time of the shared iterations it
+    # took part in as its computation time
+    ####
+    Ks = clusterer.Ks
+    offsets = np.cumsum([0] + Ks)
+    models = range(len(Ks))
+
+    setup_time = clusterer._setup_time
+    clusterer._setup_time = 0.0
 
+    initialization_ts = time.time()
+    clusterer._start(np.concatenate(initial_centers), (np.zeros((clusterer.K, clusterer.n_dim)), np.zeros(clusterer.K)))
+    initialization_time = float( time.time() - initialization_ts )
+
+    active = np.ones(len(Ks), dtype = bool)
+    computation_time = [0.0] * len(Ks)
+    n_iter = [0] * len(Ks)
+    inertia_history = [[] for _ in models]
+    shift_history = [[] for _ in models]
+    transfer_history = [[] for _ in models]
+    statistics = [None] * len(Ks)
+
+    timeline = clusterer.timeline
+    for i in range(n_max_iters):
+        timeline.iteration = i
+        aux_ts = time.time()
+        clusterer.transfer_bytes = 0
+        with timeline.span('iteration'):
+            (inertia, shifts, _, (sums, counts)) = clusterer._iterate(None)
+        iteration_time = float(time.time() - aux_ts)
+
+        for j in np.flatnonzero(active):
+            (start, stop) = (offsets[j], offsets[j + 1])
+            computation_time[j] += iteration_time
+            n_iter[j] = i + 1
+            inertia_history[j].append( float(np.sum(inertia[start:stop])) )
+            shift_history[j].append( float(np.sum(shifts[start:stop])) )
+            transfer_history[j].append( clusterer.transfer_bytes )
+            statistics[j] = (sums[start:stop], counts[start:stop])
+
+            if has_converged(inertia_history[j], shift_history[j], tol, inertia_tol):
+                active[j] = False
+
+        if not active.any():
+            break
+        clusterer._set_active(np.repeat(active, Ks))
+    timeline.iteration = None
+
+    # Labels are only computed once, for the final centers of all the models
+    centers = clusterer._centers()
+    labels = clusterer._labels()
+
+    return [ {  'end_center'                   : centers[offsets[j]:offsets[j + 1]],
+                'init_center'                  : initial_centers[j] ,
+                'setup_time'                   : setup_time         ,
+                'initialization_time'          : initialization_time,
+                'computation_time'             : computation_time[j],
+                'inertia_history'              : inertia_history[j] ,
+                'shift_history'                : shift_history[j]   ,
+                'host_to_device_bytes_history' : transfer_history[j],
+                'sums'                         : statistics[j][0]   ,
+                'counts'                       : statistics[j][1]   ,
+                'n_iter'                       : n_iter[j]          ,
+                'cluster_idx'                  : labels[:, j]
+             } for j in models ]
+
+class MultiKClusterer(DistributedClusterer):
+    ####
+    # Models of one method for several K fitted together on the same 
+    # resident shards, one per K of Ks. Their centers are the sum(Ks) rows
+    # of global_centroids, model after model, so each iteration reads every
+    # shard once for all the models and computes all the distances of a 
+    # block with one matmul, see stacked_statistics. Converged models keep
+    # their centers while the others go on, see multi_K_fit
+    # distributedHamerlyKMeans models run plain k-means iterations
+    ####
+    def __init__(self, method_name, shard_sizes, n_dim, Ks, dtype, GPU_names, method_params = None):
+        if shard_sizes is None:
+            raise ValueError("Models of several K are fitted together on resident shards only")
+        self.Ks = list(Ks)
+        DistributedClusterer.__init__(self, method_name, shard_sizes, n_dim, sum(self.Ks), dtype, GPU_names, 
+                                      method_params)
+
+    def _build_global_state(self):
+        # Centers of the models still iterating, the others are frozen
+        self.active_input = tf.placeholder(tf.bool, shape = (self.K, ), name = 'active_input')
+        self.active = tf.Variable(tf.ones([self.K], dtype = tf.bool), trainable = False)
+        self.set_active = self.active.assign(self.active_input)
+        self.reset_state.append( self.active.assign(tf.ones([self.K], dtype = tf.bool)) )
+
+    def _shard_statistics(self, GPU_num, X, X_sqr_norm, N):
+        return stacked_statistics(X, X_sqr_norm, self.global_centroids, self.Ks, **self.method_params)
+
+    def _build_graph(self):
+        DistributedClusterer._build_graph(self)
+
+        with tf.name_scope('global'):
+            with tf.device('/cpu:0'):
+                new_centers = centers_from_statistics(self.statistics[0], self.statistics[1], self.global_centroids)
+                new_centers = tf.where(self.active, new_centers, self.global_centroids)
+
+                # Squared distance moved by each center
+                shift = tf.cast(new_centers, ACCUMULATOR_DTYPE) - tf.cast(self.global_centroids, ACCUMULATOR_DTYPE)
+                self.centers_shifts = tf.reduce_sum(tf.square(shift), axis = 1)
+
+                with tf.control_dependencies([self.inertia, self.centers_shifts]):
+                    self.models_update = tf.group( self.global_centroids.assign(new_centers) )
+
+    def _iterate(self, batches):
+        self._count_centers_transfer()
+        [_, inertia, shifts, statistics] = self._run([self.models_update, self.inertia, self.centers_shifts,
+                                                      self.statistics])
+        return (inertia, shifts, {}, statistics)
+
+    def _set_active(self, active):
+        self.session.run(self.set_active, feed_dict = {self.active_input: active})
+
+class CPUMultiKClusterer(CPUClusterer):
+    ####
+    # Models of several K fitted together on the CPU workers, see 
+    # MultiKClusterer, the workers reduce the statistics of all the models
+    # of their shard in one 'stacked_statistics' command
+    ####
+    def __init__(self, method_name, shard_sizes, n_dim, Ks, dtype, GPU_names, method_params = None, pool = None):
+        if shard_sizes is None:
+            raise ValueError("Models of several K are fitted together on resident shards only")
+        self.Ks = list(Ks)
+        CPUClusterer.__init__(self, method_name, shard_sizes, n_dim, sum(self.Ks), dtype, GPU_names, 
+                              method_params, pool)
+
+    def _iterate(self, batches):
+        self._count_centers_transfer()
+        replies = self.pool.broadcast('stacked_statistics', self.centers, self.Ks, self.method_params,
+                                      self.timeline.enabled)
+        (sums, counts, inertia) = self._reduce(replies)
+        sums += self.prior_sums
+        counts += self.prior_counts
+
+        with self.timeline.span('global_reduction', name = 'update_centers'):
+            new_centers = cpu_backend.centers_from_statistics(sums, counts, self.centers).astype(self.dtype)
+            new_centers[~self.active] = self.centers[~self.active]
+            shifts = np.sum(np.square(new_centers.astype(cpu_backend.ACCUMULATOR_DTYPE) - self.centers), axis = 1)
+        self.centers = new_centers
+        return (inertia, shifts, {}, (sums, counts))
+
+    def _set_active(self, active):
+        self.active = np.asarray(active, dtype = bool)
+
+    def _start(self, initial_centers, prior):
+        CPUClusterer._start(self, initial_centers, prior)
+        self.active = np.ones(self.K, dtype = bool)
+
+    def _labels(self):
+        return np.concatenate(self.pool.broadcast('stacked_labels', self.centers, self.Ks))
+
+_clusterers_cache = {}
+
+# The worker processes of a set of CPU workers are kept between clusterers,
+# only the shards they hold change from one fit to the next
+_worker_pools = {}
+
+def get_worker_pool(method_name, GPU_names):
+    key = (method_name, tuple(GPU_names))
+    if key not in _worker_pools:
+        _worker_pools[key] = cpu_backend.WorkerPool(len(GPU_names), method_name)
+    return _worker_pools[key]
+
+def close_worker_pools():
+    for pool in _worker_pools.values():
+        pool.close()
+    _worker_pools.clear()
+
+def cpu_clusterer_class(method_name):
+    # Clusterer of a method on CPU workers, multi_node.py uses it with its nodes
+    if method_name == 'distributedMiniBatchKMeans':
+        return CPUMiniBatchClusterer
+    return CPUClusterer
+
+def get_clusterer(method_name, shard_sizes, n_dim, K, dtype, GPU_names, method_params = None, weighted = False):
+    # A list of K gets a clusterer fitting one model per K together
+    multi_K = isinstance(K, (list, tuple))
+    if multi_K:
+        K = tuple(K)
+
+    method_params = dict(method_params or {})
+    key = ( method_name, 
+            None if shard_sizes is None else tuple(shard_sizes),
+            n_dim, K, np.dtype(dtype).str, tuple(GPU_names),
+            tuple(sorted(method_params.items())), weighted )
+
+    if key not in _clusterers_cache:
+        if weighted and method_name == 'distributedMiniBatchKMeans':
+            raise ValueError("distributedMiniBatchKMeans samples its mini-batches uniformly, it does not take weights")
+        if multi_K and (weighted or method_name == 'distributedMiniBatchKMeans'):
+            raise ValueError("Models of several K are fitted together by full passes over unweighted points")
+
+        # Weighted points are clustered by the plain engines
+        if multi_K and cpu_backend.uses_cpu_workers(GPU_names):
+            clusterer_class = CPUMultiKClusterer
+        elif multi_K:
+            clusterer_class = MultiKClusterer
+        elif weighted and cpu_backend.uses_cpu_workers(GPU_names):
+            clusterer_class = CPUClusterer
+        elif weighted:
+            clusterer_class = DistributedClusterer
+        elif cpu_backend.uses_cpu_workers(GPU_names):
+            clusterer_class = cpu_clusterer_class(method_name)
+        elif method_name == 'distributedHamerlyKMeans' and shard_sizes is not None:
+            clusterer_class = HamerlyClusterer
+        elif method_name == 'distributedMiniBatchKMeans':
+            clusterer_class = MiniBatchClusterer
+        else:
+            clusterer_class = DistributedClusterer
+
+        if method_name == 'distributedHamerlyKMeans' and clusterer_class is not HamerlyClusterer:
+            print('distributedHamerlyKMeans keeps its bounds on resident unweighted tensorflow shards,',
+                  'this run does plain distributedKMeans iterations')
+
+        # Only the plain engines take the weighted flag
+        options = {'weighted' : True} if weighted else {}
+        if issubclass(clusterer_class, CPUClusterer):
+            options['pool'] = get_worker_pool(method_name, GPU_names)
+        _clusterers_cache[key] = clusterer_class(method_name, shard_sizes, n_dim, K, dtype, GPU_names, 
+                                                 method_params, **options)
+
+    return _clusterers_cache[key]
+
+def clear_clusterers_cache(GPU_names = None):
+    # Frees the sessions and shards of the clusterers on GPU_names, all by default
+    for key in list(_clusterers_cache.keys()):
+        if GPU_names is None or set(key[5]) & set(GPU_names):
+            _clusterers_cache.pop(key).close()
+
+def fit_clusterer(clusterer, data, K, init, seed, n_max_iters, tol, inertia_tol, model = None, weights = None,
+                  labels = True):
+    ####
+    # Loads the data on resident clusterers, computes the initial centers
+    # with its own timing and runs the iterations
+    # A model given is warm started : its centers are the initial centers
+    # and its statistics are kept in every update, see clustering_model.py
+    # weights are the ones of the points of data on weighted clusterers
+    # labels = False leaves out the labels of the points, see fit
+    ####
+    initialization_ts = time.time()
+    if not clusterer.streaming:
+        clusterer.load(data, weights)
+    load_time = float( time.time() - initialization_ts )
+
+    init_ts = time.time()
+    if model is None:
+        initial_centers = initialize_centers(init, clusterer, data, K, seed)
+    else:
+        initial_centers = model.centers
+    init_time = float( time.time() - init_ts )
+
+    end_resut = clusterer.fit(None if not clusterer.streaming else data, 
+                              initial_centers, n_max_iters, tol, inertia_tol,
+                              None if model is None else model.prior(), seed, labels)
+
+    end_resut['initialization_time'] += load_time
+    end_resut['init_time'] = init_time
     return end_resut
 
-def run_experiments(batches, GPU_names, K, initial_centers, n_max_iters, func):
-    result = []
-    setup_time = 0.0
-    initialization_time = 0.0
-    computation_time = 0.0
-
-    for batch in batches:
-        batch_run = func(batch, K, GPU_names, initial_centers, n_max_iters)
-        result.append(batch_run['end_center'])
-
-        setup_time += batch_run['setup_time']
-        initialization_time += batch_run['initialization_time']
-        computation_time += batch_run['computation_time']
-
-    final_centers = np.mean(result, axis=0)
-
-    return      {   'end_center'          : final_centers      ,
-                    'init_center'         : initial_centers    ,
-                    'setup_time'          : setup_time         ,
-                    'initialization_time' : initialization_time,
-                    'computation_time'    : computation_time   ,
-                    'n_iter'              : n_max_iters
-                }
+def distribuited_clustering(method_name, data_batch, K, GPU_names, init, n_max_iters, 
+                            tol = 0.0, inertia_tol = 0.0, seed = None, dtype = None, 
+                            method_params = None, model = None, weights = None):
+    # dtype is the precision of the shards and of the distances, the one of
+    # the data by default. With weights each point counts weight times
+    sizes = [len(arg) for arg in np.array_split( data_batch, len(GPU_names))]
+    dtype = data_batch.dtype if dtype is None else dtype
+
+    clusterer = get_clusterer(method_name, sizes, data_batch.shape[1], K, dtype, GPU_names, method_params,
+                              weights is not None)
+    return fit_clusterer(clusterer, data_batch, K, init, seed, n_max_iters, tol, inertia_tol, model, weights)
+
+def distribuited_multi_K_clustering(method_name, data_batch, Ks, GPU_names, init, n_max_iters, 
+                                    tol = 0.0, inertia_tol = 0.0, seed = None, dtype = None, 
+                                    method_params = None):
+    ####
+    # One model per K of Ks fitted together on data_batch, kept resident on
+    # the devices, every iteration is one pass over the shards for all the
+    # models, see MultiKClusterer. Returns the results of the models, in
+    # the order of Ks, the loading and the initialization are shared
+    ####
+    sizes = [len(arg) for arg in np.array_split( data_batch, len(GPU_names))]
+    dtype = data_batch.dtype if dtype is None else dtype
 
-def main(n_obs, n_dim, K, GPU_names, n_max_iters, seed , log_file, method_name, data_file):
+    clusterer = get_clusterer(method_name, sizes, data_batch.shape[1], list(Ks), dtype, GPU_names, method_params)
 
-    data = np.load(data_file)
-    X = data['X']
-    Y = data['Y']
-    initial_centers = X[0:K, :]
+    initialization_ts = time.time()
+    clusterer.load(data_batch)
+    load_time = float( time.time() - initialization_ts )
+
+    init_ts = time.time()
+    initial_centers = initialize_multi_K(init, clusterer, data_batch, Ks, seed)
+    init_time = float( time.time() - init_ts )
+
+    results = multi_K_fit(clusterer, initial_centers, n_max_iters, tol, inertia_tol)
+    for end_resut in results:
+        end_resut['initialization_time'] += load_time
+        end_resut['init_time'] = init_time
+    return results
+
+def distribuited_fuzzy_C_means(data_batch, K, GPU_names, init, n_max_iters, 
+                               tol = 0.0, inertia_tol = 0.0, seed = None, dtype = None, 
+                               fuzzifier = DEFAULT_FUZZIFIER):
+    return distribuited_clustering('distributedFuzzyCMeans', data_batch, K, GPU_names, 
+                                   init, n_max_iters, tol, inertia_tol, seed, dtype,
+                                   clustering_params('distributedFuzzyCMeans', fuzzifier))
+
+def distribuited_k_means(data_batch, K, GPU_names, init, n_max_iters, 
+                         tol = 0.0, inertia_tol = 0.0, seed = None, dtype = None):
+    return distribuited_clustering('distributedKMeans', data_batch, K, GPU_names, 
+                                   init, n_max_iters, tol, inertia_tol, seed, dtype)
+
+def distribuited_streaming_clustering(batches, K, GPU_names, init, n_max_iters, method_name,
+                                      tol = 0.0, inertia_tol = 0.0, seed = None, dtype = None, 
+                                      method_params = None, model = None):
+    ####
+    # Out-of-core version of the clustering methods
+    # Each iteration is one full pass over all batches, the per cluster sums 
+    # and counts of every batch are accumulated on the CPU and the centers 
+    # are updated once per pass. The result does not depend on the number 
+    # of batches and only one batch needs to be on the devices at a time
+    ####
+    (_, M) = batches[0].shape
+    dtype = batches[0].dtype if dtype is None else dtype
+
+    clusterer = get_clusterer(method_name, None, M, K, dtype, GPU_names, method_params)
+    return fit_clusterer(clusterer, batches, K, init, seed, n_max_iters, tol, inertia_tol, model)
+
+def run_experiments(batches, GPU_names, K, init, n_max_iters, method_name, 
+                    tol = 0.0, inertia_tol = 0.0, seed = None, dtype = None, method_params = None,
+                    model = None, weights = None):
+    # A list of K is fitted together when the data fits on the devices, and
+    # one K after the other otherwise, giving one result per K either way
+    if isinstance(K, (list, tuple)):
+        if len(batches) == 1:
+            return distribuited_multi_K_clustering(method_name, batches[0], K, GPU_names, init, n_max_iters, 
+                                                   tol, inertia_tol, seed, dtype, method_params)
+        print('the models of K =', list(K), 'do not fit on the devices together, they are fitted one by one')
+        return [ run_experiments(batches, GPU_names, K_value, init, n_max_iters, method_name, tol, inertia_tol,
+                                 seed, dtype, method_params) for K_value in K ]
+
+    # A single batch stays resident on the devices for all iterations
+    if len(batches) == 1:
+        return distribuited_clustering(method_name, batches[0], K, GPU_names, 
+                                       init, n_max_iters, tol, inertia_tol, seed, dtype, 
+                                       method_params, model, weights)
+
+    # Weighted points, a coreset, must fit on the devices
+    if weights is not None:
+        raise ValueError("The coreset does not fit on the devices, it needs " + str(len(batches)) + " batches")
+
+    # Otherwise every iteration streams all batches through the devices
+    return distribuited_streaming_clustering(batches          = batches        ,
+                                             K                = K              ,
+                                             GPU_names        = GPU_names      ,
+                                             init             = init           ,
+                                             n_max_iters      = n_max_iters    ,
+                                             method_name      = method_name    ,
+                                             tol              = tol            ,
+                                             inertia_tol      = inertia_tol    ,
+                                             seed             = seed           ,
+                                             dtype            = dtype          ,
+                                             method_params    = method_params  ,
+                                             model            = model          )
+
+def failed_run(exc_name, n_max_iters):
+    # Result and plan logged for runs that raised exc_name
+    run_result = {  'end_center'           : exc_name     ,
+                    'init_center'          : exc_name     ,
+                    'setup_time'           : exc_name     ,
+                    'initialization_time'  : exc_name     ,
+                    'init_time'            : exc_name     ,
+                    'computation_time'     : exc_name     ,
+                    'skipped_fraction'     : exc_name     ,
+                    'data_passes'          : exc_name     ,
+                    'host_to_device_bytes' : exc_name     ,
+                    'n_iter'               : n_max_iters
+                 }
+
+    plan = {        'num_batches'          : exc_name     ,
+                    'batch_size'           : exc_name     ,
+                    'shard_size'           : exc_name     ,
+                    'estimated_peak_MB'    : exc_name
+           }
+
+    return (run_result, plan)
+
+def main(n_obs, n_dim, K, GPU_names, n_max_iters, seed , log_file, method_name, data_file,
+         tol = 0.0, inertia_tol = 0.0, device_memory = None, init = 'k-means||', dtype = None,
+         fuzzifier = DEFAULT_FUZZIFIER, init_from = None, save_model = None, X = None, timeline = None,
+         mini_batch_size = DEFAULT_MINI_BATCH_SIZE, full_pass_every = DEFAULT_FULL_PASS_EVERY,
+         coreset_size = None):
+
+    # Checked before the fit, a model file that can not be saved would fail the run after it
+    if save_model is not None and os.path.splitext(save_model)[1] != MODEL_EXTENSION:
+        raise ValueError("Models are saved as " + MODEL_EXTENSION + " files")
+
+    # X is memory-mapped, batches are only read from disk when they are used
+    # sweep_runner.py loads it once and gives it for all its runs. The run
+    # is on the first n_obs rows of data_file, as the runs of a sweep
+    if X is None:
+        X = load_dataset(data_file, n_obs)
     return_status = 0
 
-    num_batches = 1
+    # Precision of the shards and of the distances, the one of X by default
+    dtype = X.dtype if dtype is None else np.dtype(dtype)
+    method_params = clustering_params(method_name, fuzzifier, mini_batch_size, full_pass_every)
+
+    # K can be a list, its models are fitted together and logged as one run
+    # per K, with the list in shared_K, see MultiKClusterer
+    Ks = list(K) if isinstance(K, (list, tuple)) else [K]
+    shared_K = ' '.join(str(K_value) for K_value in Ks) if isinstance(K, (list, tuple)) else ''
+    if shared_K and (init_from is not None or save_model is not None or coreset_size is not None):
+        raise ValueError("Models of several K are fitted from scratch on the data, without a model or a coreset")
+
+    # A model given with init_from is updated with X, starting from its
+    # centers and keeping the statistics of the data it was fitted on
+    model = None
+    if init_from is not None:
+        model = load_model(init_from)
+        if (model.method_name, model.K, model.n_dim) != (method_name, K, X.shape[1]):
+            raise ValueError("Model " + init_from + " is a " + model.method_name + " model with K = " + 
+                             str(model.K) + " and " + str(model.n_dim) + " dimensions")
+        method_params = model.method_params
+        init = init_from
+
+    # Per device memory budget, given in MB or detected from the devices
+    if device_memory is None:
+        device_budget = get_device_budget(GPU_names)
+    else:
+        device_budget = int(device_memory * 1024 * 1024)
+
+    backend = 'cpu_workers' if cpu_backend.uses_cpu_workers(GPU_names) else 'tensorflow'
+
+    # With coreset_size the method is fitted on a weighted coreset of X, see
+    # coreset.py, built and evaluated on the full data by one CPU worker per
+    # device (the CPU workers themselves on the cpu_workers backend)
+    coreset = None
+    coreset_report = {'coreset_time' : '', 'full_inertia' : '', 'coreset_error' : ''}
+
+    # With a .db log file the run is recorded in a ledger, as running until it ends
+    ledger = None
+    if is_ledger(log_file):
+        ledger = Ledger(log_file, LOG_COLUMNS)
+        run_ids = [ ledger.start_run({ 'method_name'     : method_name                              ,
+                                       'seed'            : seed                                     ,
+                                       'num_GPUs'        : len(GPU_names)                           ,
+                                       'K'               : K_value                                  ,
+                                       'n_obs'           : n_obs                                    ,
+                                       'n_dim'           : n_dim                                    ,
+                                       'init'            : init                                     ,
+                                       'backend'         : backend                                  ,
+                                       'dtype'           : dtype.name                               ,
+                                       'fuzzifier'       : method_params.get('fuzzifier', '')       ,
+                                       'mini_batch_size' : method_params.get('mini_batch_size', '') ,
+                                       'full_pass_every' : method_params.get('full_pass_every', '') ,
+                                       'coreset_size'    : '' if coreset_size is None else coreset_size,
+                                       'shared_K'        : shared_K                                 ,
+                                       'n_max_iters'     : int(n_max_iters)                         ,
+                                       'tol'             : float(tol)                               ,
+                                       'inertia_tol'     : float(inertia_tol)                        })
+                    for K_value in Ks ]
+    error = None
+
+    attempt = 0
     finished = False
 
     while not finished:
-        tf.reset_default_graph()
-
-        # Batching data
-        batches = np.array_split(X, num_batches)
-        print(num_batches)
+        attempt += 1
 
         # Running methods
         try:
-            if method_name == 'distributedKMeans':
+            # The coreset is built once, the attempts with smaller plans reuse it
+            if coreset_size is not None and coreset is None:
+                coreset_ts = time.time()
+                coreset = build_coreset(get_worker_pool(method_name, GPU_names), worker_dataset(data_file),
+                                        X.shape[0], coreset_size, seed)
+                coreset_report['coreset_time'] = float( time.time() - coreset_ts )
+            data = X if coreset is None else coreset[0]
+
+            # Batching data with the sizes chosen by the planner
+            plan = plan_batches(method_name   = method_name          ,
+                                n_obs         = data.shape[0]        ,
+                                n_dim         = X.shape[1]           ,
+                                K             = sum(Ks)              ,
+                                dtype         = dtype                ,
+                                n_workers     = len(GPU_names)       ,
+                                device_budget = device_budget        ,
+                                host_budget   = available_host_memory())
+            print(format_plan(plan))
+
+            batches = np.array_split(data, plan['num_batches'])
+
+            # With a timeline prefix the phases of every iteration are recorded
+            run_timeline = NULL_TIMELINE if timeline is None else Timeline()
+            with recording(run_timeline):
                 run_result = run_experiments(batches            = batches, 
                                              GPU_names          = GPU_names, 
                                              K                  = K, 
-                                             initial_centers    = initial_centers, 
+                                             init               = init, 
                                              n_max_iters        = n_max_iters, 
-                                             func               = distribuited_k_means)
-
-            if method_name == 'distributedFuzzyCMeans':
-                run_result = run_experiments(batches            = batches, 
-                                             GPU_names          = GPU_names, 
-                                             K                  = K, 
-                                             initial_centers    = initial_centers, 
-                                             n_max_iters        = n_max_iters, 
-                                             func               = distribuited_fuzzy_C_means)
+                                             method_name        = method_name,
+                                             tol                = tol, 
+                                             inertia_tol        = inertia_tol,
+                                             seed               = seed,
+                                             dtype              = dtype,
+                                             method_params      = method_params,
+                                             model              = model,
+                                             weights            = None if coreset is None else coreset[1])
+
+            # Quality of the centers fitted on the coreset : their objective on
+            # the full data, and the relative error of its coreset estimate
+            if coreset is not None:
+                centers = np.asarray(run_result['end_center'], dtype = dtype)
+                full_objective = full_inertia(get_worker_pool(method_name, GPU_names), worker_dataset(data_file),
+                                              X.shape[0], centers, method_params)
+                points = np.asarray(coreset[0], dtype = dtype)
+                coreset_objective = cpu_backend.STATISTICS_FUNCS[method_name](
+                    points, cpu_backend.squared_norms(points), centers, K, weights = coreset[1], **method_params)[2]
+
+                coreset_report['full_inertia'] = full_objective
+                coreset_report['coreset_error'] = float(coreset_objective) / full_objective - 1.0
+                print('coreset of', len(points), 'points : inertia', full_objective, 'on the full data,', 
+                      'estimated with a relative error of', coreset_report['coreset_error'])
+
+            if timeline is not None:
+                print('timeline saved to', ' and '.join(run_timeline.save(timeline)))
 
             finished = True
-        except tf.errors.ResourceExhaustedError:
-            print("caught ResourceExhaustedError")
-            num_batches = num_batches*2
-            continue
+        except (tf.errors.ResourceExhaustedError, MemoryError) as e:
+            print("caught " + type(e).__name__ + ", the memory plan underestimated the peak")
+            clear_clusterers_cache(GPU_names)
+            device_budget = device_budget // 2
+            if attempt < MAX_PLAN_ATTEMPTS:
+                continue
+
+            error = type(e).__name__
+            (run_result, plan) = failed_run(error, n_max_iters)
+            finished = True
 
         except:
             exc_type, exc_value, exc_tb = sys.exc_info()
             print(traceback.print_tb(exc_tb))
             exc_name = exc_type.__name__
 
-            run_result = {  'end_center'          : exc_name     ,
-                            'init_center'         : exc_name     ,
-                            'setup_time'          : exc_name     ,
-                            'initialization_time' : exc_name     ,
-                            'computation_time'    : exc_name     ,
-                            'n_iter'              : n_max_iters
-
-                         }
+            error = exc_name
+            (run_result, plan) = failed_run(exc_name, n_max_iters)
 
             return_status =  1 if exc_name == 'ValueError' else 0
             finished = True
 
-    data_to_append = {  'method_name'          : method_name                      ,
-                        'seed'                 : seed                             ,
-                        'num_GPUs'             : len(GPU_names)                   ,
-                        'K'                    : K                                ,
-                        'n_obs'                : n_obs                            ,
-                        'n_dim'                : n_dim                            ,
-                        'setup_time'           : run_result['setup_time']         ,
-                        'initialization_time'  : run_result['initialization_time'],
-                        'computation_time'     : run_result['computation_time']   ,
-                        'n_iter'               : run_result['n_iter']               
-                     }
-
-    str_to_write = ','.join([ str( data_to_append['method_name'] ),
-                              str( data_to_append['seed'] ),
-                              str( data_to_append['num_GPUs'] ),
-                              str( data_to_append['K'] ),
-                              str( data_to_append['n_obs'] ),
-                              str( data_to_append['n_dim'] ),
-                              str( data_to_append['setup_time'] ),
-                              str( data_to_append['initialization_time'] ),
-                              str( data_to_append['computation_time'] ),
-                              str( data_to_append['n_iter'] ) ])
-
-    str_to_write = str(str_to_write) + '\n'
-
-    with open(log_file, 'a') as f:
-        f.write(str_to_write)
+    # Failed coreset runs have no full data inertia
+    if coreset_size is not None and error is not None:
+        coreset_report.update(full_inertia = error, coreset_error = error)
+
+    # Several K fitted together give one result per K, a failed run the same failure for all
+    run_results = run_result if isinstance(run_result, list) else [run_result] * len(Ks)
+
+    for (run_num, (K_value, run_result)) in enumerate(zip(Ks, run_results)):
+        # Mean fraction of the distances skipped per iteration, only the 
+        # resident Hamerly engine skips any
+        if 'skipped_fraction_history' in run_result:
+            skipped_fraction = float(np.mean(run_result['skipped_fraction_history']))
+        else:
+            skipped_fraction = run_result.get('skipped_fraction', '')
+
+        # Rows read by the iterations, in passes over the data, the mini-batch
+        # engines report theirs and the other methods read all of them each time
+        # Coreset runs read the data once to build the coreset, and then the
+        # coreset on each iteration
+        if 'rows_touched_history' in run_result:
+            data_passes = float(np.sum(run_result['rows_touched_history'])) / X.shape[0]
+        elif coreset is not None and error is None:
+            data_passes = 1.0 + float(run_result['n_iter']) * len(coreset[0]) / X.shape[0]
+        else:
+            data_passes = run_result.get('data_passes', run_result['n_iter'])
+
+        # Mean bytes sent from the host to the devices per iteration, the 
+        # centers only when the data is resident
+        if 'host_to_device_bytes_history' in run_result:
+            host_to_device_bytes = float(np.mean(run_result['host_to_device_bytes_history']))
+        else:
+            host_to_device_bytes = run_result.get('host_to_device_bytes', '')
+
+        # The model saved holds the statistics of X and of the model it started from
+        if save_model is not None and 'sums' in run_result:
+            if model is None:
+                model = empty_model(method_name, K_value, X.shape[1], method_params)
+            model.updated(run_result, X.shape[0]).save(save_model)
+            print('model saved to', save_model)
+
+        data_to_append = {  'method_name'          : method_name                      ,
+                            'seed'                 : seed                             ,
+                            'num_GPUs'             : len(GPU_names)                   ,
+                            'K'                    : K_value                          ,
+                            'n_obs'                : n_obs                            ,
+                            'n_dim'                : n_dim                            ,
+                            'setup_time'           : run_result['setup_time']         ,
+                            'initialization_time'  : run_result['initialization_time'],
+                            'computation_time'     : run_result['computation_time']   ,
+                            'n_iter'               : run_result['n_iter']             ,
+                            'num_batches'          : plan['num_batches']              ,
+                            'batch_size'           : plan['batch_size']               ,
+                            'shard_size'           : plan['shard_size']               ,
+                            'estimated_peak_MB'    : plan['estimated_peak_MB']        ,
+                            'init'                 : init                             ,
+                            'init_time'            : run_result['init_time']          ,
+                            'skipped_fraction'     : skipped_fraction                 ,
+                            'backend'              : backend                          ,
+                            'dtype'                : dtype.name                       ,
+                            'fuzzifier'            : method_params.get('fuzzifier', '')      ,
+                            'mini_batch_size'      : method_params.get('mini_batch_size', ''),
+                            'full_pass_every'      : method_params.get('full_pass_every', ''),
+                            'data_passes'          : data_passes                      ,
+                            'coreset_size'         : '' if coreset_size is None else coreset_size,
+                            'coreset_time'         : coreset_report['coreset_time']   ,
+                            'full_inertia'         : coreset_report['full_inertia']   ,
+                            'coreset_error'        : coreset_report['coreset_error']  ,
+                            'shared_K'             : shared_K                         ,
+                            'host_to_device_bytes' : host_to_device_bytes             ,
+                            'n_max_iters'          : int(n_max_iters)                 ,
+                            'tol'                  : float(tol)                       ,
+                            'inertia_tol'          : float(inertia_tol)
+                         }
+
+        if ledger is None:
+            append_to_log(log_file, data_to_append)
+        else:
+            iterations = dict( (name[0:-len('_history')], history) for (name, history) in run_result.items()
+                               if name.endswith('_history') )
+            ledger.finish_run(run_ids[run_num], data_to_append, iterations, error)
 
     print('log_file =', log_file)
 
@@ -429,16 +2093,27 @@ if __name__ == "__main__":
                         dest     = "K"                                    ,
                         required = True                                   ,
                         metavar  = "int"                                  ,
-                        type     = lambda x: make_valid_int(parser, x)    ,
-                        help     = "Number of K Centers for the Test !!!" )
+                        type     = lambda x: make_valid_K(parser, x)      ,
+                        help     = "Number of K Centers for the Test, " +
+                        "several separated by commas are fitted together !!!" )
 
     parser.add_argument("--n_GPUs"                                                ,
                         dest     = "GPU_names"                                    ,
-                        required = True                                           ,
+                        required = False                                          ,
+                        default  = []                                             ,
                         metavar  = "int"                                          ,
                         type     = lambda x: parse_valid_gpus_names(parser, x)    ,
                         help     = "Number of GPUs !!!" )
 
+    parser.add_argument("--n_workers"                                             ,
+                        dest     = "n_workers"                                    ,
+                        required = False                                          ,
+                        default  = 0                                              ,
+                        metavar  = "int"                                          ,
+                        type     = lambda x: make_valid_int(parser, x)            ,
+                        help     = "Number of CPU worker processes, used " +
+                        "instead of GPUs !!!" )
+
     parser.add_argument("--n_max_iters"                                           ,
                         dest     = "n_max_iters"                                  ,
                         required = True                                           ,
@@ -458,7 +2133,8 @@ if __name__ == "__main__":
                         required = True                                    ,
                         metavar  = "FILE"                                  ,
                         type     = lambda x: is_valid_file(parser, x)      ,
-                        help     = "log_file Name, this would be a CSV !!!" )
+                        help     = "log_file Name, a CSV, or a .db ledger " +
+                        "recording the status and iterations of the runs !!!" )
 
     parser.add_argument("--method_name"                                                   ,
                         dest     = "method_name"                                          ,
@@ -466,26 +2142,166 @@ if __name__ == "__main__":
                         metavar  = "str"                                                  ,
                         type     = lambda x: make_valid_method(parser, x)                 ,
                         help     = "Method Name Can Be :" + 
-                        "distribuitedKMeans or distribuitedFuzzyCMeans !!!" )
+                        "distributedKMeans, distributedFuzzyCMeans, " +
+                        "distributedHamerlyKMeans or distributedMiniBatchKMeans !!!" )
 
     parser.add_argument("--data_file"                                                     ,
                         dest     = "data_file"                                            ,
                         required = True                                                   ,
                         metavar  = "str"                                                  ,
                         type     = lambda x: check_file_exists(parser, x)                 ,
-                        help     = "Unable to find data file !!!" )
+                        help     = "Data file, .npy or .bin are memory-mapped !!!" )
+
+    parser.add_argument("--tol"                                                       ,
+                        dest     = "tol"                                              ,
+                        required = False                                              ,
+                        default  = 0.0                                                ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_float(parser, x)              ,
+                        help     = "Stops when the total squared center shift is " +
+                        "below this value !!!" )
+
+    parser.add_argument("--inertia_tol"                                               ,
+                        dest     = "inertia_tol"                                      ,
+                        required = False                                              ,
+                        default  = 0.0                                                ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_float(parser, x)              ,
+                        help     = "Stops when the relative change of the inertia " +
+                        "is below this value, 0 disables it, except for " +
+                        "distributedMiniBatchKMeans which then stops at " +
+                        str(DEFAULT_MINI_BATCH_INERTIA_TOL) + " !!!" )
+
+    parser.add_argument("--device_memory"                                             ,
+                        dest     = "device_memory"                                    ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_float(parser, x)              ,
+                        help     = "Memory budget per device in MB, detected from " +
+                        "the devices when not given !!!" )
+
+    parser.add_argument("--init"                                                      ,
+                        dest     = "init"                                             ,
+                        required = False                                              ,
+                        default  = 'k-means||'                                        ,
+                        metavar  = "str"                                              ,
+                        type     = lambda x: make_valid_init(parser, x)               ,
+                        help     = "Initialization, k-means|| or random, or a .npy " +
+                        "or CSV file with the K initial centers !!!" )
+
+    parser.add_argument("--dtype"                                                     ,
+                        dest     = "dtype"                                            ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "str"                                              ,
+                        type     = lambda x: make_valid_dtype(parser, x)              ,
+                        help     = "Precision of the shards and the distances, " +
+                        "float32 or float64, the one of the dataset by default !!!" )
+
+    parser.add_argument("--fuzzifier"                                                 ,
+                        dest     = "fuzzifier"                                        ,
+                        required = False                                              ,
+                        default  = DEFAULT_FUZZIFIER                                  ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_fuzzifier(parser, x)          ,
+                        help     = "Fuzzifier m of distributedFuzzyCMeans, " +
+                        "greater than 1 !!!" )
+
+    parser.add_argument("--mini_batch_size"                                           ,
+                        dest     = "mini_batch_size"                                  ,
+                        required = False                                              ,
+                        default  = DEFAULT_MINI_BATCH_SIZE                            ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Rows of each step of distributedMiniBatchKMeans, " +
+                        "drawn over all the devices !!!" )
+
+    parser.add_argument("--full_pass_every"                                           ,
+                        dest     = "full_pass_every"                                  ,
+                        required = False                                              ,
+                        default  = DEFAULT_FULL_PASS_EVERY                            ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Iterations of distributedMiniBatchKMeans, " +
+                        "one mini-batch step each, between two full passes " +
+                        "measuring the inertia and testing the convergence !!!" )
+
+    parser.add_argument("--coreset_size"                                              ,
+                        dest     = "coreset_size"                                     ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Fits on a weighted coreset of this many points " +
+                        "of the data, and logs the inertia of the centers on the " +
+                        "full data !!!" )
+
+    parser.add_argument("--init_from"                                                 ,
+                        dest     = "init_from"                                        ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "FILE"                                             ,
+                        type     = lambda x: check_file_exists(parser, x)             ,
+                        help     = "Model saved by --save_model to update with " +
+                        "the data, instead of clustering from scratch !!!" )
+
+    parser.add_argument("--save_model"                                                ,
+                        dest     = "save_model"                                       ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "FILE"                                             ,
+                        type     = lambda x: make_valid_model_file(parser, x)         ,
+                        help     = "Saves the centers, counts and sums of the " +
+                        "fit to this .npz file !!!" )
+
+    parser.add_argument("--timeline"                                                  ,
+                        dest     = "timeline"                                         ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "PREFIX"                                           ,
+                        help     = "Records the phases of every iteration and " +
+                        "saves them to PREFIX.json (Chrome trace) and PREFIX.csv !!!" )
 
     args = parser.parse_args()
 
-    status = main(n_obs       = args.n_obs      ,
-                  n_dim       = args.n_dim      ,
-                  K           = args.K          ,
-                  GPU_names   = args.GPU_names  ,
-                  n_max_iters = args.n_max_iters,
-                  seed        = args.seed       ,
-                  log_file    = args.log_file   ,
-                  method_name = args.method_name,
-                  data_file   = args.data_file )
+    # CPU worker processes take the place of the GPUs
+    if args.n_workers < 0:
+        parser.error("Number of Workers Given is Negative")
+    if args.n_workers > 0 and len(args.GPU_names) > 0:
+        parser.error("Use Either --n_GPUs or --n_workers")
+    if args.n_workers > 0:
+        args.GPU_names = cpu_backend.cpu_worker_names(args.n_workers)
+    if len(args.GPU_names) == 0:
+        parser.error("Give a Positive --n_GPUs or --n_workers")
+    if args.coreset_size is not None and args.method_name == 'distributedMiniBatchKMeans':
+        parser.error("distributedMiniBatchKMeans Does Not Take a --coreset_size")
+    if isinstance(args.K, list) and args.method_name == 'distributedMiniBatchKMeans':
+        parser.error("distributedMiniBatchKMeans Does Not Take Several --K")
+    if isinstance(args.K, list) and (args.init_from or args.save_model or args.coreset_size):
+        parser.error("Several --K Do Not Take --init_from, --save_model or --coreset_size")
+
+    status = main(n_obs           = args.n_obs          ,
+                  n_dim           = args.n_dim          ,
+                  K               = args.K              ,
+                  GPU_names       = args.GPU_names      ,
+                  n_max_iters     = args.n_max_iters    ,
+                  seed            = args.seed           ,
+                  log_file        = args.log_file       ,
+                  method_name     = args.method_name    ,
+                  data_file       = args.data_file      ,
+                  tol             = args.tol            ,
+                  inertia_tol     = args.inertia_tol    ,
+                  device_memory   = args.device_memory  ,
+                  init            = args.init           ,
+                  dtype           = args.dtype          ,
+                  fuzzifier       = args.fuzzifier      ,
+                  init_from       = args.init_from      ,
+                  save_model      = args.save_model     ,
+                  timeline        = args.timeline       ,
+                  mini_batch_size = args.mini_batch_size,
+                  full_pass_every = args.full_pass_every,
+                  coreset_size    = args.coreset_size   )
 
 
     sys.exit(status)
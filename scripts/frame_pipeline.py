@@ -0,0 +1,442 @@
+import argparse
+import glob
+import os
+import queue
+import re
+import sys
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from predict import label_dtype
+from distribuitedClustering import (get_clusterer, fit_clusterer, clustering_params, clear_clusterers_cache,
+                                    close_worker_pools, make_valid_int, make_valid_float, make_valid_method,
+                                    make_valid_dtype, make_valid_init, make_valid_fuzzifier,
+                                    make_valid_positive_int, parse_valid_gpus_names, DEFAULT_FUZZIFIER)
+import cpu_backend
+
+####
+# Segmentation of the frames of a video, or of a sequence of images such as
+# img_vid01_*.tif, by clustering the pixels of every frame
+# => the frames are decoded and converted to float by a pool of threads,
+#    a few frames ahead of the one being clustered
+# => frames of the same size share one clusterer, its graph is built once
+#    and every frame only loads its pixels, see get_clusterer
+# => the first frame is initialized with init and runs all its
+#    iterations, every other frame starts from the centers of the previous
+#    one and stops once its inertia stops improving, so it converges in a
+#    few iterations instead of running k-means|| and all the iterations again
+# => the label maps, one H x W .npy per frame, are written by a background
+#    thread while the next frames are clustered
+# The sustained frames per second leave out the first frame, which builds
+# the graph and runs the initialization
+####
+LOG_COLUMNS = [ 'frames', 'n_frames', 'height', 'width', 'K', 'method_name', 'num_devices', 'backend',
+                'dtype', 'n_decoders', 'first_frame_time', 'total_time', 'fps', 'sustained_fps',
+                'first_frame_iters', 'mean_iters' ]
+
+VIDEO_EXTENSIONS = ['.avi', '.mp4', '.mov', '.mkv']
+
+# A warm started frame stops as soon as its inertia stops improving, the
+# first frame does not, a poor start there would be kept by all the frames
+DEFAULT_INERTIA_TOL = 1e-4
+
+# Frames decoded ahead of the one being clustered, per decoding thread
+FRAMES_AHEAD = 2
+
+def import_cv2():
+    # OpenCV is only needed to read images and videos, not .npy frames
+    try:
+        import cv2
+    except ImportError:
+        raise ImportError("Reading images and videos needs OpenCV, pip install opencv-python")
+    return cv2
+
+def natural_key(path):
+    # img_vid01_10.tif comes after img_vid01_9.tif
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+def frame_files(frames):
+    files = sorted(glob.glob(frames), key = natural_key)
+    if len(files) == 0:
+        raise ValueError("No frames match " + frames)
+    return files
+
+def is_video(frames):
+    return os.path.splitext(frames)[1].lower() in VIDEO_EXTENSIONS
+
+def frame_pixels(name, image, dtype):
+    # (name, shape of the frame, one row of channels per pixel in dtype)
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    return (name, image.shape[0:2], np.asarray(image.reshape((-1, image.shape[2])), dtype = dtype))
+
+def read_frame(path, dtype):
+    # Images are read in RGB, .npy frames are H x W x C or H x W arrays
+    if os.path.splitext(path)[1] == '.npy':
+        image = np.load(path)
+    else:
+        cv2 = import_cv2()
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Can not read the image " + path)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return frame_pixels(os.path.splitext(os.path.basename(path))[0], image, dtype)
+
+def decoded_image_frames(files, dtype, n_decoders):
+    ####
+    # Frames of files in order, decoded by n_decoders threads, at most
+    # FRAMES_AHEAD * n_decoders frames are decoded ahead of the consumer
+    ####
+    with ThreadPoolExecutor(n_decoders) as decoders:
+        pending = deque()
+        next_file = 0
+        while next_file < len(files) or pending:
+            while next_file < len(files) and len(pending) < FRAMES_AHEAD * n_decoders:
+                pending.append( decoders.submit(read_frame, files[next_file], dtype) )
+                next_file += 1
+            yield pending.popleft().result()
+
+def decoded_video_frames(video_file, dtype):
+    ####
+    # Frames of a video, decoded in order by one background thread, the
+    # decoder of a video stream can not be split between threads
+    ####
+    cv2 = import_cv2()
+    frames = queue.Queue(maxsize = FRAMES_AHEAD)
+    stop = threading.Event()
+
+    def decode():
+        capture = cv2.VideoCapture(video_file)
+        try:
+            frame_num = 0
+            while not stop.is_set():
+                (ok, image) = capture.read()
+                if not ok:
+                    break
+                frames.put( frame_pixels('frame_%06d' % frame_num, cv2.cvtColor(image, cv2.COLOR_BGR2RGB), dtype) )
+                frame_num += 1
+        finally:
+            capture.release()
+            frames.put(None)
+
+    decoder = threading.Thread(target = decode, daemon = True)
+    decoder.start()
+    try:
+        while True:
+            frame = frames.get()
+            if frame is None:
+                return
+            yield frame
+    finally:
+        # The consumer stopped early, the decoder is unblocked and stops
+        stop.set()
+        while decoder.is_alive():
+            try:
+                frames.get_nowait()
+            except queue.Empty:
+                decoder.join(0.1)
+
+def decoded_frames(frames, dtype, n_decoders, max_frames = None):
+    if is_video(frames):
+        source = decoded_video_frames(frames, dtype)
+    else:
+        files = frame_files(frames)
+        source = decoded_image_frames(files if max_frames is None else files[0:max_frames], dtype, n_decoders)
+
+    for (frame_num, frame) in enumerate(source):
+        if max_frames is not None and frame_num >= max_frames:
+            source.close()
+            return
+        yield frame
+
+def write_labels(output_file, labels, shape, K):
+    np.save(output_file, labels.reshape(shape).astype(label_dtype(K)))
+
+def append_to_log(log_file, data_to_append):
+    if not os.path.exists(log_file):
+        with open(log_file, 'w') as f:
+            f.write(','.join(LOG_COLUMNS) + '\n')
+
+    with open(log_file, 'a') as f:
+        f.write(','.join([ str( data_to_append[column] ) for column in LOG_COLUMNS ]) + '\n')
+
+def segment_frames(frames, output_dir, K, GPU_names, method_name, n_max_iters, seed, init = 'k-means||',
+                   tol = 0.0, inertia_tol = DEFAULT_INERTIA_TOL, dtype = 'float32',
+                   fuzzifier = DEFAULT_FUZZIFIER, n_decoders = None, max_frames = None):
+    ####
+    # Clusters the pixels of every frame of frames, a glob pattern of
+    # images or .npy frames, or a video file, and writes the label map of
+    # each frame to output_dir/<frame>_labels.npy
+    # Returns the per frame results and the timings of the pipeline
+    ####
+    n_decoders = (os.cpu_count() or 1) if n_decoders is None else n_decoders
+    method_params = clustering_params(method_name, fuzzifier)
+    os.makedirs(output_dir, exist_ok = True)
+
+    start_time = time.time()
+    first_frame_done = None
+    centers = None
+    frame_results = []
+
+    with ThreadPoolExecutor(1) as writer:
+        writes = []
+        for (name, shape, pixels) in decoded_frames(frames, dtype, n_decoders, max_frames):
+            frame_ts = time.time()
+
+            # Same sized frames get the same cached clusterer
+            sizes = [len(shard) for shard in np.array_split(pixels, len(GPU_names))]
+            clusterer = get_clusterer(method_name, sizes, pixels.shape[1], K, dtype, GPU_names, method_params)
+
+            run_result = fit_clusterer(clusterer   = clusterer                           ,
+                                       data        = pixels                              ,
+                                       K           = K                                   ,
+                                       init        = init if centers is None else centers,
+                                       seed        = seed                                ,
+                                       n_max_iters = n_max_iters                         ,
+                                       tol         = tol                                 ,
+                                       inertia_tol = 0.0 if centers is None else inertia_tol )
+            centers = run_result['end_center']
+
+            writes.append( writer.submit(write_labels, os.path.join(output_dir, name + '_labels.npy'),
+                                         run_result['cluster_idx'], shape, K) )
+
+            frame_results.append( { 'frame'   : name                                     ,
+                                    'shape'   : shape                                    ,
+                                    'centers' : centers                                  ,
+                                    'n_iter'  : run_result['n_iter']                     ,
+                                    'inertia' : run_result['inertia_history'][-1]        ,
+                                    'time'    : float( time.time() - frame_ts )          } )
+            if first_frame_done is None:
+                first_frame_done = time.time()
+
+        # Every label map is on disk before the time is taken
+        for write in writes:
+            write.result()
+
+    if len(frame_results) == 0:
+        raise ValueError("No frames in " + frames)
+
+    total_time = float( time.time() - start_time )
+    n_frames = len(frame_results)
+    sustained_time = time.time() - first_frame_done
+
+    return {'frame_results'     : frame_results                                               ,
+            'n_frames'          : n_frames                                                    ,
+            'height'            : frame_results[0]['shape'][0]                                ,
+            'width'             : frame_results[0]['shape'][1]                                ,
+            'n_decoders'        : n_decoders                                                  ,
+            'first_frame_time'  : float( first_frame_done - start_time )                      ,
+            'total_time'        : total_time                                                  ,
+            'fps'               : n_frames / total_time                                       ,
+            'sustained_fps'     : (n_frames - 1) / sustained_time if n_frames > 1 else ''     ,
+            'first_frame_iters' : frame_results[0]['n_iter']                                  ,
+            'mean_iters'        : float( np.mean([result['n_iter'] for result in frame_results]) ) }
+
+def main(frames, output_dir, K, GPU_names, method_name, n_max_iters, seed, init = 'k-means||', tol = 0.0,
+         inertia_tol = DEFAULT_INERTIA_TOL, dtype = 'float32', fuzzifier = DEFAULT_FUZZIFIER, n_decoders = None,
+         max_frames = None, log_file = None):
+    try:
+        result = segment_frames(frames      = frames       ,
+                                output_dir  = output_dir   ,
+                                K           = K            ,
+                                GPU_names   = GPU_names    ,
+                                method_name = method_name  ,
+                                n_max_iters = n_max_iters  ,
+                                seed        = seed         ,
+                                init        = init         ,
+                                tol         = tol          ,
+                                inertia_tol = inertia_tol  ,
+                                dtype       = dtype        ,
+                                fuzzifier   = fuzzifier    ,
+                                n_decoders  = n_decoders   ,
+                                max_frames  = max_frames   )
+    finally:
+        clear_clusterers_cache()
+        close_worker_pools()
+
+    backend = 'cpu_workers' if cpu_backend.uses_cpu_workers(GPU_names) else 'tensorflow'
+    print('Segmented', result['n_frames'], 'frames of', result['height'], 'x', result['width'], 'in',
+          '%.3f' % result['total_time'], 's,', '%.2f' % result['fps'], 'frames/s, with',
+          '%.1f' % result['mean_iters'], 'iterations per frame on', len(GPU_names), backend, 'devices')
+    if result['n_frames'] > 1:
+        print('Sustained', '%.2f' % result['sustained_fps'], 'frames/s after the first frame, which took',
+              '%.3f' % result['first_frame_time'], 's and', result['first_frame_iters'], 'iterations')
+
+    if log_file is not None:
+        result.update({ 'frames'      : frames          ,
+                        'K'           : K               ,
+                        'method_name' : method_name     ,
+                        'num_devices' : len(GPU_names)  ,
+                        'backend'     : backend         ,
+                        'dtype'       : dtype           })
+        append_to_log(log_file, result)
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Segments the Frames of a Video by Clustering their Pixels.')
+
+    parser.add_argument("--frames"                                                    ,
+                        dest     = "frames"                                           ,
+                        required = True                                               ,
+                        metavar  = "PATTERN"                                          ,
+                        help     = "Glob pattern of the frames (images or .npy), " +
+                        "such as 'img_vid01_*.tif', or a video file !!!" )
+
+    parser.add_argument("--output_dir"                                                ,
+                        dest     = "output_dir"                                       ,
+                        required = True                                               ,
+                        metavar  = "DIR"                                              ,
+                        help     = "The label map of each frame is written to " +
+                        "DIR/<frame>_labels.npy !!!" )
+
+    parser.add_argument("--K"                                                         ,
+                        dest     = "K"                                                ,
+                        required = True                                               ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Number of K Centers !!!" )
+
+    parser.add_argument("--n_GPUs"                                                    ,
+                        dest     = "GPU_names"                                        ,
+                        required = False                                              ,
+                        default  = []                                                 ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: parse_valid_gpus_names(parser, x)        ,
+                        help     = "Number of GPUs !!!" )
+
+    parser.add_argument("--n_workers"                                                 ,
+                        dest     = "n_workers"                                        ,
+                        required = False                                              ,
+                        default  = 0                                                  ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_int(parser, x)                ,
+                        help     = "Number of CPU worker processes, used " +
+                        "instead of GPUs !!!" )
+
+    parser.add_argument("--method_name"                                               ,
+                        dest     = "method_name"                                      ,
+                        required = False                                              ,
+                        default  = 'distributedKMeans'                                ,
+                        metavar  = "str"                                              ,
+                        type     = lambda x: make_valid_method(parser, x)             ,
+                        help     = "Clustering Method, distributedKMeans by " +
+                        "default !!!" )
+
+    parser.add_argument("--n_max_iters"                                               ,
+                        dest     = "n_max_iters"                                      ,
+                        required = False                                              ,
+                        default  = 20                                                 ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Maximum number of iterations per frame !!!" )
+
+    parser.add_argument("--seed"                                                      ,
+                        dest     = "seed"                                             ,
+                        required = False                                              ,
+                        default  = 0                                                  ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_int(parser, x)                ,
+                        help     = "Seed of the initialization of the first " +
+                        "frame !!!" )
+
+    parser.add_argument("--init"                                                      ,
+                        dest     = "init"                                             ,
+                        required = False                                              ,
+                        default  = 'k-means||'                                        ,
+                        metavar  = "str"                                              ,
+                        type     = lambda x: make_valid_init(parser, x)               ,
+                        help     = "Initialization of the first frame, the " +
+                        "others start from the centers of the previous one !!!" )
+
+    parser.add_argument("--tol"                                                       ,
+                        dest     = "tol"                                              ,
+                        required = False                                              ,
+                        default  = 0.0                                                ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_float(parser, x)              ,
+                        help     = "Stops a frame when the total squared center " +
+                        "shift is below this value !!!" )
+
+    parser.add_argument("--inertia_tol"                                               ,
+                        dest     = "inertia_tol"                                      ,
+                        required = False                                              ,
+                        default  = DEFAULT_INERTIA_TOL                                ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_float(parser, x)              ,
+                        help     = "Stops a warm started frame when the relative " +
+                        "change of the inertia is below this value !!!" )
+
+    parser.add_argument("--dtype"                                                     ,
+                        dest     = "dtype"                                            ,
+                        required = False                                              ,
+                        default  = 'float32'                                          ,
+                        metavar  = "str"                                              ,
+                        type     = lambda x: make_valid_dtype(parser, x)              ,
+                        help     = "Precision the pixels are clustered in !!!" )
+
+    parser.add_argument("--fuzzifier"                                                 ,
+                        dest     = "fuzzifier"                                        ,
+                        required = False                                              ,
+                        default  = DEFAULT_FUZZIFIER                                  ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_fuzzifier(parser, x)          ,
+                        help     = "Fuzzifier m of distributedFuzzyCMeans !!!" )
+
+    parser.add_argument("--n_decoders"                                                ,
+                        dest     = "n_decoders"                                       ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Threads decoding the images, one per core " +
+                        "by default !!!" )
+
+    parser.add_argument("--max_frames"                                                ,
+                        dest     = "max_frames"                                       ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Segments only the first frames !!!" )
+
+    parser.add_argument("--log_file"                                                  ,
+                        dest     = "log_file"                                         ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "FILE"                                             ,
+                        help     = "Appends the frames per second to this CSV !!!" )
+
+    args = parser.parse_args()
+
+    # CPU worker processes take the place of the GPUs
+    if args.n_workers < 0:
+        parser.error("Number of Workers Given is Negative")
+    if args.n_workers > 0 and len(args.GPU_names) > 0:
+        parser.error("Use Either --n_GPUs or --n_workers")
+    if args.n_workers > 0:
+        args.GPU_names = cpu_backend.cpu_worker_names(args.n_workers)
+    if len(args.GPU_names) == 0:
+        parser.error("Give a Positive --n_GPUs or --n_workers")
+
+    status = main(frames      = args.frames       ,
+                  output_dir  = args.output_dir   ,
+                  K           = args.K            ,
+                  GPU_names   = args.GPU_names    ,
+                  method_name = args.method_name  ,
+                  n_max_iters = args.n_max_iters  ,
+                  seed        = args.seed         ,
+                  init        = args.init         ,
+                  tol         = args.tol          ,
+                  inertia_tol = args.inertia_tol  ,
+                  dtype       = args.dtype        ,
+                  fuzzifier   = args.fuzzifier    ,
+                  n_decoders  = args.n_decoders   ,
+                  max_frames  = args.max_frames   ,
+                  log_file    = args.log_file     )
+
+    sys.exit(status)
@@ -0,0 +1,163 @@
+import os
+
+import numpy as np
+
+####
+# Initial centers for the clustering methods :
+# => 'k-means||' : scalable k-means++ (Bahmani et al.), the oversampling
+#                  rounds run data parallel on the shards of the clusterer
+# => 'random'    : K distinct rows of the data chosen uniformly
+# => file path   : user supplied centers, a .npy file or a CSV with K rows
+#
+# k-means|| only needs a clusterer offering the three data parallel passes
+# candidates_potential, sample_candidates and candidates_weights, so it
+# runs unchanged on any backend. `data` is the batch loaded on a resident
+# clusterer or the list of batches of a streaming one
+####
+INIT_METHODS = ['k-means||', 'random']
+
+# Expected number of candidates sampled per round is OVERSAMPLING_FACTOR * K
+OVERSAMPLING_FACTOR = 2.0
+N_ROUNDS = 5
+
+# Lloyd iterations run on the weighted candidates after k-means++
+N_RECLUSTER_ITERS = 10
+
+def data_batches(data):
+    return data if isinstance(data, (list, tuple)) else [data]
+
+def random_rows(data, n, rng):
+    ####
+    # n distinct rows chosen uniformly over all batches
+    # Only the chosen rows are read, so it works on memory-mapped batches
+    ####
+    batches = data_batches(data)
+    offsets = np.cumsum([0] + [len(batch) for batch in batches])
+
+    indexes = np.sort(rng.choice(offsets[-1], size = n, replace = False))
+    batch_of_index = np.searchsorted(offsets, indexes, side = 'right') - 1
+
+    return np.array([batches[b][i - offsets[b]] for (i, b) in zip(indexes, batch_of_index)])
+
+def random_init(data, K, seed):
+    return random_rows(data, K, np.random.RandomState(seed))
+
+def user_supplied_init(centers, K, n_dim):
+    if isinstance(centers, str):
+        if os.path.splitext(centers)[1] == '.npy':
+            centers = np.load(centers)
+        else:
+            centers = np.loadtxt(centers, delimiter = ',', ndmin = 2)
+
+    centers = np.asarray(centers)
+    if centers.shape != (K, n_dim):
+        raise ValueError("Initial centers must have shape " + str((K, n_dim)) +
+                         ", got " + str(centers.shape))
+    return centers
+
+def weighted_k_means_pp(points, weights, K, rng):
+    ####
+    # Sequential k-means++ on the small set of weighted candidates
+    ####
+    centers = [points[rng.choice(len(points), p = weights / weights.sum())]]
+    min_sqr_dist = np.sum(np.square(points - centers[0]), axis = 1)
+
+    for _ in range(1, K):
+        potential = weights * min_sqr_dist
+        if potential.sum() > 0:
+            new_center = points[rng.choice(len(points), p = potential / potential.sum())]
+        else:
+            new_center = points[rng.choice(len(points))]
+        centers.append(new_center)
+        min_sqr_dist = np.minimum(min_sqr_dist, np.sum(np.square(points - new_center), axis = 1))
+
+    return np.array(centers)
+
+def weighted_lloyd(points, weights, centers, n_iters):
+    for _ in range(n_iters):
+        sqr_dist = (np.sum(np.square(points), axis = 1)[:, np.newaxis]
+                    - 2 * np.dot(points, centers.T) + np.sum(np.square(centers), axis = 1))
+        labels = np.argmin(sqr_dist, axis = 1)
+
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, weights[:, np.newaxis] * points)
+        counts = np.bincount(labels, weights = weights, minlength = len(centers))
+
+        non_empty = counts > 0
+        new_centers = centers.copy()
+        new_centers[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+        if np.array_equal(new_centers, centers):
+            break
+        centers = new_centers
+
+    return centers
+
+def k_means_parallel_candidates(clusterer, data, K, rng, seed,
+                                oversampling_factor = OVERSAMPLING_FACTOR, n_rounds = N_ROUNDS):
+    ####
+    # Oversampling rounds of k-means||, returns the candidates weighted by
+    # the number of points closest to them
+    ####
+    # The first candidate is a uniformly chosen point
+    candidates = random_rows(data, 1, rng)
+    potential = clusterer.candidates_potential(candidates, 1, data, reset = True)
+
+    # Each round keeps every point with probability l * d^2(x, C) / potential
+    l = oversampling_factor * K
+    for r in range(n_rounds):
+        if potential <= 0:
+            break
+
+        sampled = clusterer.sample_candidates(candidates, l / potential, [seed, r], data)
+        if len(sampled) == 0:
+            continue
+
+        candidates = np.concatenate([candidates, sampled])
+        potential = clusterer.candidates_potential(candidates, len(sampled), data)
+
+    # Too few distinct points were sampled, complete with random rows
+    if len(candidates) < K:
+        candidates = np.concatenate([candidates, random_rows(data, K - len(candidates), rng)])
+
+    return (candidates, clusterer.candidates_weights(candidates, data).astype(np.float64))
+
+def recluster_candidates(candidates, weights, K, rng):
+    # The weighted candidates are reclustered into K centers on the host
+    centers = weighted_k_means_pp(candidates, weights, K, rng)
+    return weighted_lloyd(candidates, weights, centers, N_RECLUSTER_ITERS).astype(candidates.dtype)
+
+def k_means_parallel_init(clusterer, data, K, seed,
+                          oversampling_factor = OVERSAMPLING_FACTOR, n_rounds = N_ROUNDS):
+    rng = np.random.RandomState(seed)
+    (candidates, weights) = k_means_parallel_candidates(clusterer, data, K, rng, seed, oversampling_factor, n_rounds)
+    return recluster_candidates(candidates, weights, K, rng)
+
+def initialize_centers(init, clusterer, data, K, seed):
+    if not isinstance(init, str) or init not in INIT_METHODS:
+        return user_supplied_init(init, K, clusterer.n_dim)
+
+    if init == 'random':
+        return random_init(data, K, seed)
+
+    return k_means_parallel_init(clusterer, data, K, seed)
+
+def initialize_multi_K(init, clusterer, data, Ks, seed):
+    ####
+    # Initial centers of the models of several K fitted together, see 
+    # MultiKClusterer. k-means|| samples the candidates once, for the 
+    # largest K, and reclusters them into the centers of every K, the 
+    # other initializations are the ones of each K. Given centers are a 
+    # list with the centers of each K
+    ####
+    if isinstance(init, str) and init not in INIT_METHODS:
+        raise ValueError("Models of several K take a list of initial centers, not the file " + init)
+
+    if not isinstance(init, str):
+        return [user_supplied_init(centers, K, clusterer.n_dim) for (centers, K) in zip(init, Ks)]
+
+    if init == 'random':
+        return [random_init(data, K, seed) for K in Ks]
+
+    rng = np.random.RandomState(seed)
+    (candidates, weights) = k_means_parallel_candidates(clusterer, data, max(Ks), rng, seed)
+    return [recluster_candidates(candidates, weights, K, rng) for K in Ks]
@@ -0,0 +1,219 @@
+import argparse
+import csv
+import os
+import socket
+import sqlite3
+import time
+
+from contextlib import closing
+
+####
+# Results store of the experiments, a SQLite database used instead of the
+# CSV log when the log file is a .db or .sqlite file
+# => runs       : one record per run with its status (running, completed or
+#                 failed), the error of failed runs, where and when it ran,
+#                 and one column per column of the CSV log
+# => iterations : the per iteration metrics of the runs (inertia, shift,
+#                 ...) in long form, one row per run, iteration and metric
+# A run is recorded as running when it starts and updated when it ends, so
+# runs interrupted stay running and are run again by a resumed sweep
+# The database is in WAL mode and every write is a short transaction, so
+# several processes or threads can record runs at the same time
+####
+LEDGER_EXTENSIONS = ['.db', '.sqlite']
+
+RUN_STATUSES = ['running', 'completed', 'failed']
+
+# Columns of the runs table that are not columns of the CSV log
+RUN_FIELDS = ['run_id', 'status', 'error', 'host', 'pid', 'started_at', 'finished_at']
+
+# Seconds a writer waits for the others before failing
+BUSY_TIMEOUT = 60.0
+
+def is_ledger(log_file):
+    return os.path.splitext(log_file)[1] in LEDGER_EXTENSIONS
+
+def quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+class Ledger(object):
+    ####
+    # columns are the ones of the CSV log, their values keep their python
+    # types in SQLite. Columns added to the log later are added to the
+    # runs table of existing databases, the ledger has all the columns of
+    # its table
+    ####
+    def __init__(self, db_file, columns = ()):
+        self.db_file = db_file
+
+        with closing(self._connect()) as connection:
+            connection.execute('PRAGMA journal_mode = WAL')
+            with connection:
+                # Write lock taken first, the processes opening a new ledger at
+                # the same time would otherwise all add the same columns
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute('CREATE TABLE IF NOT EXISTS runs ( run_id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                   'status TEXT NOT NULL, error TEXT, host TEXT, pid INTEGER, '
+                                   'started_at REAL, finished_at REAL )')
+                connection.execute('CREATE TABLE IF NOT EXISTS iterations ( run_id INTEGER NOT NULL '
+                                   'REFERENCES runs(run_id), iteration INTEGER NOT NULL, metric TEXT NOT NULL, '
+                                   'value REAL, PRIMARY KEY (run_id, iteration, metric) )')
+
+                existing = [row[1] for row in connection.execute('PRAGMA table_info(runs)')]
+                for column in columns:
+                    if column not in existing:
+                        connection.execute('ALTER TABLE runs ADD COLUMN ' + quote(column))
+                        existing.append(column)
+
+        self.columns = [column for column in existing if column not in RUN_FIELDS]
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_file, timeout = BUSY_TIMEOUT)
+        connection.execute('PRAGMA busy_timeout = ' + str(int(BUSY_TIMEOUT * 1000)))
+        return connection
+
+    def start_run(self, config):
+        # Records a running run with the known columns of config, returns its id
+        columns = [column for column in self.columns if column in config]
+        with closing(self._connect()) as connection:
+            with connection:
+                cursor = connection.execute(
+                    'INSERT INTO runs (status, host, pid, started_at' + ''.join(', ' + quote(c) for c in columns) +
+                    ') VALUES (?, ?, ?, ?' + ', ?' * len(columns) + ')',
+                    ['running', socket.gethostname(), os.getpid(), time.time()] + [config[c] for c in columns])
+                return cursor.lastrowid
+
+    def finish_run(self, run_id, record, iterations = None, error = None):
+        ####
+        # Ends a run with the columns of record and its per iteration metrics,
+        # a dict of metric name to list of values. The CSV log puts the name
+        # of the exception of a failed run in its numeric columns, here they
+        # are left NULL and the name is kept in error
+        ####
+        columns = [column for column in self.columns if column in record]
+        values = [None if error is not None and record[c] == error else record[c] for c in columns]
+
+        with closing(self._connect()) as connection:
+            with connection:
+                connection.execute(
+                    'UPDATE runs SET status = ?, error = ?, finished_at = ?' +
+                    ''.join(', ' + quote(c) + ' = ?' for c in columns) + ' WHERE run_id = ?',
+                    ['completed' if error is None else 'failed', error, time.time()] + values + [run_id])
+
+                rows = []
+                for (metric, history) in (iterations or {}).items():
+                    rows.extend( (run_id, i, metric, float(value)) for (i, value) in enumerate(history) )
+                connection.executemany('INSERT OR REPLACE INTO iterations VALUES (?, ?, ?, ?)', rows)
+
+    def completed(self, columns):
+        # Values of columns of every completed run, NULL as ''
+        with closing(self._connect()) as connection:
+            rows = connection.execute('SELECT ' + ', '.join(quote(c) for c in columns) +
+                                      ' FROM runs WHERE status = ?', ['completed'])
+            return [tuple('' if value is None else value for value in row) for row in rows]
+
+    def iterations(self, run_id):
+        with closing(self._connect()) as connection:
+            rows = connection.execute('SELECT metric, iteration, value FROM iterations WHERE run_id = ? '
+                                      'ORDER BY metric, iteration', [run_id])
+            metrics = {}
+            for (metric, _, value) in rows:
+                metrics.setdefault(metric, []).append(value)
+            return metrics
+
+    def export_csv(self, csv_file, ledger_fields = False):
+        ####
+        # CSV log of the finished runs in the order they started, with exactly
+        # the columns of the log so that it can be resumed or appended to as
+        # any CSV log. A failed run has the name of its exception as its
+        # computation_time, as in the CSV log. ledger_fields adds the run_id,
+        # status and error after the columns of the log
+        ####
+        columns = self.columns + (['run_id', 'status', 'error'] if ledger_fields else [])
+        with closing(self._connect()) as connection:
+            rows = connection.execute('SELECT error, ' + ', '.join(quote(c) for c in columns) +
+                                      ' FROM runs WHERE status != ? ORDER BY run_id', ['running'])
+
+            with open(csv_file, 'w', newline = '') as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                n_rows = 0
+                for values in rows:
+                    (error, row) = (values[0], dict(zip(columns, values[1:])))
+                    if error is not None and row.get('computation_time') is None:
+                        row['computation_time'] = error
+                    writer.writerow(['' if row[c] is None else row[c] for c in columns])
+                    n_rows += 1
+        return n_rows
+
+def import_csv(db_file, csv_file):
+    # Records the runs of a CSV log, the ones with non numeric times failed
+    with open(csv_file, 'r', newline = '') as f:
+        reader = csv.DictReader(f)
+        ledger = Ledger(db_file, reader.fieldnames)
+
+        n_rows = 0
+        for row in reader:
+            try:
+                float(row.get('computation_time'))
+                error = None
+            except (TypeError, ValueError):
+                error = row.get('computation_time') or 'unknown'
+
+            record = dict( (column, parse_value(value)) for (column, value) in row.items()
+                           if value != '' and column not in RUN_FIELDS )
+            ledger.finish_run(ledger.start_run(record), record, error = error)
+            n_rows += 1
+    return n_rows
+
+def parse_value(value):
+    # Numbers of a CSV log back to numbers
+    for parse in [int, float]:
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Exports or Imports the Runs of an Experiment Ledger.')
+
+    parser.add_argument("--ledger"                                                    ,
+                        dest     = "ledger"                                           ,
+                        required = True                                               ,
+                        metavar  = "FILE"                                             ,
+                        help     = "The .db ledger !!!" )
+
+    parser.add_argument("--export_csv"                                                ,
+                        dest     = "export_csv"                                       ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "FILE"                                             ,
+                        help     = "Writes the finished runs to this CSV log !!!" )
+
+    parser.add_argument("--ledger_fields"                                             ,
+                        dest     = "ledger_fields"                                    ,
+                        action   = "store_true"                                       ,
+                        help     = "Adds the run_id, status and error of the runs to the exported CSV, "
+                                   "which is then no longer a CSV log that can be resumed or appended to !!!" )
+
+    parser.add_argument("--import_csv"                                                ,
+                        dest     = "import_csv"                                       ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "FILE"                                             ,
+                        help     = "Records the runs of this CSV log !!!" )
+
+    args = parser.parse_args()
+
+    if not is_ledger(args.ledger):
+        parser.error("Ledgers Must Be " + ' or '.join(LEDGER_EXTENSIONS) + " Files")
+    if args.export_csv is None and args.import_csv is None:
+        parser.error("Give --export_csv or --import_csv")
+    if args.ledger_fields and args.export_csv is None:
+        parser.error("--ledger_fields Is Only Used With --export_csv")
+
+    if args.import_csv is not None:
+        print(import_csv(args.ledger, args.import_csv), 'runs imported from', args.import_csv)
+    if args.export_csv is not None:
+        print(Ledger(args.ledger).export_csv(args.export_csv, args.ledger_fields), 'runs exported to', args.export_csv)
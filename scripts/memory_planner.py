@@ -0,0 +1,150 @@
+import os
+
+import numpy as np
+
+####
+# Up-front estimate of the memory used by the clustering graphs, used to
+# choose the batch and shard sizes before anything is allocated
+# In the coments we denote :
+# => N = Number of Observations of a shard
+# => M = Number of Dimensions
+# => K = Number of Centers
+# => b = Size in bytes of the dtype the shards and distances are computed in
+# The per cluster statistics are accumulated in float64 whatever the dtype
+####
+ACCUMULATOR_ITEMSIZE = 8
+
+# Fraction of the budget the plan is allowed to use, the estimate does
+# not know about allocator fragmentation or TF workspace memory
+SAFETY_FRACTION = 0.8
+
+# Number of N x K matrices alive at the same time while computing one
+# iteration on a shard (matmul result, distances, memberships ...)
+DISTANCE_TEMPORARIES = {    'distributedKMeans'          : 3,
+                            'distributedFuzzyCMeans'     : 5,
+                            'distributedHamerlyKMeans'   : 3,
+                            'distributedMiniBatchKMeans' : 3 }
+
+# Methods whose N x K temporaries only exist for one block of rows at a time
+BLOCKED_METHODS = ['distributedFuzzyCMeans']
+
+# Elements of the block x K matrices of the blocked methods
+BLOCK_ELEMENTS = 1 << 20
+MIN_BLOCK_ROWS = 1024
+
+# Streamed batches staged on the host ahead of the one being computed, see
+# distribuitedClustering.prefetched, 1 is double buffering
+PREFETCH_DEPTH = 1
+
+def fuzzy_block_rows(K):
+    # Rows per block, so that a block x K matrix has about BLOCK_ELEMENTS values
+    return max(MIN_BLOCK_ROWS, BLOCK_ELEMENTS // K)
+
+def available_host_memory():
+    # MemAvailable accounts for the page cache that can be reclaimed
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+def bytes_per_row(method_name, n_dim, K, dtype, resident):
+    ####
+    # Peak bytes needed on a device for each row of its shard
+    # => Shard fed from the host : N x M plus the N x 1 ||x||^2
+    # => Resident shard : the Variables holding X, ||x||^2 and the k-means||
+    #    distances on top of the fed copy, which is alive while it is loaded
+    # => Iteration : the N x K temporaries plus the int64 labels, the int32
+    #    segment ids and the column of ones used to count the points, and
+    #    the float64 copy of the shard summed when b is smaller than that
+    #    Blocked methods only have the block x K temporaries, see fixed_bytes
+    # => Resident Hamerly shards also keep the upper and lower bounds and
+    #    the int64 assignment, and gather the centers of the checked points
+    ####
+    itemsize = np.dtype(dtype).itemsize
+
+    fed_bytes = (n_dim + 1) * itemsize
+    resident_bytes = (n_dim + 2) * itemsize if resident else 0
+    if resident and method_name == 'distributedHamerlyKMeans':
+        resident_bytes += (n_dim + 2) * itemsize + 8
+    if method_name in BLOCKED_METHODS:
+        return fed_bytes + resident_bytes
+
+    iteration_bytes = DISTANCE_TEMPORARIES[method_name] * K * itemsize + 8 + 4 + ACCUMULATOR_ITEMSIZE
+    if itemsize < ACCUMULATOR_ITEMSIZE:
+        iteration_bytes += n_dim * ACCUMULATOR_ITEMSIZE
+
+    return fed_bytes + resident_bytes + iteration_bytes
+
+def fixed_bytes(method_name, n_dim, K, dtype, shard_size = None):
+    # Centers and their norms, and the float64 K x M sums and K counts of each device
+    itemsize = np.dtype(dtype).itemsize
+    centers_bytes = (K * n_dim + K) * itemsize + (2 * K * n_dim + 2 * K) * ACCUMULATOR_ITEMSIZE
+
+    # The temporaries of one block of the blocked methods, a shard smaller 
+    # than a block is a single block
+    if method_name in BLOCKED_METHODS:
+        block_rows = fuzzy_block_rows(K) if shard_size is None else min(fuzzy_block_rows(K), shard_size)
+        centers_bytes += block_rows * (DISTANCE_TEMPORARIES[method_name] * K + n_dim) * itemsize
+    return centers_bytes
+
+def plan_batches(method_name, n_obs, n_dim, K, dtype, n_workers, device_budget, host_budget = None):
+    ####
+    # Chooses the largest shards that fit the per device budget
+    # If the whole dataset fits, it is kept resident on the devices in a
+    # single batch, otherwise it is streamed in the fewest equal batches
+    # whose shards fit. host_budget bounds the size of a batch read from
+    # disk, and of the streamed batches staged on the host at the same time
+    ####
+    usable_budget = int(SAFETY_FRACTION * device_budget) - fixed_bytes(method_name, n_dim, K, dtype)
+    if usable_budget <= 0:
+        raise ValueError("Device memory budget is too small for K = " + str(K))
+
+    itemsize = np.dtype(dtype).itemsize
+    resident_shard_size = int(np.ceil(n_obs / float(n_workers)))
+    resident_peak = resident_shard_size * bytes_per_row(method_name, n_dim, K, dtype, True)
+
+    host_fits = host_budget is None or n_obs * n_dim * itemsize <= SAFETY_FRACTION * host_budget
+
+    if resident_peak <= usable_budget and host_fits:
+        (num_batches, shard_size, peak) = (1, resident_shard_size, resident_peak)
+    else:
+        max_shard_size = usable_budget // bytes_per_row(method_name, n_dim, K, dtype, False)
+        if host_budget is not None:
+            staged_batches = 1 + PREFETCH_DEPTH
+            max_shard_size = min(max_shard_size, int(SAFETY_FRACTION * host_budget) // 
+                                                 (staged_batches * n_workers * n_dim * itemsize))
+        if max_shard_size <= 0:
+            raise ValueError("Memory budget is too small for a single row")
+
+        # A single batch is always resident, streaming needs at least two
+        num_batches = max(2, int(np.ceil(n_obs / float(max_shard_size * n_workers))))
+        shard_size = int(np.ceil(n_obs / float(num_batches * n_workers)))
+        peak = shard_size * bytes_per_row(method_name, n_dim, K, dtype, False)
+
+    estimated_peak_bytes = int(peak + fixed_bytes(method_name, n_dim, K, dtype, shard_size))
+
+    return {    'method_name'          : method_name                                ,
+                'n_obs'                : n_obs                                      ,
+                'n_dim'                : n_dim                                      ,
+                'K'                    : K                                          ,
+                'dtype'                : np.dtype(dtype).name                       ,
+                'n_workers'            : n_workers                                  ,
+                'num_batches'          : num_batches                                ,
+                'batch_size'           : int(np.ceil(n_obs / float(num_batches)))   ,
+                'shard_size'           : shard_size                                 ,
+                'resident'             : num_batches == 1                           ,
+                'estimated_peak_bytes' : estimated_peak_bytes                       ,
+                'estimated_peak_MB'    : estimated_peak_bytes // (1024 * 1024)      ,
+                'device_budget'        : int(device_budget)
+           }
+
+def format_plan(plan):
+    return ('Memory plan : ' + str(plan['num_batches']) + ' batch(es) of ' + str(plan['batch_size']) +
+            ' rows, shards of ' + str(plan['shard_size']) + ' rows on ' + str(plan['n_workers']) +
+            ' device(s), ' + ('resident' if plan['resident'] else 'streaming') + ' in ' + plan['dtype'] +
+            ', estimated peak ' + str(plan['estimated_peak_MB']) + ' MB of ' +
+            str(plan['device_budget'] // (1024 * 1024)) + ' MB per device')
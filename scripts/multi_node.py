@@ -0,0 +1,407 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from multiprocessing.connection import Listener
+
+import numpy as np
+
+from cluster_node import parse_address
+from dataset_io import load_dataset
+from distribuitedClustering import (cpu_clusterer_class, fit_clusterer, clustering_params, make_valid_int, 
+                                    make_valid_float, make_valid_method, make_valid_init, 
+                                    make_valid_dtype, make_valid_fuzzifier, make_valid_positive_int,
+                                    check_file_exists, DEFAULT_FUZZIFIER, DEFAULT_MINI_BATCH_SIZE,
+                                    DEFAULT_FULL_PASS_EVERY, DEFAULT_MINI_BATCH_INERTIA_TOL)
+import cpu_backend
+
+####
+# Coordinator of a multi-node run
+# Every node (cluster_node.py) owns a range of rows of the dataset, sized
+# by its number of workers, and returns the per cluster statistics of its
+# range on each iteration. The coordinator sums them and sends back the new
+# centers, acting as the parameter server of the allreduce
+# The dataset must be readable at the same path on all the hosts
+# The labels of the points are only sent to the coordinator when they are
+# saved with --labels_file, otherwise the nodes reduce them to the number
+# of points and the inertia of each cluster
+# With --local_nodes the nodes are started on localhost, to test or to
+# use the several NUMA domains of a single host
+####
+LOG_COLUMNS = [ 'method_name', 'seed', 'n_nodes', 'n_workers', 'K', 'n_obs', 'n_dim',
+                'setup_time', 'initialization_time', 'computation_time', 'n_iter',
+                'iteration_time', 'speedup', 'scaling_efficiency', 'dtype', 'fuzzifier',
+                'mini_batch_size', 'full_pass_every', 'inertia' ]
+
+class NodePool(object):
+    ####
+    # Pool of remote nodes with the interface of cpu_backend.WorkerPool
+    # A node replies like a single worker holding the rows of all its workers
+    ####
+    def __init__(self, address, authkey, n_nodes):
+        listener = Listener(address, authkey = authkey)
+        self.address = listener.address
+        self.listener = listener
+        self.n_nodes = n_nodes
+
+        self.nodes = []
+        self.connections = []
+        self.closed = False
+
+    def wait_for_nodes(self):
+        while len(self.nodes) < self.n_nodes:
+            connection = self.listener.accept()
+            (hostname, n_workers) = connection.recv()
+            print('Node', len(self.nodes), 'connected from', hostname, 'with', n_workers, 'workers')
+
+            self.nodes.append( {'hostname': hostname, 'n_workers': n_workers, 'connection': connection} )
+        self.listener.close()
+
+    def assign(self, data_file, n_obs, method_name, dtype, n_nodes_used):
+        ####
+        # Gives each of the first n_nodes_used nodes a range of rows
+        # proportional to its number of workers, stored by the nodes in dtype
+        # Returns the names of all the workers used and the rows of each node
+        ####
+        nodes = self.nodes[0:n_nodes_used]
+        n_workers = [node['n_workers'] for node in nodes]
+        bounds = np.round(np.cumsum([0] + n_workers) * n_obs / float(sum(n_workers))).astype(int)
+        worker_offsets = np.cumsum([0] + n_workers)
+
+        self.connections = [node['connection'] for node in nodes]
+        self.run('load', [ (data_file, int(bounds[i]), int(bounds[i + 1]), method_name, 
+                            np.dtype(dtype).str, int(worker_offsets[i]))
+                           for i in range(n_nodes_used) ])
+        self.n_rows = int(bounds[-1])
+
+        return (cpu_backend.cpu_worker_names(sum(n_workers)), [int(rows) for rows in np.diff(bounds)])
+
+    def run(self, command, per_node_args):
+        # The nodes compute in parallel, the replies are gathered afterwards
+        for (connection, args) in zip(self.connections, per_node_args):
+            connection.send((command, args))
+
+        replies = [connection.recv() for connection in self.connections]
+        for (status, reply) in replies:
+            if status == 'error':
+                raise reply
+        return [reply for (_, reply) in replies]
+
+    def broadcast(self, command, *args):
+        return self.run(command, [args] * len(self.connections))
+
+    def scatter(self, batch, dtype = None):
+        # The nodes read their own rows when they are assigned
+        if len(batch) != self.n_rows:
+            raise ValueError("Multi-node runs can not be given another batch")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        for node in self.nodes:
+            try:
+                node['connection'].send(('close', None))
+            except (IOError, OSError):
+                pass
+            node['connection'].close()
+
+def start_local_nodes(address, authkey, n_nodes, n_workers):
+    env = dict(os.environ)
+    env['MULTI_NODE_AUTHKEY'] = authkey.decode('utf-8')
+
+    node_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cluster_node.py')
+    return [ subprocess.Popen([ sys.executable, node_file,
+                                '--address', address[0] + ':' + str(address[1]),
+                                '--n_workers', str(n_workers) ], env = env)
+             for _ in range(n_nodes) ]
+
+def append_to_log(log_file, data_to_append):
+    if not os.path.exists(log_file):
+        with open(log_file, 'w') as f:
+            f.write(','.join(LOG_COLUMNS) + '\n')
+
+    with open(log_file, 'a') as f:
+        f.write(','.join([ str( data_to_append[column] ) for column in LOG_COLUMNS ]) + '\n')
+
+def main(data_file, K, n_max_iters, seed, log_file, method_name, address, authkey, n_nodes,
+         local_nodes = False, n_local_workers = 1, scaling = False, tol = 0.0, inertia_tol = 0.0,
+         init = 'k-means||', dtype = None, fuzzifier = DEFAULT_FUZZIFIER,
+         mini_batch_size = DEFAULT_MINI_BATCH_SIZE, full_pass_every = DEFAULT_FULL_PASS_EVERY,
+         labels_file = None):
+
+    # The coordinator only reads the rows chosen by the initialization
+    X = load_dataset(data_file)
+    dtype = X.dtype if dtype is None else np.dtype(dtype)
+    method_params = clustering_params(method_name, fuzzifier, mini_batch_size, full_pass_every)
+
+    pool = NodePool(address, authkey, n_nodes)
+    processes = []
+    if local_nodes:
+        processes = start_local_nodes(pool.address, authkey, n_nodes, n_local_workers)
+
+    try:
+        pool.wait_for_nodes()
+
+        # The scaling study runs the same fit on 1, 2, ... n_nodes nodes
+        nodes_used = range(1, n_nodes + 1) if scaling else [n_nodes]
+        base_iteration_time = None
+
+        for n_nodes_used in nodes_used:
+            # The nodes reading their rows is the setup of a multi-node run
+            setup_ts = time.time()
+            (worker_names, node_rows) = pool.assign(data_file, X.shape[0], method_name, dtype, n_nodes_used)
+            setup_time = float( time.time() - setup_ts )
+
+            clusterer = cpu_clusterer_class(method_name)(method_name, node_rows, X.shape[1], K, dtype, worker_names,
+                                                         method_params, pool = pool)
+            # The labels are gathered once, on the last number of nodes
+            save_labels = labels_file is not None and n_nodes_used == nodes_used[-1]
+            run_result = fit_clusterer(clusterer, X, K, init, seed, n_max_iters, tol, inertia_tol,
+                                       labels = save_labels)
+            run_result['setup_time'] += setup_time
+
+            (cluster_sizes, cluster_inertia) = clusterer.label_statistics()
+            if save_labels:
+                np.save(labels_file, run_result['cluster_idx'])
+
+            # Speedup and efficiency are relative to the fit on a single node
+            iteration_time = run_result['computation_time'] / run_result['n_iter']
+            if n_nodes_used == 1:
+                base_iteration_time = iteration_time
+
+            if base_iteration_time is None:
+                (speedup, scaling_efficiency) = ('', '')
+            else:
+                speedup = base_iteration_time / iteration_time
+                scaling_efficiency = speedup / n_nodes_used
+
+            print('Nodes =', n_nodes_used, 'workers =', len(worker_names),
+                  'time per iteration =', iteration_time, 'speedup =', speedup,
+                  'scaling efficiency =', scaling_efficiency)
+            print('Cluster sizes =', cluster_sizes.astype(np.int64), 'inertia =', float(np.sum(cluster_inertia)))
+
+            data_to_append = {  'method_name'          : method_name                              ,
+                                'seed'                 : seed                                     ,
+                                'n_nodes'              : n_nodes_used                             ,
+                                'n_workers'            : len(worker_names)                        ,
+                                'K'                    : K                                        ,
+                                'n_obs'                : X.shape[0]                               ,
+                                'n_dim'                : X.shape[1]                               ,
+                                'setup_time'           : run_result['setup_time']                 ,
+                                'initialization_time'  : run_result['initialization_time']        ,
+                                'computation_time'     : run_result['computation_time']           ,
+                                'n_iter'               : run_result['n_iter']                     ,
+                                'iteration_time'       : iteration_time                           ,
+                                'speedup'              : speedup                                  ,
+                                'scaling_efficiency'   : scaling_efficiency                       ,
+                                'dtype'                : dtype.name                               ,
+                                'fuzzifier'            : method_params.get('fuzzifier', '')       ,
+                                'mini_batch_size'      : method_params.get('mini_batch_size', '') ,
+                                'full_pass_every'      : method_params.get('full_pass_every', '') ,
+                                'inertia'              : float(np.sum(cluster_inertia))
+                             }
+            append_to_log(log_file, data_to_append)
+    finally:
+        pool.close()
+        for process in processes:
+            process.wait()
+
+    print('log_file =', log_file)
+
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Multi-Node Distribuited Clustering Coordinator.')
+
+    parser.add_argument("--data_file"                                                     ,
+                        dest     = "data_file"                                            ,
+                        required = True                                                   ,
+                        metavar  = "str"                                                  ,
+                        type     = lambda x: check_file_exists(parser, x)                 ,
+                        help     = "Data file, readable at the same path on every node !!!" )
+
+    parser.add_argument("--K"                                             ,
+                        dest     = "K"                                    ,
+                        required = True                                   ,
+                        metavar  = "int"                                  ,
+                        type     = lambda x: make_valid_int(parser, x)    ,
+                        help     = "Number of K Centers for the Test !!!" )
+
+    parser.add_argument("--n_max_iters"                                           ,
+                        dest     = "n_max_iters"                                  ,
+                        required = True                                           ,
+                        metavar  = "int"                                          ,
+                        type     = lambda x: make_valid_int(parser, x)            ,
+                        help     = "Number of iterations before stopping!!!" )
+
+    parser.add_argument("--seed"                                      ,
+                        dest     = "seed"                             ,
+                        required = True                               ,
+                        metavar  = "int"                              ,
+                        type     = lambda x: make_valid_int(parser, x),
+                        help     = "Seed Value !!!"                    )
+
+    parser.add_argument("--log_file"                                       ,
+                        dest     = "log_file"                              ,
+                        required = True                                    ,
+                        metavar  = "FILE"                                  ,
+                        help     = "log_file Name, this would be a CSV !!!" )
+
+    parser.add_argument("--method_name"                                                   ,
+                        dest     = "method_name"                                          ,
+                        required = True                                                   ,
+                        metavar  = "str"                                                  ,
+                        type     = lambda x: make_valid_method(parser, x)                 ,
+                        help     = "Method Name Can Be :" +
+                        "distributedKMeans, distributedFuzzyCMeans or " +
+                        "distributedMiniBatchKMeans !!!" )
+
+    parser.add_argument("--address"                                           ,
+                        dest     = "address"                                  ,
+                        required = False                                      ,
+                        default  = '127.0.0.1:0'                              ,
+                        metavar  = "host:port"                                ,
+                        help     = "Address the nodes connect to, port 0 " +
+                        "picks a free port !!!" )
+
+    parser.add_argument("--authkey"                                           ,
+                        dest     = "authkey"                                  ,
+                        required = False                                      ,
+                        default  = os.environ.get('MULTI_NODE_AUTHKEY')       ,
+                        metavar  = "str"                                      ,
+                        help     = "Shared secret of the nodes, or the " +
+                        "MULTI_NODE_AUTHKEY environment variable !!!" )
+
+    parser.add_argument("--n_nodes"                                           ,
+                        dest     = "n_nodes"                                  ,
+                        required = True                                       ,
+                        metavar  = "int"                                      ,
+                        type     = lambda x: make_valid_int(parser, x)        ,
+                        help     = "Number of nodes to wait for !!!" )
+
+    parser.add_argument("--local_nodes"                                       ,
+                        dest     = "local_nodes"                              ,
+                        action   = "store_true"                               ,
+                        help     = "Start the nodes on localhost !!!" )
+
+    parser.add_argument("--n_local_workers"                                   ,
+                        dest     = "n_local_workers"                          ,
+                        required = False                                      ,
+                        default  = 1                                          ,
+                        metavar  = "int"                                      ,
+                        type     = lambda x: make_valid_int(parser, x)        ,
+                        help     = "Number of workers of each local node !!!" )
+
+    parser.add_argument("--scaling"                                           ,
+                        dest     = "scaling"                                  ,
+                        action   = "store_true"                               ,
+                        help     = "Fit on 1 to n_nodes nodes and report " +
+                        "the scaling efficiency of each added node !!!" )
+
+    parser.add_argument("--tol"                                                       ,
+                        dest     = "tol"                                              ,
+                        required = False                                              ,
+                        default  = 0.0                                                ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_float(parser, x)              ,
+                        help     = "Stops when the total squared center shift is " +
+                        "below this value !!!" )
+
+    parser.add_argument("--inertia_tol"                                               ,
+                        dest     = "inertia_tol"                                      ,
+                        required = False                                              ,
+                        default  = 0.0                                                ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_float(parser, x)              ,
+                        help     = "Stops when the relative change of the inertia " +
+                        "is below this value, 0 disables it, except for " +
+                        "distributedMiniBatchKMeans which then stops at " +
+                        str(DEFAULT_MINI_BATCH_INERTIA_TOL) + " !!!" )
+
+    parser.add_argument("--init"                                                      ,
+                        dest     = "init"                                             ,
+                        required = False                                              ,
+                        default  = 'k-means||'                                        ,
+                        metavar  = "str"                                              ,
+                        type     = lambda x: make_valid_init(parser, x)               ,
+                        help     = "Initialization, k-means|| or random, or a .npy " +
+                        "or CSV file with the K initial centers !!!" )
+
+    parser.add_argument("--dtype"                                                     ,
+                        dest     = "dtype"                                            ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "str"                                              ,
+                        type     = lambda x: make_valid_dtype(parser, x)              ,
+                        help     = "Precision of the shards and the distances, " +
+                        "float32 or float64, the one of the dataset by default !!!" )
+
+    parser.add_argument("--fuzzifier"                                                 ,
+                        dest     = "fuzzifier"                                        ,
+                        required = False                                              ,
+                        default  = DEFAULT_FUZZIFIER                                  ,
+                        metavar  = "float"                                            ,
+                        type     = lambda x: make_valid_fuzzifier(parser, x)          ,
+                        help     = "Fuzzifier m of distributedFuzzyCMeans, " +
+                        "greater than 1 !!!" )
+
+    parser.add_argument("--mini_batch_size"                                           ,
+                        dest     = "mini_batch_size"                                  ,
+                        required = False                                              ,
+                        default  = DEFAULT_MINI_BATCH_SIZE                            ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Rows of each step of distributedMiniBatchKMeans, " +
+                        "drawn over all the workers of all the nodes !!!" )
+
+    parser.add_argument("--full_pass_every"                                           ,
+                        dest     = "full_pass_every"                                  ,
+                        required = False                                              ,
+                        default  = DEFAULT_FULL_PASS_EVERY                            ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_positive_int(parser, x)       ,
+                        help     = "Iterations of distributedMiniBatchKMeans, " +
+                        "one mini-batch step each, between two full passes " +
+                        "measuring the inertia and testing the convergence !!!" )
+
+    parser.add_argument("--labels_file"                                               ,
+                        dest     = "labels_file"                                      ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "FILE"                                             ,
+                        help     = "Gathers the label of every point from the " +
+                        "nodes and saves them to this .npy file !!!" )
+
+    args = parser.parse_args()
+
+    # Local nodes get a random secret, remote ones must share one
+    if args.authkey is None and not args.local_nodes:
+        parser.error("An --authkey or MULTI_NODE_AUTHKEY is Required for Remote Nodes")
+    authkey = os.urandom(16).hex() if args.authkey is None else args.authkey
+
+    status = main(data_file       = args.data_file              ,
+                  K               = args.K                      ,
+                  n_max_iters     = args.n_max_iters            ,
+                  seed            = args.seed                   ,
+                  log_file        = args.log_file               ,
+                  method_name     = args.method_name            ,
+                  address         = parse_address(args.address) ,
+                  authkey         = authkey.encode('utf-8')     ,
+                  n_nodes         = args.n_nodes                ,
+                  local_nodes     = args.local_nodes            ,
+                  n_local_workers = args.n_local_workers        ,
+                  scaling         = args.scaling                ,
+                  tol             = args.tol                    ,
+                  inertia_tol     = args.inertia_tol            ,
+                  init            = args.init                   ,
+                  dtype           = args.dtype                  ,
+                  fuzzifier       = args.fuzzifier              ,
+                  mini_batch_size = args.mini_batch_size        ,
+                  full_pass_every = args.full_pass_every        ,
+                  labels_file     = args.labels_file            )
+
+    sys.exit(status)
@@ -1,67 +1,74 @@
-import numpy as np
-from sklearn.datasets import make_classification
-import os
 
-from subprocess import Popen, PIPE, STDOUT
+import argparse
 
 from datetime import datetime
 
-def make_data(filepath, n_obs, n_dim, seed):
+from data_generator import cached_dataset
 
-    try:
-        os.remove(filepath)
-    except:
-        print('file not found')
-    finally:
-        (X, Y) = make_classification(n_samples            = n_obs    , 
-                                     n_features           = n_dim    ,
-                                     n_informative        = n_dim    ,
-                                     n_redundant          = 0        ,
-                                     n_classes            = 2        ,
-                                     n_clusters_per_class = 1        ,
-                                     shuffle              = True     ,
-                                     random_state         = seed      )
-
-        np.savez(filepath, X=X, Y=Y)
-
-    return True
+def make_data(n_obs, n_dim, seed):
+    # Classification data made chunk by chunk on all the cores and cached in
+    # datasets/, a dataset with fewer rows is the prefix of the cached one
+    (data_path, _) = cached_dataset(cache_dir = 'datasets'       ,
+                                    kind      = 'classification' ,
+                                    n_obs     = n_obs            ,
+                                    n_dim     = n_dim            ,
+                                    n_centers = 2                ,
+                                    seed      = seed             )
+    return data_path
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Runs the Benchmark Sweep.')
 
-    startTime = datetime.now()
-
-    # Varying the number of observations between 25M and 100M
-    for num_obs in [100000000, 75000000, 50000000, 25000000]:
-            
-        # Number of dimensions will be fixed in 5
-        num_dims = 5
+    parser.add_argument("--nvprof_dir"                                                ,
+                        dest     = "nvprof_dir"                                       ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "DIR"                                              ,
+                        help     = "Runs every configuration in its own process " +
+                        "under nvprof, with its log in this directory for " +
+                        "compileResults.py !!!" )
 
-        data_path = 'class-data.npz'
-        make_data(data_path, num_obs, num_dims, 1826273)
+    parser.add_argument("--multi_K"                                                   ,
+                        dest     = "multi_K"                                          ,
+                        action   = "store_true"                                       ,
+                        help     = "Fits the models of all the K of a configuration " +
+                        "together, their times are then the ones of the shared " +
+                        "iterations !!!" )
 
-        # Varying the number of K between 3 and 15
-        for K in [15, 12, 9, 6, 3]:
+    args = parser.parse_args()
 
-            # Varying number of GPUs between 2 and 8, 2 by 2
-            for num_gpus in [1, 2, 3, 4, 5, 6, 7, 8]:
+    if args.multi_K and args.nvprof_dir is not None:
+        parser.error("--nvprof_dir Profiles Every Run on Its Own, Without --multi_K")
 
-                # Varying methods between distribuitedFuzzyCMeans and distribuitedKMeans
-                for method in ['distributedKMeans', 'distributedFuzzyCMeans']:
-
-                    # Name of log file, inlcuding the number of obs, dims, K, GPUs and method
-                    log_filename =  method + '-GPUs' + str(num_gpus) + '-n_obs' + str(num_obs) + '-n_dims' + str(num_dims) + '-K' + str(K) + '.log'
-
-                    # nvprof process comand to run
-                    process_command =   'nvprof --log-file nvprof_logs/' + log_filename + ' python distribuitedClustering.py --n_obs=' + str(num_obs) + ' --n_dim=' + str(num_dims) + ' --K=' + str(K) + ' --n_GPUs=' + str(num_gpus) + ' --n_max_iters=20 --seed=123128 --log_file=executions_log.csv --method_name=' + method + ' --data_file=' + data_path
-
-                    # Trigger new process with the command defined above
-                    process = Popen(process_command, shell=True)
-                    output = process.communicate()[0]
-                    K_error = process.returncode
+    startTime = datetime.now()
 
-                    # Print filename in case of errors
-                    print(log_filename + ' - Return code: ' + str(K_error))
+    # Number of dimensions will be fixed in 5
+    num_dims = 5
+
+    # The data is made once with the most observations, the smaller runs 
+    # use its first rows. Runs already in the log are skipped
+    data_path = make_data(100000000, num_dims, 1826273)
+
+    # Imported once the data is made, the processes of the generator import
+    # this file again and must not load tensorflow
+    from sweep_runner import run_sweep
+
+    # The whole sweep runs in this process, with --nvprof_dir every run is
+    # profiled in a process of its own
+    run_sweep(data_file  = data_path            ,
+              log_file   = 'executions_log.db'  ,
+              grid       = { # Varying the number of observations between 25M and 100M
+                             'n_obs'       : [100000000, 75000000, 50000000, 25000000],
+                             # Varying the number of K between 3 and 15
+                             'K'           : [15, 12, 9, 6, 3],
+                             # Varying number of GPUs between 1 and 8
+                             'n_devices'   : [1, 2, 3, 4, 5, 6, 7, 8],
+                             # Varying methods between distribuitedFuzzyCMeans and distribuitedKMeans
+                             'method_name' : ['distributedKMeans', 'distributedFuzzyCMeans'] },
+              fixed      = { 'n_max_iters' : 20, 'seed' : 123128 },
+              multi_K    = args.multi_K,
+              nvprof_dir = args.nvprof_dir)
 
     print(datetime.now() - startTime)
 
@@ -0,0 +1,263 @@
+import argparse
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tensorflow as tf
+
+from dataset_io import load_dataset, worker_dataset
+from memory_planner import fuzzy_block_rows
+from clustering_model import MODEL_EXTENSION, load_model
+from distribuitedClustering import (squared_norms, squared_distances, session_config, make_valid_int,
+                                    make_valid_dtype, parse_valid_gpus_names, check_file_exists)
+import cpu_backend
+
+####
+# Label assignment of a dataset with fitted centers, without refitting
+# The dataset is read block by block and the labels are written to a
+# memory-mapped .npy file, so neither is ever whole in memory
+# => on CPU workers every worker reads its own range of rows from the
+#    dataset file and writes its labels straight into the output file
+# => on GPUs each device labels one block per step, while the next blocks
+#    are read from disk by a background thread
+# The labels are stored in the smallest integer type that holds K
+####
+LOG_COLUMNS = [ 'centers_file', 'data_file', 'n_obs', 'n_dim', 'K', 'num_devices', 'backend',
+                'dtype', 'block_rows', 'time', 'rows_per_second' ]
+
+LABEL_DTYPES = [np.uint8, np.uint16, np.int32]
+
+def label_dtype(K):
+    for dtype in LABEL_DTYPES:
+        if K - 1 <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("Too many centers to label : " + str(K))
+
+def load_centers(centers_file):
+    # Centers of a saved model, or a .npy or CSV file with one center per row
+    extension = os.path.splitext(centers_file)[1]
+    if extension == MODEL_EXTENSION:
+        return load_model(centers_file).centers
+    if extension == '.npy':
+        return np.load(centers_file)
+    return np.loadtxt(centers_file, delimiter = ',', ndmin = 2)
+
+def append_to_log(log_file, data_to_append):
+    if not os.path.exists(log_file):
+        with open(log_file, 'w') as f:
+            f.write(','.join(LOG_COLUMNS) + '\n')
+
+    with open(log_file, 'a') as f:
+        f.write(','.join([ str( data_to_append[column] ) for column in LOG_COLUMNS ]) + '\n')
+
+def predict_on_workers(centers, data_file, n_obs, output_file, n_workers, block_rows):
+    ####
+    # Every worker labels a contiguous range of rows, reading the dataset and
+    # writing the labels itself, the parent only sends the ranges
+    ####
+    pool = cpu_backend.WorkerPool(n_workers, 'distributedKMeans')
+    try:
+        bounds = np.linspace(0, n_obs, n_workers + 1).astype(np.int64)
+        pool.run('predict', [ (data_file, int(bounds[i]), int(bounds[i + 1]), centers, output_file, block_rows)
+                              for i in range(n_workers) ])
+    finally:
+        pool.close()
+
+def predict_on_devices(centers, X, labels, GPU_names, block_rows):
+    ####
+    # One copy of the labelling graph per device, with the centers as a
+    # constant of the graph. Each step feeds one block to every device and
+    # the blocks of the next step are read while the devices compute
+    ####
+    n_devices = len(GPU_names)
+    graph = tf.Graph()
+    with graph.as_default():
+        X_blocks = []
+        block_labels = []
+        for GPU_name in GPU_names:
+            with tf.device(GPU_name):
+                X_block = tf.placeholder(centers.dtype, shape = [None, centers.shape[1]])
+                sqr_distances = squared_distances(X_block, squared_norms(X_block), tf.constant(centers))
+                X_blocks.append(X_block)
+                block_labels.append( tf.cast(tf.argmin(sqr_distances, axis = 1), labels.dtype) )
+
+    starts = list(range(0, len(X), block_rows))
+    steps = [starts[i:i + n_devices] for i in range(0, len(starts), n_devices)]
+
+    def read_step(step):
+        return [np.asarray(X[start:start + block_rows], dtype = centers.dtype) for start in step]
+
+    with tf.Session(graph = graph, config = session_config()) as sess, ThreadPoolExecutor(1) as reader:
+        next_blocks = reader.submit(read_step, steps[0]) if steps else None
+        for (step_num, step) in enumerate(steps):
+            blocks = next_blocks.result()
+            if step_num + 1 < len(steps):
+                next_blocks = reader.submit(read_step, steps[step_num + 1])
+
+            feed_dict = dict(zip(X_blocks, blocks))
+            step_labels = sess.run(block_labels[0:len(step)], feed_dict = feed_dict)
+            for (start, values) in zip(step, step_labels):
+                labels[start:start + len(values)] = values
+
+def predict(centers, data_file, output_file, GPU_names, dtype = None, block_rows = None):
+    ####
+    # Writes the index of the nearest center of every row of data_file to
+    # output_file, a .npy file, using the GPUs or CPU workers of GPU_names
+    # The distances are computed in dtype, the one of the dataset by default
+    ####
+    if os.path.splitext(output_file)[1] != '.npy':
+        raise ValueError("Labels are written to .npy files")
+
+    # The CPU workers read their own rows, the parent only needs the shape
+    # and dtype from the header of the memory-mappable file they are given,
+    # a .npz is converted once for them instead of loaded here
+    if cpu_backend.uses_cpu_workers(GPU_names):
+        data_file = worker_dataset(data_file)
+    X = load_dataset(data_file)
+    (n_obs, n_dim) = X.shape
+    dtype = X.dtype if dtype is None else np.dtype(dtype)
+    centers = np.asarray(centers, dtype = dtype)
+    K = centers.shape[0]
+
+    if centers.shape[1] != n_dim:
+        raise ValueError("Centers have " + str(centers.shape[1]) + " dimensions, the data " + str(n_dim))
+
+    # Same N x K block size as the blocked fuzzy C-means
+    block_rows = fuzzy_block_rows(K) if block_rows is None else block_rows
+
+    start_time = time.time()
+
+    labels = np.lib.format.open_memmap(output_file, mode = 'w+', dtype = label_dtype(K), shape = (n_obs, ))
+    if cpu_backend.uses_cpu_workers(GPU_names):
+        # The header must be on disk before the workers open the file
+        labels.flush()
+        del labels
+        predict_on_workers(centers, data_file, n_obs, output_file, len(GPU_names), block_rows)
+    else:
+        predict_on_devices(centers, X, labels, GPU_names, block_rows)
+        labels.flush()
+        del labels
+
+    elapsed_time = time.time() - start_time
+
+    return {'n_obs'           : n_obs                              ,
+            'n_dim'           : n_dim                              ,
+            'K'               : K                                  ,
+            'block_rows'      : block_rows                         ,
+            'time'            : elapsed_time                       ,
+            'rows_per_second' : n_obs / max(elapsed_time, 1e-12)   }
+
+def main(centers_file, data_file, output_file, GPU_names, dtype = None, block_rows = None, log_file = None):
+    result = predict(centers     = load_centers(centers_file) ,
+                     data_file   = data_file                  ,
+                     output_file = output_file                ,
+                     GPU_names   = GPU_names                  ,
+                     dtype       = dtype                      ,
+                     block_rows  = block_rows                 )
+
+    backend = 'cpu_workers' if cpu_backend.uses_cpu_workers(GPU_names) else 'tensorflow'
+    print('Labelled', result['n_obs'], 'rows in', '%.3f' % result['time'], 's,',
+          '%.0f' % result['rows_per_second'], 'rows/s on', len(GPU_names), backend, 'devices')
+
+    if log_file is not None:
+        result.update({ 'centers_file' : centers_file                               ,
+                        'data_file'    : data_file                                  ,
+                        'num_devices'  : len(GPU_names)                             ,
+                        'backend'      : backend                                    ,
+                        'dtype'        : dtype if dtype is not None else 'data'     })
+        append_to_log(log_file, result)
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Labels a Dataset with Fitted Centers.')
+
+    parser.add_argument("--centers"                                                   ,
+                        dest     = "centers_file"                                     ,
+                        required = True                                               ,
+                        metavar  = "FILE"                                             ,
+                        type     = lambda x: check_file_exists(parser, x)             ,
+                        help     = "Saved .npz model, or .npy or CSV file with " +
+                        "the centers !!!" )
+
+    parser.add_argument("--data_file"                                                 ,
+                        dest     = "data_file"                                        ,
+                        required = True                                               ,
+                        metavar  = "FILE"                                             ,
+                        type     = lambda x: check_file_exists(parser, x)             ,
+                        help     = "Dataset to label, .npy, .bin or .npz !!!" )
+
+    parser.add_argument("--output_file"                                               ,
+                        dest     = "output_file"                                      ,
+                        required = True                                               ,
+                        metavar  = "FILE"                                             ,
+                        help     = "The labels are written to this .npy file !!!" )
+
+    parser.add_argument("--n_GPUs"                                                    ,
+                        dest     = "GPU_names"                                        ,
+                        required = False                                              ,
+                        default  = []                                                 ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: parse_valid_gpus_names(parser, x)        ,
+                        help     = "Number of GPUs !!!" )
+
+    parser.add_argument("--n_workers"                                                 ,
+                        dest     = "n_workers"                                        ,
+                        required = False                                              ,
+                        default  = 0                                                  ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_int(parser, x)                ,
+                        help     = "Number of CPU worker processes, used " +
+                        "instead of GPUs !!!" )
+
+    parser.add_argument("--dtype"                                                     ,
+                        dest     = "dtype"                                            ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "str"                                              ,
+                        type     = lambda x: make_valid_dtype(parser, x)              ,
+                        help     = "Precision of the distances, float32 or " +
+                        "float64, the one of the dataset by default !!!" )
+
+    parser.add_argument("--block_rows"                                                ,
+                        dest     = "block_rows"                                       ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "int"                                              ,
+                        type     = lambda x: make_valid_int(parser, x)                ,
+                        help     = "Rows labelled at once by each device, " +
+                        "sized from K by default !!!" )
+
+    parser.add_argument("--log_file"                                                  ,
+                        dest     = "log_file"                                         ,
+                        required = False                                              ,
+                        default  = None                                               ,
+                        metavar  = "FILE"                                             ,
+                        help     = "Appends the throughput to this CSV !!!" )
+
+    args = parser.parse_args()
+
+    # CPU worker processes take the place of the GPUs
+    if args.n_workers < 0:
+        parser.error("Number of Workers Given is Negative")
+    if args.n_workers > 0 and len(args.GPU_names) > 0:
+        parser.error("Use Either --n_GPUs or --n_workers")
+    if args.n_workers > 0:
+        args.GPU_names = cpu_backend.cpu_worker_names(args.n_workers)
+    if len(args.GPU_names) == 0:
+        parser.error("Give a Positive --n_GPUs or --n_workers")
+    if args.block_rows is not None and args.block_rows <= 0:
+        parser.error("Number of Block Rows Given is Non Positive")
+
+    status = main(centers_file = args.centers_file ,
+                  data_file    = args.data_file    ,
+                  output_file  = args.output_file  ,
+                  GPU_names    = args.GPU_names    ,
+                  dtype        = args.dtype        ,
+                  block_rows   = args.block_rows   ,
+                  log_file     = args.log_file     )
+
+    sys.exit(status)
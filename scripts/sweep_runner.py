@@ -0,0 +1,356 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from dataset_io import load_dataset
+from distribuitedClustering import (main, is_valid_file, get_available_gpus, clustering_params,
+                                    clear_clusterers_cache, close_worker_pools, check_file_exists,
+                                    DEFAULT_FUZZIFIER, DEFAULT_MINI_BATCH_SIZE, DEFAULT_FULL_PASS_EVERY,
+                                    LOG_COLUMNS)
+from ledger import Ledger, is_ledger
+import cpu_backend
+
+####
+# Benchmark sweep run in a single process
+# The sweep is a grid of parameters, every combination is one call of
+# distribuitedClustering.main, so tensorflow is imported, the devices listed
+# and the dataset opened only once. Smaller n_obs are prefixes of the
+# dataset, and the CPU worker processes are kept for the whole sweep
+# Runs already in the log are skipped, so an interrupted sweep resumes
+# where it stopped. With concurrent the runs needing fewer devices than
+# available are run at the same time on disjoint sets of devices, their
+# times are then measured on a shared host
+# A sweep is given as a dict (or a JSON file) such as :
+# {   "data_file" : "class-data.npy",
+#     "log_file"  : "executions_log.csv",
+#     "backend"   : "tensorflow",
+#     "grid"      : { "K": [3, 6], "n_devices": [1, 2], "method_name": ["distributedKMeans"] },
+#     "fixed"     : { "n_max_iters": 20, "seed": 123128 } }
+# where "backend" is tensorflow, for the GPUs, or cpu_workers, with
+# "n_workers" workers shared by the runs. With "multi_K" the runs differing
+# only in K fit their models together, in shared passes over the data
+# With "nvprof_dir" every run is a distribuitedClustering.py process of its
+# own under nvprof, which profiles whole processes, and its nvprof log is
+# written in nvprof_dir with the name compileResults.py parses
+####
+SWEEP_PARAMS = [ 'n_obs', 'K', 'n_devices', 'method_name', 'seed', 'n_max_iters', 'tol',
+                 'inertia_tol', 'init', 'dtype', 'fuzzifier', 'device_memory', 'mini_batch_size',
+                 'full_pass_every', 'coreset_size' ]
+
+REQUIRED_PARAMS = [ 'K', 'n_devices', 'method_name', 'seed', 'n_max_iters' ]
+
+DEFAULT_PARAMS = {  'n_obs'           : None                    ,
+                    'tol'             : 0.0                     ,
+                    'inertia_tol'     : 0.0                     ,
+                    'init'            : 'k-means||'             ,
+                    'dtype'           : None                    ,
+                    'fuzzifier'       : DEFAULT_FUZZIFIER       ,
+                    'device_memory'   : None                    ,
+                    'mini_batch_size' : DEFAULT_MINI_BATCH_SIZE ,
+                    'full_pass_every' : DEFAULT_FULL_PASS_EVERY ,
+                    'coreset_size'    : None                     }
+
+# Log columns identifying a run, and the parameters that do not change the
+# clusterer, so that the runs differing only in them share its graph
+# n_max_iters, tol and inertia_tol are empty in the rows logged before they
+# were columns of the log, those runs are run again rather than taken for
+# runs with any stopping parameters
+KEY_COLUMNS = [ 'method_name', 'seed', 'num_GPUs', 'K', 'n_obs', 'n_dim', 'init', 'backend',
+                'dtype', 'fuzzifier', 'mini_batch_size', 'full_pass_every', 'coreset_size',
+                'n_max_iters', 'tol', 'inertia_tol' ]
+
+RUN_ONLY_PARAMS = [ 'seed', 'n_max_iters', 'tol', 'inertia_tol', 'init' ]
+
+BACKENDS = ['tensorflow', 'cpu_workers']
+
+DISTRIBUITED_CLUSTERING = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'distribuitedClustering.py')
+
+# Parameters given to a profiled process only when they are set
+OPTIONAL_FLAGS = [ 'tol', 'inertia_tol', 'device_memory', 'init', 'dtype', 'fuzzifier', 'mini_batch_size',
+                   'full_pass_every', 'coreset_size' ]
+
+def expand_grid(grid, fixed):
+    ####
+    # One configuration per combination of the values of the grid, in the
+    # order of the grid, the first parameter varying the slowest
+    ####
+    unknown = set(grid) | set(fixed)
+    unknown.difference_update(SWEEP_PARAMS)
+    if unknown:
+        raise ValueError("Unknown sweep parameters " + ', '.join(sorted(unknown)))
+
+    names = list(grid.keys())
+    configs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        config = dict(DEFAULT_PARAMS)
+        config.update(fixed)
+        config.update(zip(names, values))
+
+        missing = [name for name in REQUIRED_PARAMS if name not in config]
+        if missing:
+            raise ValueError("Missing sweep parameters " + ', '.join(missing))
+        configs.append(config)
+    return configs
+
+def run_key(config, n_dim, dtype, backend):
+    # The values the run of config logs in the KEY_COLUMNS
+    method_params = clustering_params(config['method_name'], config['fuzzifier'], config['mini_batch_size'],
+                                      config['full_pass_every'])
+    return ( str(config['method_name']), str(config['seed']), str(config['n_devices']), str(config['K']),
+             str(config['n_obs']), str(n_dim), str(config['init']), backend,
+             dtype if config['dtype'] is None else str(config['dtype']),
+             str(method_params.get('fuzzifier', '')), str(method_params.get('mini_batch_size', '')),
+             str(method_params.get('full_pass_every', '')),
+             '' if config['coreset_size'] is None else str(config['coreset_size']),
+             str(int(config['n_max_iters'])), str(float(config['tol'])), str(float(config['inertia_tol'])) )
+
+def completed_runs(log_file):
+    ####
+    # Keys of the runs of the log that finished, failed runs log the name of
+    # their exception in the times and are run again, as the runs that a
+    # ledger has as failed or still running
+    # Columns missing from the header of an old CSV log are None and match
+    # any value. An empty value was logged, the run had no such parameter
+    # (no coreset, no fuzzifier ...), and only matches an empty one. The
+    # ledger has all the columns, a NULL is a run logged before its column
+    # existed, which had no such parameter either, so it reads as empty
+    ####
+    if is_ledger(log_file):
+        return [ tuple(str(value) for value in run) for run in Ledger(log_file, LOG_COLUMNS).completed(KEY_COLUMNS) ]
+
+    runs = []
+    with open(log_file, 'r') as f:
+        reader = csv.DictReader(f)
+        logged_columns = [column for column in KEY_COLUMNS if column in (reader.fieldnames or [])]
+        for row in reader:
+            try:
+                float(row['computation_time'])
+            except (TypeError, ValueError):
+                continue
+            runs.append( tuple((row[column] or '') if column in logged_columns else None for column in KEY_COLUMNS) )
+    return runs
+
+def is_completed(key, runs):
+    return any( all(logged is None or logged == value for (logged, value) in zip(run, key)) for run in runs )
+
+def pending_configs(configs, log_file, data_shape, dtype, backend):
+    # Configurations of a dataset of data_shape whose run is not completed in log_file
+    runs = completed_runs(log_file)
+    pending = []
+    for config in configs:
+        logged_config = dict(config, n_obs = data_shape[0] if config['n_obs'] is None else config['n_obs'])
+        if not is_completed(run_key(logged_config, data_shape[1], dtype, backend), runs):
+            pending.append(config)
+    return pending
+
+class DeviceAllocator(object):
+    ####
+    # Hands out disjoint sets of devices to the concurrent runs, the devices
+    # are given in a fixed order so that the runs of the same size tend to
+    # get the same devices, and the same cached workers
+    ####
+    def __init__(self, device_names):
+        self.device_names = list(device_names)
+        self.free = list(device_names)
+        self.condition = threading.Condition()
+
+    def acquire(self, n_devices):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.free) >= n_devices)
+            (devices, self.free) = (self.free[0:n_devices], self.free[n_devices:])
+            return devices
+
+    def release(self, devices):
+        with self.condition:
+            self.free = [name for name in self.device_names if name in self.free or name in devices]
+            self.condition.notify_all()
+
+def merge_K(configs):
+    ####
+    # Merges the configurations differing only in K into one with the list
+    # of their K, in the order of the grid, distribuitedClustering.main fits
+    # their models together. Mini-batch and coreset runs are not merged
+    ####
+    merged = OrderedDict()
+    for (config_num, config) in enumerate(configs):
+        if config['method_name'] == 'distributedMiniBatchKMeans' or config['coreset_size'] is not None:
+            merge_key = config_num
+        else:
+            merge_key = tuple( (name, str(value)) for (name, value) in sorted(config.items()) if name != 'K' )
+        merged.setdefault(merge_key, dict(config, K = []))['K'].append(config['K'])
+
+    return [ dict(config, K = config['K'][0]) if len(config['K']) == 1 else config for config in merged.values() ]
+
+def run_group(configs, X, data_file, log_file, allocator):
+    ####
+    # Runs configurations sharing a clusterer on one set of devices, the
+    # clusterer is freed afterwards so that the shards of the finished runs
+    # do not stay on the devices
+    ####
+    devices = allocator.acquire(configs[0]['n_devices'])
+    status = 0
+    try:
+        for config in configs:
+            n_obs = len(X) if config['n_obs'] is None else config['n_obs']
+            status |= main(n_obs           = n_obs                      ,
+                           n_dim           = X.shape[1]                 ,
+                           K               = config['K']                ,
+                           GPU_names       = devices                    ,
+                           n_max_iters     = config['n_max_iters']      ,
+                           seed            = config['seed']             ,
+                           log_file        = log_file                   ,
+                           method_name     = config['method_name']      ,
+                           data_file       = data_file                  ,
+                           tol             = config['tol']              ,
+                           inertia_tol     = config['inertia_tol']      ,
+                           device_memory   = config['device_memory']    ,
+                           init            = config['init']             ,
+                           dtype           = config['dtype']            ,
+                           fuzzifier       = config['fuzzifier']        ,
+                           mini_batch_size = config['mini_batch_size']  ,
+                           full_pass_every = config['full_pass_every']  ,
+                           coreset_size    = config['coreset_size']     ,
+                           X               = X[0:n_obs]                 )
+    finally:
+        clear_clusterers_cache(devices)
+        allocator.release(devices)
+    return status
+
+def nvprof_log_name(config, n_obs, n_dim):
+    # method-GPUs2-n_obs1000-n_dims5-K3.log, see compileResults.py
+    return ( config['method_name'] + '-GPUs' + str(config['n_devices']) + '-n_obs' + str(n_obs) +
+             '-n_dims' + str(n_dim) + '-K' + str(config['K']) + '.log' )
+
+def run_profiled(config, n_obs, n_dim, data_file, log_file, nvprof_dir):
+    ####
+    # Runs one configuration in a distribuitedClustering.py process under
+    # nvprof, the process logs the run as the ones of the sweep and nvprof
+    # writes its profile in nvprof_dir. Returns the exit status of the run
+    ####
+    command = [ 'nvprof', '--log-file', os.path.join(nvprof_dir, nvprof_log_name(config, n_obs, n_dim)),
+                sys.executable, DISTRIBUITED_CLUSTERING,
+                '--n_obs', str(n_obs), '--n_dim', str(n_dim), '--K', str(config['K']),
+                '--n_GPUs', str(config['n_devices']), '--n_max_iters', str(config['n_max_iters']),
+                '--seed', str(config['seed']), '--log_file', log_file,
+                '--method_name', config['method_name'], '--data_file', data_file ]
+    for name in OPTIONAL_FLAGS:
+        if config[name] is not None:
+            command.extend(['--' + name, str(config[name])])
+
+    status = subprocess.call(command)
+    print(nvprof_log_name(config, n_obs, n_dim) + ' - Return code: ' + str(status))
+    return status
+
+def run_sweep(data_file, log_file, grid, fixed = None, backend = 'tensorflow', n_workers = None,
+              concurrent = False, multi_K = False, nvprof_dir = None):
+    start_time = time.time()
+
+    if backend not in BACKENDS:
+        raise ValueError("Backend Must Be One of " + ', '.join(BACKENDS))
+    if nvprof_dir is not None and (backend != 'tensorflow' or concurrent or multi_K):
+        raise ValueError("nvprof profiles the GPU runs one at a time, without concurrent or multi_K runs")
+
+    if backend == 'cpu_workers':
+        device_names = cpu_backend.cpu_worker_names(n_workers or 0)
+    elif nvprof_dir is None:
+        device_names = get_available_gpus()
+    else:
+        # Listing the GPUs here would hold their memory during the profiled
+        # runs, each process checks the GPUs it is given
+        device_names = None
+
+    X = load_dataset(data_file)
+    is_valid_file(None, log_file)
+
+    configs = expand_grid(grid, fixed or {})
+    for config in configs:
+        if config['n_devices'] <= 0:
+            raise ValueError("Runs on " + str(config['n_devices']) + " devices")
+        if device_names is not None and config['n_devices'] > len(device_names):
+            raise ValueError("Runs on " + str(config['n_devices']) + " devices, " +
+                             str(len(device_names)) + " are available")
+        if config['n_obs'] is not None and config['n_obs'] > len(X):
+            raise ValueError("Runs on " + str(config['n_obs']) + " observations, " +
+                             data_file + " has " + str(len(X)))
+
+    # Runs in the log are not run again
+    pending = pending_configs(configs, log_file, X.shape, X.dtype.name, backend)
+    print(len(configs) - len(pending), 'of the', len(configs), 'runs of the sweep are already in', log_file)
+    n_pending = len(pending)
+
+    if multi_K:
+        pending = merge_K(pending)
+
+    # Consecutive runs differing only in RUN_ONLY_PARAMS share their clusterer
+    groups = OrderedDict()
+    for config in pending:
+        group_key = tuple( (name, str(value)) for (name, value) in sorted(config.items())
+                           if name not in RUN_ONLY_PARAMS )
+        groups.setdefault(group_key, []).append(config)
+
+    allocator = DeviceAllocator(device_names or [])
+    status = 0
+    try:
+        if nvprof_dir is not None:
+            if not os.path.exists(nvprof_dir):
+                os.makedirs(nvprof_dir)
+            for config in pending:
+                n_obs = len(X) if config['n_obs'] is None else config['n_obs']
+                status |= run_profiled(config, n_obs, X.shape[1], data_file, log_file, nvprof_dir)
+        elif concurrent:
+            with ThreadPoolExecutor(len(device_names)) as executor:
+                futures = [ executor.submit(run_group, group, X, data_file, log_file, allocator)
+                            for group in groups.values() ]
+                for future in futures:
+                    status |= future.result()
+        else:
+            for group in groups.values():
+                status |= run_group(group, X, data_file, log_file, allocator)
+    finally:
+        close_worker_pools()
+
+    print('sweep of', n_pending, 'runs done in', '%.1f' % (time.time() - start_time), 's')
+    return status
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Runs a Grid of Distribuited Clustering Benchmarks.')
+
+    parser.add_argument("--sweep"                                                     ,
+                        dest     = "sweep_file"                                       ,
+                        required = True                                               ,
+                        metavar  = "FILE"                                             ,
+                        type     = lambda x: check_file_exists(parser, x)             ,
+                        help     = "JSON file with the data_file, log_file, grid " +
+                        "and fixed parameters of the sweep !!!" )
+
+    parser.add_argument("--concurrent"                                                ,
+                        dest     = "concurrent"                                       ,
+                        action   = "store_true"                                       ,
+                        help     = "Runs the configurations on disjoint sets of " +
+                        "devices at the same time !!!" )
+
+    args = parser.parse_args()
+
+    with open(args.sweep_file, 'r') as f:
+        sweep = json.load(f)
+
+    status = run_sweep(data_file  = sweep['data_file']                     ,
+                       log_file   = sweep['log_file']                      ,
+                       grid       = sweep['grid']                          ,
+                       fixed      = sweep.get('fixed')                     ,
+                       backend    = sweep.get('backend', 'tensorflow')     ,
+                       n_workers  = sweep.get('n_workers')                 ,
+                       concurrent = args.concurrent or sweep.get('concurrent', False),
+                       multi_K    = sweep.get('multi_K', False)            ,
+                       nvprof_dir = sweep.get('nvprof_dir')                    )
+
+    sys.exit(status)
@@ -0,0 +1,175 @@
+import contextlib
+import csv
+import json
+import re
+import threading
+import time
+
+####
+# Per iteration and per shard timings of the fits
+# A Timeline records events (iteration, device, shard, phase, name, start,
+# duration, source) where the phase is one of PHASES :
+# => on tensorflow devices the events are the ops of the traced session
+#    runs (RunOptions FULL_TRACE), their phase is the innermost name scope
+#    of the op that is a phase, see node_phase
+# => on CPU workers and on the host they are wall clock spans
+# The timeline of a thread is switched on by running the fit inside
+# recording(Timeline()). Otherwise the clusterers get NULL_TIMELINE, whose
+# spans do nothing and which never asks tensorflow for traces
+# Timelines are saved as a Chrome trace (chrome://tracing or Perfetto) and
+# as a tidy CSV with one row per event
+####
+PHASES = ['distance', 'assignment', 'local_reduction', 'global_reduction', 'host_transfer']
+
+# Name scopes of the graphs standing for a phase, besides the phases themselves
+SCOPE_PHASES = {    'global' : 'global_reduction' ,
+                    'bounds' : 'assignment'        }
+
+TIMELINE_COLUMNS = [ 'iteration', 'device', 'shard', 'phase', 'name', 'start', 'duration', 'source' ]
+
+HOST_DEVICE = 'host'
+
+SHARD_SCOPE = re.compile(r'scope_(\d+)')
+
+def node_phase(node_name, timeline_label, device):
+    # Phase of an op of a traced session run
+    if 'memcpy' in device.lower() or '_Send' in timeline_label or '_Recv' in timeline_label:
+        return 'host_transfer'
+    for scope in reversed(node_name.split('/')):
+        if scope in PHASES:
+            return scope
+        if scope in SCOPE_PHASES:
+            return SCOPE_PHASES[scope]
+    return 'other'
+
+class Span(object):
+    # Wall clock event, recorded when the with block ends
+    __slots__ = ['timeline', 'phase', 'device', 'shard', 'name', 'start']
+
+    def __init__(self, timeline, phase, device, shard, name):
+        (self.timeline, self.phase, self.device, self.shard, self.name) = (timeline, phase, device, shard, name)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timeline.add(self.phase, self.device, self.shard, self.name, self.start, time.time() - self.start)
+        return False
+
+class NullSpan(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Timeline(object):
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+        # Iteration of the fit the events are recorded in, None outside the iterations
+        self.iteration = None
+
+    def span(self, phase, device = HOST_DEVICE, shard = '', name = None):
+        return Span(self, phase, device, shard, phase if name is None else name)
+
+    def add(self, phase, device, shard, name, start, duration, source = 'wall'):
+        self.events.append( (self.iteration, device, shard, phase, name, start, duration, source) )
+
+    def add_worker_events(self, events, device, shard):
+        # Events recorded by a worker process, tagged with its device and shard
+        for (_, _, _, phase, name, start, duration, source) in events:
+            self.add(phase, device, shard, name, start, duration, source)
+
+    def add_step_stats(self, step_stats):
+        ####
+        # Ops of a session run traced with RunOptions FULL_TRACE, the devices
+        # of GPUs also list all their ops on a 'stream:all' device, skipped
+        ####
+        for device_stats in step_stats.dev_stats:
+            if device_stats.device.endswith('stream:all'):
+                continue
+            for node_stats in device_stats.node_stats:
+                shard = SHARD_SCOPE.search(node_stats.node_name)
+                self.add(phase    = node_phase(node_stats.node_name, node_stats.timeline_label, device_stats.device),
+                         device   = device_stats.device                             ,
+                         shard    = '' if shard is None else int(shard.group(1))    ,
+                         name     = node_stats.node_name                            ,
+                         start    = node_stats.all_start_micros * 1e-6              ,
+                         duration = node_stats.all_end_rel_micros * 1e-6            ,
+                         source   = 'tensorflow'                                    )
+
+    def save(self, prefix):
+        # Writes prefix.json, the Chrome trace, and prefix.csv
+        self.save_chrome_trace(prefix + '.json')
+        self.save_csv(prefix + '.csv')
+        return (prefix + '.json', prefix + '.csv')
+
+    def save_chrome_trace(self, trace_file):
+        # One trace process per device and one thread per shard
+        devices = []
+        trace_events = []
+        for (iteration, device, shard, phase, name, start, duration, source) in self.events:
+            if device not in devices:
+                devices.append(device)
+                trace_events.append( {  'name' : 'process_name', 'ph' : 'M', 'pid' : len(devices) - 1,
+                                        'args' : {'name' : device} } )
+
+            trace_events.append( {  'name' : name, 'cat' : phase, 'ph' : 'X',
+                                    'ts'   : start * 1e6, 'dur' : duration * 1e6,
+                                    'pid'  : devices.index(device), 'tid' : 0 if shard == '' else shard,
+                                    'args' : {'iteration' : iteration, 'phase' : phase, 'source' : source} } )
+
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents' : trace_events, 'displayTimeUnit' : 'ms'}, f)
+
+    def save_csv(self, csv_file):
+        with open(csv_file, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(TIMELINE_COLUMNS)
+            for event in self.events:
+                writer.writerow(['' if value is None else value for value in event])
+
+class NullTimeline(object):
+    # Timeline of the fits that are not recorded
+    enabled = False
+    events = ()
+
+    def __setattr__(self, name, value):
+        # The fits set the iteration of any timeline, the null one is shared
+        pass
+
+    def span(self, phase, device = HOST_DEVICE, shard = '', name = None):
+        return NULL_SPAN
+
+    def add(self, phase, device, shard, name, start, duration, source = 'wall'):
+        pass
+
+    def add_worker_events(self, events, device, shard):
+        pass
+
+    def add_step_stats(self, step_stats):
+        pass
+
+NULL_TIMELINE = NullTimeline()
+
+_active = threading.local()
+
+def active_timeline():
+    return getattr(_active, 'timeline', NULL_TIMELINE)
+
+@contextlib.contextmanager
+def recording(timeline):
+    # Fits run by this thread inside the with block record to timeline
+    previous = active_timeline()
+    _active.timeline = timeline
+    try:
+        yield timeline
+    finally:
+        _active.timeline = previous
@@ -0,0 +1,17 @@
+import sys
+
+####
+# The clustering engines are built with the tensorflow 1 graph API. Under
+# tensorflow 2 the tests import its tf.compat.v1 as tensorflow, with the v2
+# behavior disabled, before any test imports distribuitedClustering
+####
+try:
+    import tensorflow
+    from tensorflow.python.client import device_lib
+except ImportError:
+    tensorflow = None
+
+if tensorflow is not None and not hasattr(tensorflow, 'Session'):
+    import tensorflow.compat.v1 as tf_v1
+    tf_v1.disable_v2_behavior()
+    sys.modules['tensorflow'] = tf_v1
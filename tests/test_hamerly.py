@@ -0,0 +1,26 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+# conftest.py gives the tensorflow 1 graph API under tensorflow 2
+pytest.importorskip('tensorflow')
+
+from distribuitedClustering import clear_clusterers_cache, distribuited_clustering
+
+def test_skipped_fraction_is_a_fraction_from_the_first_iteration():
+    # The first iteration tightens the upper bound of every point, those
+    # checks are not counted in the skipped distances
+    X = np.random.RandomState(3).randn(2000, 4)
+    result = distribuited_clustering('distributedHamerlyKMeans', X, 8, ['/cpu:0'], 'random', 10, seed = 3)
+    clear_clusterers_cache()
+
+    skipped_fraction = result['skipped_fraction_history']
+    assert 0.0 <= skipped_fraction[0] <= 1.0
+    assert all(0.0 <= fraction <= 1.0 for fraction in skipped_fraction)
+    assert skipped_fraction[-1] > 0.0
+    assert result['checked_fraction_history'][0] == 1.0
+    assert all(0.0 <= fraction <= 1.0 for fraction in result['checked_fraction_history'])
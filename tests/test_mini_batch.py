@@ -0,0 +1,41 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import cpu_backend
+from distribuitedClustering import clear_clusterers_cache, close_worker_pools, distribuited_clustering
+
+# Mini-batch k-means must end within this relative gap of the inertia of
+# full k-means started from the same k-means|| centers
+INERTIA_GAP = 0.01
+
+def test_mini_batch_inertia_is_close_to_k_means_with_fewer_rows_touched():
+    rng = np.random.RandomState(0)
+    centers = rng.uniform(-6, 6, size = (8, 4))
+    X = centers[rng.randint(8, size = 100000)] + rng.randn(100000, 4)
+    worker_names = cpu_backend.cpu_worker_names(2)
+
+    try:
+        full = distribuited_clustering('distributedKMeans', X, 8, worker_names, 'k-means||', 100,
+                                       inertia_tol = 1e-4, seed = 0)
+        # No inertia_tol, the mini-batch default stops it long before n_max_iters
+        mini_batch = distribuited_clustering('distributedMiniBatchKMeans', X, 8, worker_names, 'k-means||', 1000,
+                                             seed = 0, method_params = {'mini_batch_size' : 2000,
+                                                                        'full_pass_every' : 20})
+    finally:
+        clear_clusterers_cache()
+        close_worker_pools()
+
+    gap = mini_batch['inertia_history'][-1] / full['inertia_history'][-1] - 1
+    assert abs(gap) <= INERTIA_GAP
+
+    # The last iteration is a full pass, so its inertia is exact
+    assert mini_batch['n_iter'] < 1000
+    assert mini_batch['full_pass_history'][-1] == 1.0
+    assert sum(mini_batch['full_pass_history']) == mini_batch['n_iter'] // 20
+
+    data_passes = float(np.sum(mini_batch['rows_touched_history'])) / len(X)
+    assert data_passes < full['n_iter']
@@ -0,0 +1,101 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from distribuitedClustering import LOG_COLUMNS, append_to_log, is_valid_file
+from ledger import Ledger
+from sweep_runner import expand_grid, pending_configs
+
+DATA_SHAPE = (1000, 4)
+
+def logged_run(K, coreset_size, n_max_iters = 5):
+    # Log record of a finished run, as distribuitedClustering.main writes it
+    record = dict((column, '') for column in LOG_COLUMNS)
+    record.update({ 'method_name'      : 'distributedKMeans'                         ,
+                    'seed'             : 7                                           ,
+                    'num_GPUs'         : 1                                           ,
+                    'K'                : K                                           ,
+                    'n_obs'            : DATA_SHAPE[0]                               ,
+                    'n_dim'            : DATA_SHAPE[1]                               ,
+                    'init'             : 'k-means||'                                 ,
+                    'backend'          : 'cpu_workers'                               ,
+                    'dtype'            : 'float64'                                   ,
+                    'computation_time' : 0.5                                         ,
+                    'coreset_size'     : '' if coreset_size is None else coreset_size ,
+                    'n_max_iters'      : n_max_iters                                 ,
+                    'tol'              : 0.0                                         ,
+                    'inertia_tol'      : 0.0                                         })
+    return record
+
+def grid_configs():
+    return expand_grid({ 'K' : [3, 5], 'coreset_size' : [None, 100] },
+                       { 'n_devices' : 1, 'method_name' : 'distributedKMeans', 'seed' : 7, 'n_max_iters' : 5 })
+
+def pending_keys(log_file, configs = None):
+    configs = grid_configs() if configs is None else configs
+    pending = pending_configs(configs, log_file, DATA_SHAPE, 'float64', 'cpu_workers')
+    return sorted( (config['K'], config['coreset_size'] or 0) for config in pending )
+
+def write_log(log_file, records):
+    if log_file.endswith('.csv'):
+        for record in records:
+            append_to_log(log_file, record)
+    else:
+        ledger = Ledger(log_file, LOG_COLUMNS)
+        for record in records:
+            ledger.finish_run(ledger.start_run(record), record)
+
+@pytest.mark.parametrize('extension', ['.csv', '.db'])
+def test_runs_without_coreset_do_not_complete_coreset_runs(tmp_path, extension):
+    log_file = str(tmp_path / ('log' + extension))
+    is_valid_file(None, log_file)
+
+    write_log(log_file, [logged_run(3, None), logged_run(5, None), logged_run(3, 100)])
+
+    assert pending_keys(log_file) == [(5, 100)]
+
+@pytest.mark.parametrize('extension', ['.csv', '.db'])
+def test_runs_differing_in_stopping_parameters_are_not_completed(tmp_path, extension):
+    log_file = str(tmp_path / ('log' + extension))
+    is_valid_file(None, log_file)
+    write_log(log_file, [logged_run(3, None, n_max_iters = 5)])
+
+    configs = expand_grid({ 'n_max_iters' : [5, 20], 'tol' : [0.0, 1e-4] },
+                          { 'K' : 3, 'n_devices' : 1, 'method_name' : 'distributedKMeans', 'seed' : 7 })
+    pending = pending_configs(configs, log_file, DATA_SHAPE, 'float64', 'cpu_workers')
+    assert sorted( (config['n_max_iters'], config['tol']) for config in pending ) == [(5, 1e-4), (20, 0.0),
+                                                                                      (20, 1e-4)]
+
+def test_columns_missing_from_old_logs_match_any_value(tmp_path):
+    # A log written before coreset_size existed, its runs had no coreset
+    log_file = str(tmp_path / 'log.csv')
+    old_columns = LOG_COLUMNS[0:LOG_COLUMNS.index('coreset_size')]
+    with open(log_file, 'w') as f:
+        f.write(','.join(old_columns) + '\n')
+        f.write(','.join(str(logged_run(3, None)[column]) for column in old_columns) + '\n')
+
+    assert pending_keys(log_file) == [(5, 0), (5, 100)]
+
+def test_exported_ledger_is_a_csv_log_that_can_be_resumed_and_appended_to(tmp_path):
+    db_file = str(tmp_path / 'log.db')
+    csv_file = str(tmp_path / 'log.csv')
+    ledger = Ledger(db_file, LOG_COLUMNS)
+    write_log(db_file, [logged_run(3, None), logged_run(5, None)])
+    failed = logged_run(3, 100)
+    failed['computation_time'] = 'MemoryError'
+    ledger.finish_run(ledger.start_run(failed), failed, error = 'MemoryError')
+
+    assert ledger.export_csv(csv_file) == 3
+    with open(csv_file, 'r') as f:
+        assert f.readline().rstrip('\n') == ','.join(LOG_COLUMNS)
+    assert pending_keys(csv_file) == [(3, 100), (5, 100)]
+
+    append_to_log(csv_file, logged_run(5, 100))
+    assert pending_keys(csv_file) == [(3, 100)]
+
+    ledger.export_csv(csv_file, ledger_fields = True)
+    with open(csv_file, 'r') as f:
+        assert f.readline().rstrip('\n') == ','.join(LOG_COLUMNS + ['run_id', 'status', 'error'])